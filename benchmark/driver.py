@@ -0,0 +1,298 @@
+import heapq
+import logging
+import resource
+import time
+from random import Random
+from threading import Condition, Thread
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+from benchmark.fakePlayers import FakePlayer, FakePlayers, PLAYINGKEY, STOPPEDKEY, SEEKCOMMAND, VOLUMECOMMAND, STOPCOMMAND, PLAYCOMMAND
+from benchmark.fakeServer import FakeLibrary, FakeEpisode, FakeMarker, FakePlexServer
+
+
+INTRO = "intro"
+CREDITS = "credits"
+
+
+class MarkerRun():
+    # One marker on one playback, when the playhead reached it and what the skipper did about it. Reaction runs are
+    # entered by a user seek into the middle of the marker so the alert reporting it is what the skipper has to act on
+    __slots__ = ("player", "product", "sessionKey", "kind", "start", "end", "reaction", "crossed", "alerted", "command",
+                 "commandAt", "position", "target", "lastAlert", "landedAt", "landed", "restoredAt", "nextAt", "missed", "done")
+
+    def __init__(self, player: FakePlayer, marker: FakeMarker, reaction: bool) -> None:
+        self.player: str = player.machineIdentifier
+        self.product: str = player.product
+        self.sessionKey: int = player.sessionKey
+        self.kind: str = marker.type
+        self.start: int = marker.start
+        self.end: int = marker.end
+        self.reaction: bool = reaction
+        self.crossed: float = None
+        self.alerted: float = None
+        self.command: str = None
+        self.commandAt: float = None
+        self.position: int = None
+        self.target: int = None
+        self.lastAlert: float = None
+        self.landedAt: float = None
+        self.landed: int = None
+        self.restoredAt: float = None
+        self.nextAt: float = None
+        self.missed: bool = False
+        self.done: bool = False
+
+    def toJson(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Driver(Thread):
+    # Scripts playback on every fake player: start an episode a little before its intro, report progress over the
+    # websocket like Plex does, sometimes jump into the intro instead, seek to just before the credits once the intro
+    # is dealt with and start the next episode when it ends. Commands from the skipper land after the player's latency
+    START = "start"
+    ALERT = "alert"
+    SEEK = "seek"
+    LAND = "land"
+    LEAVE = "leave"
+    END = "end"
+    PLAY = "play"
+
+    LEAD_IN = (4000, 12000)
+    JUMP_AFTER = (1.0, 3.0)
+    DWELL = (2.0, 5.0)
+    IDLE = (1.0, 3.0)
+    PLAY_TIMEOUT = 10.0
+
+    def __init__(self, server: FakePlexServer, interval: float = 1.0, jumps: float = 0.25, ramp: float = 10.0, seed: int = 0, logger: logging.Logger = None) -> None:
+        super(Driver, self).__init__(name="Driver", daemon=True)
+        self.log = logger or logging.getLogger(__name__)
+        self.server: FakePlexServer = server
+        self.library: FakeLibrary = server.library
+        self.players: FakePlayers = server.players
+        self.interval: float = interval
+        self.jumps: float = jumps
+        self.ramp: float = ramp
+        self.random: Random = Random(seed)
+
+        self.runs: List[MarkerRun] = []
+        self.current: Dict[int, MarkerRun] = {}
+        self.sessionKey: int = 0
+        self.sessions: int = 0
+        self.strays: int = 0
+        self.started: float = None
+        self.stopped: float = None
+
+        self._heap: List[Tuple[float, int, str, FakePlayer, int, object]] = []
+        self._counter: int = 0
+        self._condition: Condition = Condition()
+        self._running: bool = True
+        self._usage: resource.struct_rusage = None
+
+        server.onCommand = self.command
+
+    def schedule(self, when: float, kind: str, player: FakePlayer, generation: int = None, data=None) -> None:
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._heap, (when, self._counter, kind, player, generation, data))
+            if self._heap[0][1] == self._counter:
+                self._condition.notify()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join()
+
+    def run(self) -> None:
+        self._usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.started = time.monotonic()
+        for player in self.players:
+            self.schedule(self.started + self.ramp * player.index / len(self.players), self.START, player)
+        while True:
+            with self._condition:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if not self._running:
+                    break
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap))
+            for when, _, kind, player, generation, data in due:
+                if generation is not None and generation != player.generation:
+                    continue
+                with self.server.lock:
+                    try:
+                        self.handle(kind, player, when, data)
+                    except:
+                        self.log.exception("Error handling %s for %s" % (kind, player))
+        self.stopped = time.monotonic()
+
+    def handle(self, kind: str, player: FakePlayer, when: float, data) -> None:
+        if kind == self.START:
+            self.begin(player, when)
+        elif kind == self.ALERT:
+            if player.active:
+                self.server.notify(player, time.monotonic())
+                self.schedule(when + self.interval, self.ALERT, player, player.generation)
+        elif kind == self.SEEK:
+            offset, marker, reaction = data
+            if marker:
+                self.track(player, marker, reaction)
+            player.anchor(offset, PLAYINGKEY, when)
+            self.retime(player, when)
+            if reaction:
+                self.current[player.index].alerted = player.lastAlert
+        elif kind == self.LAND:
+            self.land(player, when, *data)
+        elif kind == self.LEAVE:
+            run = self.current.get(player.index)
+            if run and not run.done:
+                run.missed = run.commandAt is None
+                self.advance(player, run, when)
+        elif kind == self.END:
+            player.anchor(player.episode.duration, STOPPEDKEY, when)
+            self.server.notify(player, when)
+            self.schedule(when + self.random.uniform(*self.IDLE), self.START, player, player.generation)
+        elif kind == self.PLAY:
+            playQueueID, offset = data
+            episode = self.library.get(self.server.queues.selected(playQueueID))
+            if episode:
+                self.begin(player, when, episode, playQueueID, offset)
+
+    def begin(self, player: FakePlayer, now: float, episode: FakeEpisode = None, playQueueID: int = None, offset: int = None) -> None:
+        if not episode:
+            shows = self.library.shows
+            episode = self.library.next(player.episode) if player.episode else shows[player.index % len(shows)].episodes[(player.index // len(shows)) % len(shows[0].episodes)]
+        self.sessionKey += 1
+        self.sessions += 1
+        player.sessionKey = self.sessionKey
+        player.episode = episode
+        player.volume = 100
+        if not playQueueID:
+            episodes = [e.ratingKey for e in episode.show.episodes]
+            playQueueID = self.server.queues.create(episodes[episodes.index(episode.ratingKey):], episode.ratingKey)
+        player.playQueueID = playQueueID
+
+        intro = episode.marker(INTRO)
+        leadIn = self.random.randint(*self.LEAD_IN)
+        reaction = self.random.random() < self.jumps
+        self.current.pop(player.index, None)
+        if offset is None:
+            # Started from the library just before the intro, reaction runs jump into it before it is reached
+            self.track(player, intro, reaction)
+            player.anchor(max(intro.start - leadIn, 0), PLAYINGKEY, now)
+            self.retime(player, now)
+            if reaction:
+                self.jump(player, intro, now + self.random.uniform(*self.JUMP_AFTER))
+        else:
+            # Started by skip-next, the user seeks from wherever it started to just before the intro
+            player.anchor(offset, PLAYINGKEY, now)
+            self.retime(player, now)
+            self.schedule(now + self.random.uniform(*self.JUMP_AFTER), self.SEEK, player, player.generation, (max(intro.start - leadIn, offset), intro, False))
+
+    def track(self, player: FakePlayer, marker: FakeMarker, reaction: bool) -> None:
+        run = MarkerRun(player, marker, reaction)
+        self.current[player.index] = run
+        self.runs.append(run)
+
+    def jump(self, player: FakePlayer, marker: FakeMarker, when: float) -> None:
+        offset = marker.start + int((marker.end - marker.start) * self.random.uniform(0.2, 0.5))
+        self.schedule(when, self.SEEK, player, player.generation, (offset, marker, True))
+
+    def retime(self, player: FakePlayer, now: float) -> None:
+        # Anchor changed, report it straight away and move every pending playhead event to the new timeline
+        self.server.notify(player, now)
+        self.schedule(now + self.interval, self.ALERT, player, player.generation)
+        if player.state != PLAYINGKEY:
+            return
+        run = self.current.get(player.index)
+        if run and not run.done:
+            if not run.reaction and run.commandAt is None and player.offset < run.start:
+                run.crossed = player.at(run.start)
+            leave = player.at(run.end)
+            if leave is not None:
+                self.schedule(leave, self.LEAVE, player, player.generation)
+        end = player.at(player.episode.duration)
+        if end is not None:
+            self.schedule(end, self.END, player, player.generation)
+
+    def advance(self, player: FakePlayer, run: MarkerRun, now: float) -> None:
+        run.done = True
+        if run.kind == INTRO:
+            credits = player.episode.marker(CREDITS)
+            when = now + self.random.uniform(*self.DWELL)
+            if self.random.random() < self.jumps:
+                self.jump(player, credits, when)
+            else:
+                self.schedule(when, self.SEEK, player, player.generation, (max(credits.start - self.random.randint(*self.LEAD_IN), player.position(when)), credits, False))
+
+    def land(self, player: FakePlayer, now: float, sessionKey: int, offset: int, run: MarkerRun) -> None:
+        if player.sessionKey != sessionKey or player.state == STOPPEDKEY:
+            return
+        position = player.position(now)
+        if run and run.landedAt is None and run.target == offset:
+            run.landedAt = now
+            run.landed = position
+        player.anchor(min(offset, player.episode.duration), PLAYINGKEY, now)
+        self.retime(player, now)
+        if run and run is self.current.get(player.index) and not run.done and offset >= run.start:
+            self.advance(player, run, now)
+
+    def action(self, run: MarkerRun, command: str, now: float, position: int, lastAlert: float, target: int = None) -> bool:
+        if not run or run.commandAt is not None:
+            return False
+        run.command = command
+        run.commandAt = now
+        run.position = position
+        run.lastAlert = lastAlert
+        run.target = target
+        return True
+
+    def command(self, player: FakePlayer, command: str, params: dict, now: float) -> None:
+        # Runs on the HTTP thread holding the server lock, records the command and plays out its effect
+        record = player.receive(command, params, now)
+        run = self.current.get(player.index)
+        run = run if run and run.sessionKey == player.sessionKey else None
+        if command == SEEKCOMMAND:
+            offset = int(params.get("offset", 0))
+            if not (run and offset >= run.start and self.action(run, "seekTo", now, record.position, record.lastAlert, offset)):
+                self.strays += 1
+            self.schedule(now + player.latency, self.LAND, player, None, (player.sessionKey, offset, run))
+        elif command == VOLUMECOMMAND and "volume" in params:
+            volume = int(params["volume"])
+            if volume < player.volume:
+                if not self.action(run, "setVolume", now, record.position, record.lastAlert):
+                    self.strays += 1
+            elif run and run.commandAt is not None and run.restoredAt is None:
+                run.restoredAt = now
+            player.volume = volume
+        elif command == STOPCOMMAND:
+            if run and run.kind == CREDITS:
+                self.action(run, "stop", now, record.position, record.lastAlert)
+            if player.active:
+                player.anchor(player.position(now), STOPPEDKEY, now)
+                self.server.notify(player, now)
+                self.schedule(now + self.PLAY_TIMEOUT, self.START, player, player.generation)
+        elif command == PLAYCOMMAND:
+            playQueueID = int(urlsplit(params.get("containerKey", "")).path.rsplit("/", 1)[-1] or 0)
+            if run:
+                run.nextAt = now
+                run.done = True
+            self.schedule(now + player.latency, self.PLAY, player, None, (playQueueID, int(params.get("offset", 0))))
+
+    def results(self) -> dict:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        elapsed = (self.stopped or time.monotonic()) - self.started
+        with self.server.lock:
+            return {
+                "elapsed": elapsed,
+                "sessions": self.sessions,
+                "alerts": self.server.alerts,
+                "requests": self.server.requests,
+                "commands": self.players.commandCounts(),
+                "strays": self.strays,
+                "runs": [r.toJson() for r in self.runs],
+                "cpu": (usage.ru_utime - self._usage.ru_utime) + (usage.ru_stime - self._usage.ru_stime)
+            }
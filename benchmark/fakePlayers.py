@@ -0,0 +1,113 @@
+import time
+from random import Random
+from typing import Dict, List, NamedTuple
+
+
+PLAYINGKEY = "playing"
+PAUSEDKEY = "paused"
+STOPPEDKEY = "stopped"
+
+SEEKCOMMAND = "playback/seekTo"
+VOLUMECOMMAND = "playback/setParameters"
+STOPCOMMAND = "playback/stop"
+PLAYCOMMAND = "playback/playMedia"
+TIMELINECOMMAND = "timeline/poll"
+
+
+# Seek latency range in milliseconds per product, different products so per device/product estimates have something to learn
+PRODUCTS = {
+    "Plex for Android (TV)": (150, 450),
+    "Plex for Apple TV": (100, 300),
+    "Plex for iOS": (200, 600),
+    "Plex HTPC": (50, 150)
+}
+
+
+class CommandRecord(NamedTuple):
+    received: float
+    command: str
+    params: dict
+    sessionKey: int
+    ratingKey: int
+    position: int
+    lastAlert: float
+
+
+class FakePlayer():
+    # Companion player playing one item at a time, the playhead is an anchor (offset at a monotonic time) extrapolated
+    # while playing the same way a real client reports it
+    def __init__(self, index: int, random: Random) -> None:
+        self.index: int = index
+        self.machineIdentifier: str = "benchmark-player-%04d" % (index)
+        self.title: str = "Benchmark Player %d" % (index)
+        self.product: str = list(PRODUCTS)[index % len(PRODUCTS)]
+        low, high = PRODUCTS[self.product]
+        self.latency: float = random.uniform(low, high) / 1000
+
+        self.state: str = STOPPEDKEY
+        self.episode = None
+        self.sessionKey: int = 0
+        self.playQueueID: int = 0
+        self.offset: int = 0
+        self.anchored: float = 0.0
+        self.volume: int = 100
+        self.generation: int = 0
+        self.lastAlert: float = 0.0
+
+        self.commands: List[CommandRecord] = []
+
+    def __repr__(self) -> str:
+        return "<FakePlayer:%s:%s:%s>" % (self.machineIdentifier, self.product, self.state)
+
+    @property
+    def active(self) -> bool:
+        return self.episode is not None and self.state != STOPPEDKEY
+
+    def position(self, now: float = None) -> int:
+        if self.state != PLAYINGKEY or not self.episode:
+            return self.offset
+        now = time.monotonic() if now is None else now
+        return min(self.offset + int((now - self.anchored) * 1000), self.episode.duration)
+
+    def at(self, offset: int) -> float:
+        # Monotonic time the playhead reaches offset if it keeps playing, None when it won't
+        if self.state != PLAYINGKEY or offset < self.offset:
+            return None
+        return self.anchored + (offset - self.offset) / 1000
+
+    def anchor(self, offset: int, state: str, now: float) -> None:
+        self.offset = offset
+        self.state = state
+        self.anchored = now
+        self.generation += 1
+
+    def receive(self, command: str, params: dict, now: float) -> CommandRecord:
+        record = CommandRecord(now, command, params, self.sessionKey, self.episode.ratingKey if self.episode else None, self.position(now), self.lastAlert)
+        self.commands.append(record)
+        return record
+
+
+class FakePlayers():
+    def __init__(self, count: int, seed: int = 0) -> None:
+        random = Random(seed)
+        self.players: List[FakePlayer] = [FakePlayer(i, random) for i in range(count)]
+        self._byIdentifier: Dict[str, FakePlayer] = {p.machineIdentifier: p for p in self.players}
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+    def __iter__(self):
+        return iter(self.players)
+
+    def get(self, machineIdentifier: str) -> FakePlayer:
+        return self._byIdentifier.get(machineIdentifier)
+
+    def active(self) -> List[FakePlayer]:
+        return [p for p in self.players if p.active]
+
+    def commandCounts(self) -> Dict[str, int]:
+        counts = {}
+        for player in self.players:
+            for record in player.commands:
+                counts[record.command] = counts.get(record.command, 0) + 1
+        return counts
@@ -0,0 +1,441 @@
+import base64
+import hashlib
+import json
+import logging
+import struct
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Condition, Lock, RLock
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+from xml.sax.saxutils import quoteattr
+from requests.adapters import HTTPAdapter
+from benchmark.fakePlayers import FakePlayer, FakePlayers, TIMELINECOMMAND
+
+
+TOKEN = "benchmark-token"
+MACHINEIDENTIFIER = "benchmark-server"
+USERNAME = "benchmark"
+PLEXTV = "/plex.tv"
+NOTIFICATIONS = "/:/websockets/notifications"
+WSGUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+TARGETHEADER = "X-Plex-Target-Client-Identifier"
+SECTION = 1
+
+
+class FakeMarker(NamedTuple):
+    id: int
+    type: str
+    start: int
+    end: int
+
+
+class FakeEpisode():
+    __slots__ = ("ratingKey", "show", "index", "duration", "markers")
+
+    def __init__(self, ratingKey: int, show: "FakeShow", index: int, duration: int, markers: List[FakeMarker]) -> None:
+        self.ratingKey: int = ratingKey
+        self.show: FakeShow = show
+        self.index: int = index
+        self.duration: int = duration
+        self.markers: List[FakeMarker] = markers
+
+    def marker(self, kind: str) -> FakeMarker:
+        return next((m for m in self.markers if m.type == kind), None)
+
+
+class FakeShow():
+    __slots__ = ("ratingKey", "title", "episodes")
+
+    def __init__(self, ratingKey: int, title: str) -> None:
+        self.ratingKey: int = ratingKey
+        self.title: str = title
+        self.episodes: List[FakeEpisode] = []
+
+    @property
+    def seasonKey(self) -> int:
+        return self.ratingKey + 1
+
+
+class FakeLibrary():
+    # Generated single season shows, every episode has an intro and a credits marker that runs to the end
+    SHOW_KEYS = 1000
+    EPISODE_KEYS = 100000
+
+    def __init__(self, shows: int = 20, episodes: int = 10, seed: int = 0) -> None:
+        random = Random(seed)
+        self.shows: List[FakeShow] = []
+        self._items: Dict[int, object] = {}
+        ratingKey = self.EPISODE_KEYS
+        for s in range(shows):
+            show = FakeShow(self.SHOW_KEYS + s * 10, "Benchmark Show %d" % (s + 1))
+            for e in range(episodes):
+                duration = random.randint(20, 45) * 60000
+                introStart = random.randint(20, 120) * 1000
+                creditsStart = duration - random.randint(30, 120) * 1000
+                markers = [
+                    FakeMarker(ratingKey * 10, "intro", introStart, introStart + random.randint(30, 90) * 1000),
+                    FakeMarker(ratingKey * 10 + 1, "credits", creditsStart, duration)
+                ]
+                # Episode 1 is left out so first episode handling doesn't change what gets skipped
+                episode = FakeEpisode(ratingKey, show, e + 2, duration, markers)
+                show.episodes.append(episode)
+                self._items[ratingKey] = episode
+                ratingKey += 1
+            self.shows.append(show)
+            self._items[show.ratingKey] = show
+
+    def get(self, ratingKey: int):
+        return self._items.get(ratingKey)
+
+    def next(self, episode: FakeEpisode) -> FakeEpisode:
+        episodes = episode.show.episodes
+        return episodes[(episodes.index(episode) + 1) % len(episodes)]
+
+
+def attrs(**kwargs) -> str:
+    return " ".join("%s=%s" % (k, quoteattr(str(v))) for k, v in kwargs.items() if v is not None)
+
+
+def episodeXml(episode: FakeEpisode, children: str = "", **extra) -> str:
+    show = episode.show
+    markers = "".join("<Marker %s><Attributes id=\"%d\" version=\"5\" /></Marker>" % (attrs(id=m.id, type=m.type, startTimeOffset=m.start, endTimeOffset=m.end, final=1 if m.end >= episode.duration else None), m.id) for m in episode.markers)
+    return "<Video %s>%s%s</Video>" % (attrs(
+        ratingKey=episode.ratingKey, key="/library/metadata/%d" % (episode.ratingKey), guid="plex://episode/%d" % (episode.ratingKey),
+        parentRatingKey=show.seasonKey, grandparentRatingKey=show.ratingKey, parentKey="/library/metadata/%d" % (show.seasonKey),
+        grandparentKey="/library/metadata/%d" % (show.ratingKey), type="episode", title="Episode %d" % (episode.index),
+        grandparentTitle=show.title, parentTitle="Season 1", index=episode.index, parentIndex=1, duration=episode.duration,
+        viewCount=1, librarySectionID=SECTION, librarySectionTitle="TV Shows", librarySectionKey="/library/sections/%d" % (SECTION),
+        addedAt=1600000000, updatedAt=1600000000, **extra), markers, children)
+
+
+def showXml(show: FakeShow) -> str:
+    return "<Directory %s />" % (attrs(
+        ratingKey=show.ratingKey, key="/library/metadata/%d/children" % (show.ratingKey), guid="plex://show/%d" % (show.ratingKey),
+        type="show", title=show.title, index=1, leafCount=len(show.episodes), childCount=1, viewedLeafCount=len(show.episodes),
+        librarySectionID=SECTION, librarySectionTitle="TV Shows", addedAt=1600000000, updatedAt=1600000000))
+
+
+def container(items: List[str] = None, **extra) -> str:
+    items = items or []
+    return "<?xml version=\"1.0\" encoding=\"UTF-8\"?><MediaContainer %s>%s</MediaContainer>" % (attrs(size=len(items), **extra), "".join(items))
+
+
+class PlayQueues():
+    def __init__(self) -> None:
+        self._queues: Dict[int, Tuple[List[int], int]] = {}
+        self._nextID: int = 1
+        self._lock: Lock = Lock()
+
+    def create(self, ratingKeys: List[int], selected: int) -> int:
+        with self._lock:
+            playQueueID = self._nextID
+            self._nextID += 1
+            self._queues[playQueueID] = (ratingKeys, ratingKeys.index(selected) if selected in ratingKeys else 0)
+        return playQueueID
+
+    def get(self, playQueueID: int) -> Tuple[List[int], int]:
+        return self._queues.get(playQueueID)
+
+    def selected(self, playQueueID: int) -> int:
+        queue = self._queues.get(playQueueID)
+        return queue[0][queue[1]] if queue else None
+
+
+class WebSocket():
+    # Server side of RFC 6455, unmasked text frames out, pings answered, enough for one notification stream
+    def __init__(self, handler: BaseHTTPRequestHandler) -> None:
+        self.handler: BaseHTTPRequestHandler = handler
+        self._lock: Lock = Lock()
+        self.sent: int = 0
+
+    @staticmethod
+    def frame(payload: bytes, opcode: int = 0x1) -> bytes:
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        return header + payload
+
+    def send(self, frame: bytes) -> None:
+        with self._lock:
+            self.handler.connection.sendall(frame)
+            self.sent += 1
+
+    def _read(self, size: int) -> bytes:
+        data = self.handler.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError("WebSocket closed")
+        return data
+
+    def receive(self) -> None:
+        while True:
+            first, second = self._read(2)
+            opcode = first & 0x0f
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack("!H", self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self._read(8))[0]
+            mask = self._read(4) if second & 0x80 else None
+            payload = self._read(length) if length else b""
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            if opcode == 0x8:
+                self.send(self.frame(payload[:2], 0x8))
+                return
+            elif opcode == 0x9:
+                self.send(self.frame(payload, 0xA))
+
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.route("GET")
+
+    def do_POST(self) -> None:
+        self.route("POST")
+
+    def do_PUT(self) -> None:
+        self.route("PUT")
+
+    def route(self, method: str) -> None:
+        server: FakePlexServer = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/") or "/"
+        params = dict(parse_qsl(url.query))
+        server.requests += 1
+        try:
+            if path == NOTIFICATIONS and self.headers.get("Upgrade", "").lower() == "websocket":
+                self.websocket()
+                return
+            if path.startswith("/player/"):
+                body = server.command(self.headers.get(TARGETHEADER), path[len("/player/"):], params)
+            else:
+                body = server.respond(method, path, params)
+        except:
+            server.log.exception("Error handling %s %s" % (method, self.path))
+            self.reply(500, "")
+            return
+        if body is None:
+            self.reply(404, "")
+        else:
+            self.reply(200, body)
+
+    def reply(self, status: int, body: str) -> None:
+        content = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml;charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def websocket(self) -> None:
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WSGUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        socket = WebSocket(self)
+        self.server.addListener(socket)
+        try:
+            socket.receive()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.server.removeListener(socket)
+            self.close_connection = True
+
+
+class FakePlexServer(ThreadingHTTPServer):
+    # Stand-in for Plex Media Server, the plex.tv endpoints PlexAPI calls and the companion players on one local port.
+    # Player commands arrive either directly or proxied, both carry the target header so they land on the same player
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, library: FakeLibrary, players: FakePlayers, address: str = "127.0.0.1", port: int = 0, proxy: bool = False, logger: logging.Logger = None) -> None:
+        super(FakePlexServer, self).__init__((address, port), FakePlexHandler)
+        self.log = logger or logging.getLogger(__name__)
+        self.library: FakeLibrary = library
+        self.players: FakePlayers = players
+        self.queues: PlayQueues = PlayQueues()
+        self.proxy: bool = proxy
+        self.lock: RLock = RLock()
+        self.onCommand: Callable = None
+        self.requests: int = 0
+        self.alerts: int = 0
+
+        self._listeners: List[WebSocket] = []
+        self._listening: Condition = Condition()
+
+    @property
+    def address(self) -> str:
+        return self.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def baseurl(self) -> str:
+        return "http://%s:%d" % (self.address, self.port)
+
+    def addListener(self, socket: WebSocket) -> None:
+        with self._listening:
+            self._listeners.append(socket)
+            self._listening.notify_all()
+
+    def removeListener(self, socket: WebSocket) -> None:
+        with self._listening:
+            if socket in self._listeners:
+                self._listeners.remove(socket)
+
+    def waitForListener(self, timeout: float) -> bool:
+        with self._listening:
+            return self._listening.wait_for(lambda: self._listeners, timeout)
+
+    def broadcast(self, notification: dict) -> None:
+        frame = WebSocket.frame(json.dumps({"NotificationContainer": notification}).encode('utf-8'))
+        for socket in list(self._listeners):
+            try:
+                socket.send(frame)
+            except OSError:
+                self.removeListener(socket)
+        self.alerts += 1
+
+    def command(self, target: str, command: str, params: dict) -> str:
+        player = self.players.get(target)
+        if not player:
+            return None
+        with self.lock:
+            if command == TIMELINECOMMAND:
+                return container([self.timelineXml(player)], commandID=params.get("commandID"))
+            if self.onCommand:
+                self.onCommand(player, command, params, time.monotonic())
+        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?><Response code=\"200\" status=\"OK\" />"
+
+    def respond(self, method: str, path: str, params: dict) -> str:
+        if path.startswith(PLEXTV):
+            return self.plexTv(path[len(PLEXTV):])
+        if path == "/" or path == "/identity":
+            return container(friendlyName="PlexAutoSkip Benchmark", machineIdentifier=MACHINEIDENTIFIER, version="1.40.0.0",
+                             myPlex=1, myPlexUsername=USERNAME, myPlexSigninState="ok", platform="Linux", multiuser=1)
+        if path == "/status/sessions":
+            return self.sessionsXml()
+        if path == "/clients":
+            return container(["<Server %s />" % (attrs(name=p.title, host=self.address, address=self.address,
+                                                          port=self.port, machineIdentifier=p.machineIdentifier, product=p.product, version="1.0.0", protocol="plex",
+                                                          protocolCapabilities="timeline,mirror,navigation" if self.proxy else "timeline,playback,navigation,playqueues"))
+                              for p in self.players])
+        if path == "/security/token":
+            return container(token="%s-delegation" % (TOKEN))
+        if path.startswith("/library/metadata/"):
+            return self.metadata(path[len("/library/metadata/"):])
+        if path.startswith("/playQueues"):
+            return self.playQueue(method, path, params)
+        return None
+
+    def plexTv(self, path: str) -> str:
+        if path == "/api/v2/user":
+            return "<?xml version=\"1.0\" encoding=\"UTF-8\"?><user %s><subscription active=\"1\" status=\"Active\" plan=\"lifetime\" /><profile autoSelectAudio=\"1\" /></user>" % (
+                attrs(id=1, uuid=USERNAME, username=USERNAME, title=USERNAME, email="%s@localhost" % (USERNAME), authToken=TOKEN, scrobbleTypes="1,4"))
+        if path == "/devices.xml":
+            return container(["<Device %s><Connection uri=\"%s\" /></Device>" % (attrs(name=p.title, clientIdentifier=p.machineIdentifier, product=p.product, provides="player"), self.baseurl)
+                              for p in self.players])
+        return None
+
+    def metadata(self, path: str) -> str:
+        parts = path.split("/")
+        try:
+            item = self.library.get(int(parts[0]))
+        except ValueError:
+            return None
+        if isinstance(item, FakeEpisode) and len(parts) == 1:
+            return container([episodeXml(item)], librarySectionID=SECTION, identifier="com.plexapp.plugins.library")
+        if isinstance(item, FakeShow) and len(parts) == 1:
+            return container([showXml(item)], librarySectionID=SECTION, identifier="com.plexapp.plugins.library")
+        if isinstance(item, FakeShow) and parts[1] == "allLeaves":
+            return container([episodeXml(e) for e in item.episodes], totalSize=len(item.episodes), librarySectionID=SECTION)
+        return None
+
+    def playQueue(self, method: str, path: str, params: dict) -> str:
+        if method == "POST" and path == "/playQueues":
+            # uri is library:///directory//library/metadata/1,2,3 and key the item to start with
+            ratingKeys = [int(x) for x in unquote(params.get("uri", "")).rsplit("/", 1)[-1].split(",") if x.isdigit()]
+            if not ratingKeys:
+                return None
+            selected = int(params["key"].rsplit("/", 1)[-1]) if params.get("key") else ratingKeys[0]
+            playQueueID = self.queues.create(ratingKeys, selected)
+        else:
+            try:
+                playQueueID = int(path.split("/")[2])
+            except (IndexError, ValueError):
+                return None
+        return self.playQueueXml(playQueueID)
+
+    def playQueueXml(self, playQueueID: int) -> str:
+        queue = self.queues.get(playQueueID)
+        if not queue:
+            return None
+        ratingKeys, selected = queue
+        items = [episodeXml(self.library.get(k), playQueueItemID=playQueueID * 1000 + i) for i, k in enumerate(ratingKeys)]
+        return container(items, identifier="com.plexapp.plugins.library", playQueueID=playQueueID, playQueueSelectedItemID=playQueueID * 1000 + selected,
+                         playQueueSelectedItemOffset=selected, playQueueSelectedMetadataItemID=ratingKeys[selected], playQueueTotalCount=len(ratingKeys),
+                         playQueueVersion=1, playQueueShuffled=0)
+
+    def sessionsXml(self) -> str:
+        items = []
+        with self.lock:
+            for player in self.players.active():
+                children = "<User %s /><Player %s /><Session %s />" % (
+                    attrs(id=1, title=USERNAME),
+                    attrs(address=self.address, machineIdentifier=player.machineIdentifier, product=player.product, title=player.title,
+                          platform="Benchmark", state=player.state, local=1, version="1.0.0"),
+                    attrs(id="session-%d" % (player.sessionKey), bandwidth=10000, location="lan"))
+                items.append(episodeXml(player.episode, children, sessionKey=player.sessionKey, viewOffset=player.position()))
+        return container(items)
+
+    def timelineXml(self, player: FakePlayer) -> str:
+        return "<Timeline %s />" % (attrs(type="video", state=player.state, volume=player.volume, time=player.position(),
+                                          duration=player.episode.duration if player.episode else None,
+                                          ratingKey=player.episode.ratingKey if player.episode else None))
+
+    def notify(self, player: FakePlayer, now: float) -> None:
+        # Same shape as the PlaySessionStateNotification Plex sends for every timeline update
+        player.lastAlert = now
+        self.broadcast({"type": "playing", "size": 1, "PlaySessionStateNotification": [{
+            "sessionKey": str(player.sessionKey),
+            "clientIdentifier": player.machineIdentifier,
+            "guid": "",
+            "ratingKey": str(player.episode.ratingKey),
+            "url": "",
+            "key": "/library/metadata/%d" % (player.episode.ratingKey),
+            "viewOffset": player.position(now),
+            "playQueueID": player.playQueueID,
+            "playQueueItemID": player.playQueueID * 1000,
+            "state": player.state
+        }]})
+
+
+class PlexTvAdapter(HTTPAdapter):
+    # PlexAPI calls plex.tv for the account and device ports, mounted on the PlexServer session these go to the fake server
+    def __init__(self, baseurl: str) -> None:
+        super(PlexTvAdapter, self).__init__()
+        self.baseurl: str = baseurl
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace("https://plex.tv", self.baseurl + PLEXTV, 1)
+        return super(PlexTvAdapter, self).send(request, **kwargs)
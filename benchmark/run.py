@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from threading import Thread
+from typing import List
+from benchmark.driver import Driver, CREDITS
+from benchmark.fakePlayers import FakePlayers
+from benchmark.fakeServer import FakeLibrary, FakePlexServer, PlexTvAdapter, TOKEN
+from resources.settings import Settings
+from resources.server import getPlexServer
+from resources.skipper import Skipper
+from resources.asyncSkipper import AsyncSkipper
+
+###########################################################################################################################
+# End to end load benchmark, everything runs locally and offline
+#   python -m benchmark.run -s 100 -d 60
+# The fake Plex server, companion players and driver run in a child process so CPU and memory below are the skipper's
+###########################################################################################################################
+
+LISTENER_TIMEOUT = 30
+
+
+def serve(options: dict, conn: Connection) -> None:
+    log = logging.getLogger("benchmark.server")
+    library = FakeLibrary(options['shows'], options['episodes'], options['seed'])
+    players = FakePlayers(options['sessions'], options['seed'])
+    server = FakePlexServer(library, players, proxy=options['proxy'], logger=log)
+    driver = Driver(server, options['interval'], options['jumps'], options['ramp'], options['seed'], logger=log)
+    Thread(target=server.serve_forever, name="FakePlexServer", daemon=True).start()
+    conn.send(server.port)
+
+    conn.recv()
+    if not server.waitForListener(LISTENER_TIMEOUT):
+        conn.send(False)
+        return
+    driver.start()
+    conn.send(True)
+
+    conn.recv()
+    driver.stop()
+    conn.send(driver.results())
+    # Keep serving until the parent exits and terminates this process so the skipper doesn't see the server go away
+    conn.recv()
+
+
+def writeConfig(directory: str, port: int, options: dict) -> str:
+    config = ConfigParser()
+    config["Plex.tv"] = {"token": TOKEN}
+    config["Server"] = {"address": "127.0.0.1", "ssl": "False", "port": str(port)}
+    config["Skip"] = {"mode": options['mode'], "tags": "intro, credits", "next": str(options['next'])}
+    config["Offsets"] = {"start": "0", "end": "0"}
+    config["Performance"] = {
+        "engine": options['engine'],
+        "watch-config": "False",
+        "prefetch": str(not options['no_prefetch']),
+        "latency-compensation": str(not options['no_latency'])
+    }
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def rss() -> float:
+    # Current resident set in MB, Linux only like the rest of the measurements
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentiles(values: List[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+
+    def pick(p: float) -> float:
+        return round(values[min(int(p * len(values)), len(values) - 1)], 1)
+
+    return {"count": len(values), "min": round(values[0], 1), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 1), "mean": round(sum(values) / len(values), 1)}
+
+
+def summarize(results: dict, skipper: Skipper, usage: dict, options: dict) -> dict:
+    runs = [r for r in results['runs'] if r['commandAt'] is not None or r['missed']]
+    natural = [r for r in runs if not r['reaction']]
+    elapsed = results['elapsed']
+    commands = sum(results['commands'].values())
+    alerts = sum(skipper.metrics.counters("alerts").values())
+    caches = {"sessions": skipper.sessions, "players": skipper.players, "shows": skipper.shows, "prefetch": skipper.prefetcher}
+    return {
+        "options": options,
+        "elapsed": round(elapsed, 1),
+        "throughput": {
+            "sessions": results['sessions'],
+            "alertsSent": results['alerts'],
+            "alertsProcessed": alerts,
+            "alertsPerSecond": round(results['alerts'] / elapsed, 1),
+            "commands": results['commands'],
+            "commandsPerSecond": round(commands / elapsed, 1),
+            "serverRequests": results['requests']
+        },
+        # Reaction: user seeks into the middle of a marker, from the alert reporting it to the skipper's command
+        "alertToCommand": percentiles([(r['commandAt'] - r['alerted']) * 1000 for r in runs if r['reaction'] and r['commandAt'] and r['alerted']]),
+        # Playing into a marker, command arrival against the moment the playhead reached its start, negative is early
+        "boundaryLag": percentiles([(r['commandAt'] - r['crossed']) * 1000 for r in natural if r['commandAt'] and r['crossed']]),
+        # How much of the marker was shown before the seek took effect on the player, negative cut content before it
+        "markerShown": percentiles([r['landed'] - r['start'] for r in natural if r['landed'] is not None]),
+        "targetError": percentiles([r['target'] - r['end'] for r in runs if r['target'] is not None]),
+        "volumeRestore": percentiles([(r['restoredAt'] - r['crossed']) * 1000 - (r['end'] - r['start']) for r in natural if r['restoredAt'] and r['crossed']]),
+        "skipNext": percentiles([(r['nextAt'] - r['crossed']) * 1000 for r in natural if r['kind'] == CREDITS and r['nextAt'] and r['crossed']]),
+        "markers": {
+            "handled": len([r for r in runs if r['commandAt'] is not None]),
+            "missed": len([r for r in runs if r['missed']]),
+            "cutEarly": len([r for r in natural if r['landed'] is not None and r['landed'] < r['start']]),
+            "pending": len(results['runs']) - len(runs),
+            "strayCommands": results['strays']
+        },
+        "skipper": {
+            "cpu": round(usage['cpu'], 2),
+            "cpuPercent": round(usage['cpu'] / elapsed * 100, 1),
+            "rss": round(usage['rss'], 1),
+            "rssGrowth": round(usage['rss'] - usage['baseline'], 1),
+            "peakRss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "schedulerLag": skipper.scheduler.lag.toJson(),
+            "dispatcher": skipper.dispatcher.stats(),
+            "cacheHitRates": {k: round(v.hits / (v.hits + v.misses), 3) if v.hits + v.misses else 0.0 for k, v in caches.items() if v is not None},
+            "calls": {"%s:%s" % k: v.toJson() for k, v in sorted(skipper.metrics.histograms().items())}
+        },
+        "fakeServer": {
+            "cpu": round(results['cpu'], 2),
+            "cpuPercent": round(results['cpu'] / elapsed * 100, 1)
+        }
+    }
+
+
+def printReport(report: dict) -> None:
+    options = report['options']
+    throughput = report['throughput']
+    markers = report['markers']
+    skipper = report['skipper']
+
+    def line(title: str, stats: dict) -> None:
+        if stats['count']:
+            print("  %-44s n=%-6d p50 %8.1f  p95 %8.1f  p99 %8.1f  max %8.1f" % (title, stats['count'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+
+    print("PlexAutoSkip benchmark: %d sessions, %s engine, %s mode%s, %.0fs, alerts every %.1fs" % (options['sessions'], options['engine'], options['mode'], " with skip-next" if options['next'] else "", report['elapsed'], options['interval']))
+    print("Throughput")
+    print("  %d sessions started, %d alerts sent (%.1f/s), %d processed, %d player commands (%.1f/s), %d server requests" % (throughput['sessions'], throughput['alertsSent'], throughput['alertsPerSecond'], throughput['alertsProcessed'], sum(throughput['commands'].values()), throughput['commandsPerSecond'], throughput['serverRequests']))
+    print("Latency and accuracy (ms)")
+    line("Alert to command (seek into marker)", report['alertToCommand'])
+    line("Boundary lag (negative is early)", report['boundaryLag'])
+    line("Marker shown before seek landed", report['markerShown'])
+    line("Seek target error", report['targetError'])
+    line("Volume restore lag", report['volumeRestore'])
+    line("Credits to next item", report['skipNext'])
+    print("Markers")
+    print("  %d handled, %d missed, %d cut early, %d pending at the end, %d stray commands" % (markers['handled'], markers['missed'], markers['cutEarly'], markers['pending'], markers['strayCommands']))
+    print("Resources")
+    print("  Skipper CPU %.2fs (%.1f%% of one core), RSS %.1fMB (%+.1fMB during the run, peak %.1fMB)" % (skipper['cpu'], skipper['cpuPercent'], skipper['rss'], skipper['rssGrowth'], skipper['peakRss']))
+    print("  Scheduler lag p50 %.1fms p99 %.1fms, dispatcher waited %.1fms on average (max %.1fms)" % (skipper['schedulerLag']['p50'], skipper['schedulerLag']['p99'], skipper['dispatcher']['waitAverage'] * 1000, skipper['dispatcher']['waitMax'] * 1000))
+    print("  Cache hit rates %s" % (", ".join("%s %.0f%%" % (k, v * 100) for k, v in skipper['cacheHitRates'].items())))
+    print("  Fake server CPU %.2fs (%.1f%% of one core)%s" % (report['fakeServer']['cpu'], report['fakeServer']['cpuPercent'], ", close to saturated so results understate the skipper" if report['fakeServer']['cpuPercent'] > 80 else ""))
+
+
+def getBenchmarkLogger(level: str) -> logging.Logger:
+    # Kept off pas.log and the console config so log I/O doesn't dominate what is being measured
+    log = logging.getLogger("benchmark")
+    log.setLevel(level.upper())
+    log.propagate = False
+    if not log.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+        log.addHandler(handler)
+    return log
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Plex Autoskip end to end benchmark against a local fake Plex server and players")
+    parser.add_argument('-s', '--sessions', help="Concurrent sessions, one fake player each", type=int, default=100)
+    parser.add_argument('-d', '--duration', help="Seconds to run after the websocket connects", type=float, default=60)
+    parser.add_argument('-e', '--engine', help="Skipper engine", choices=Settings.ENGINES, default="threaded")
+    parser.add_argument('-m', '--mode', help="Skip or lower the volume for markers", choices=["skip", "volume"], default="skip")
+    parser.add_argument('-n', '--next', help="Enable skip-next so credits start the next PlayQueue item", action='store_true')
+    parser.add_argument('-i', '--interval', help="Seconds between playing alerts for each session", type=float, default=1.0)
+    parser.add_argument('-j', '--jumps', help="Fraction of markers entered by a user seek into the middle of them", type=float, default=0.25)
+    parser.add_argument('-r', '--ramp', help="Seconds over which sessions start", type=float, default=10.0)
+    parser.add_argument('-p', '--proxy', help="Send player commands through the server instead of directly", action='store_true')
+    parser.add_argument('-nl', '--no_latency', help="Disable latency compensation", action='store_true')
+    parser.add_argument('-np', '--no_prefetch', help="Disable next item prefetching", action='store_true')
+    parser.add_argument('--shows', help="Shows in the fake library", type=int, default=20)
+    parser.add_argument('--episodes', help="Episodes per show", type=int, default=10)
+    parser.add_argument('--seed', help="Random seed for the library and timelines", type=int, default=0)
+    parser.add_argument('-o', '--output', help="Write the full report as JSON to compare runs")
+    parser.add_argument('-l', '--log_level', help="Skipper log level", default="WARNING")
+
+    args = vars(parser.parse_args())
+    log = getBenchmarkLogger(args['log_level'])
+
+    if args['engine'] == "asyncio" and not AsyncSkipper.available():
+        log.error("The asyncio engine requires the aiohttp python package")
+        sys.exit(1)
+
+    parent, child = Pipe()
+    process = Process(target=serve, args=(args, child), name="FakePlexServer", daemon=True)
+    process.start()
+    port = parent.recv()
+
+    os.environ.pop(Settings.ENV_CONFIG_VAR, None)
+    with tempfile.TemporaryDirectory(prefix="pas-benchmark-") as directory:
+        settings = Settings(writeConfig(directory, port, args), logger=log)
+        plex, sslopt = getPlexServer(settings, log)
+        if not plex:
+            log.error("Unable to connect to the fake Plex server on port %d" % (port))
+            sys.exit(1)
+        plex._session.mount("https://plex.tv", PlexTvAdapter(plex._baseurl))
+        skipper = AsyncSkipper(plex, settings, log) if args['engine'] == "asyncio" else Skipper(plex, settings, log)
+
+        baseline = rss()
+        started = cpu()
+        Thread(target=skipper.start, kwargs={"sslopt": sslopt}, name="Skipper", daemon=True).start()
+        parent.send("start")
+        if not parent.recv():
+            log.error("Skipper did not connect to the notification websocket within %d seconds" % (LISTENER_TIMEOUT))
+            sys.exit(1)
+        print("Running %d sessions for %.0f seconds..." % (args['sessions'], args['duration']))
+        time.sleep(args['duration'])
+        parent.send("stop")
+        results = parent.recv()
+        usage = {"cpu": cpu() - started, "rss": rss(), "baseline": baseline}
+
+        report = summarize(results, skipper, usage, args)
+        printReport(report)
+        if args['output']:
+            with open(args['output'], "w") as f:
+                json.dump(dict(report, runs=results['runs']), f, indent=4)
+            print("Full report written to %s" % (args['output']))
+
+    # The fake server is terminated on exit, the skipper noticing that is not part of the run
+    log.disabled = True
@@ -1,15 +1,19 @@
 import sys
 import os
 import json
+import hashlib
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from resources.customEntries import CustomEntries
+from resources.guidIndex import GuidIndex
+from resources.markerExport import MarkerExporter
 from resources.settings import Settings
 from resources.mediaWrapper import STARTKEY, ENDKEY, TYPEKEY
 from resources.log import getLogger
 from plexapi.server import PlexServer
 from plexapi.video import Show, Season, Episode, Movie
 from resources.server import getPlexServer
-from typing import TypeVar
+from typing import List, Tuple, TypeVar
 
 ComplexMedia = TypeVar("ComplexMedia", Show, Season, Episode, Movie)
 
@@ -24,13 +28,21 @@ parser.add_argument('-eo', '--endoffset', type=int, help="Specify an offset by w
 parser.add_argument('-d', '--duration', type=int, help="Validate marker duration in milliseconds")
 parser.add_argument('-dg', '--dump_guids', type=str, help="Dump existing markers using GUIDs. Specify source as ratingKey or GUID")
 parser.add_argument('-drk', '--dump_ratingkeys', type=str, help="Dump existing markers using ratingKeys. Specify source as ratingKey or GUID")
+parser.add_argument('-eg', '--export_guids', type=str, help="Export markers for an entire library section using GUIDs, streamed to the path (.json or .jsonl). Specify section title, key or all")
+parser.add_argument('-erk', '--export_ratingkeys', type=str, help="Export markers for an entire library section using ratingKeys, streamed to the path (.json or .jsonl). Specify section title, key or all")
+parser.add_argument('-b', '--batch', action='store_true', help="Process a directory of custom JSON files in parallel, skipping files unchanged since the last run")
+parser.add_argument('-j', '--jobs', type=int, help="Number of worker processes for batch mode, defaults to the CPU count")
 args = vars(parser.parse_args())
 
 path = args["path"] or os.path.join(os.path.dirname(sys.argv[0]), Settings.CONFIG_DIRECTORY)
 
 log = getLogger(__name__)
 
-NEEDS_SERVER = ['write_guids', 'write_ratingkeys', 'dump_guids', 'dump_ratingkeys']
+NEEDS_SERVER = ['write_guids', 'write_ratingkeys', 'dump_guids', 'dump_ratingkeys', 'export_guids', 'export_ratingkeys']
+NOT_IDEMPOTENT = ['offset', 'startoffset', 'endoffset']
+CACHE_FILE = ".custom_audit_cache"
+
+guidIndex: GuidIndex = None
 
 
 def processData(data, server: PlexServer = None, ratingKeyLookup: dict = None, guidLookup: dict = None) -> dict:
@@ -82,10 +94,98 @@ def processFile(path, server: PlexServer = None, ratingKeyLookup: dict = None, g
         Settings.writeCustom(data, path, log)
 
 
-def analyzeMarkers(markers: dict) -> None:
+def analyzeMarkers(markers: dict) -> Tuple[int, int]:
     total = len(markers)
     populated = len([x for x in markers.values() if x])
-    log.info("%d total entries, %d populated, %d empty (%.0f%%)" % (total, populated, total - populated, (populated / total) * 100))
+    log.info("%d total entries, %d populated, %d empty (%.0f%%)" % (total, populated, total - populated, (populated / total) * 100 if total else 0))
+    return total, populated
+
+
+def contentHash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def batchSignature() -> str:
+    # Offsets shift markers again on every run so only repeatable operations can skip unchanged files
+    if any(args[x] for x in NOT_IDEMPOTENT):
+        return None
+    return json.dumps({k: args[k] for k in ['write_guids', 'write_ratingkeys', 'duration']}, sort_keys=True)
+
+
+def batchFiles(root: str) -> List[str]:
+    _, ext = os.path.splitext(Settings.CUSTOM_DEFAULT)
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(root) for f in files if os.path.splitext(f)[1] == ext)
+
+
+def initWorker(workerArgs: dict, indexPath: str) -> None:
+    global args, guidIndex
+    args = workerArgs
+    guidIndex = GuidIndex(None, indexPath, readOnly=True, logger=log) if indexPath else None
+
+
+def processBatchFile(path: str) -> dict:
+    result = {"path": path, "changed": False, "total": 0, "populated": 0, "hash": None, "error": None}
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        data = processData(json.loads(content), None, guidIndex, guidIndex)
+        markers = data.get("markers", {})
+        result["total"] = len(markers)
+        result["populated"] = len([x for x in markers.values() if x])
+        output = json.dumps(data, indent=4).encode('utf-8')
+        if output != content:
+            Settings.writeAtomic(output, path)
+            result["changed"] = True
+        result["hash"] = contentHash(output)
+    except Exception as e:
+        result["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return result
+
+
+def processBatch(root: str, indexPath: str = None) -> None:
+    cachePath = os.path.join(root, CACHE_FILE)
+    try:
+        with open(cachePath, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    signature = batchSignature()
+
+    files = batchFiles(root)
+    pending = []
+    skipped = 0
+    for fullpath in files:
+        entry = cache.get(os.path.relpath(fullpath, root))
+        if signature and entry and entry.get("signature") == signature:
+            with open(fullpath, 'rb') as f:
+                if contentHash(f.read()) == entry.get("hash"):
+                    skipped += 1
+                    continue
+        pending.append(fullpath)
+
+    jobs = args['jobs'] or os.cpu_count() or 1
+    log.info("Batch processing %d of %d files in %s with %d workers, %d unchanged since the last run" % (len(pending), len(files), root, jobs, skipped))
+    results = []
+    if pending:
+        with ProcessPoolExecutor(jobs, initializer=initWorker, initargs=(args, indexPath)) as executor:
+            results = list(executor.map(processBatchFile, pending, chunksize=max(1, len(pending) // (jobs * 4))))
+
+    for result in results:
+        relative = os.path.relpath(result["path"], root)
+        if result["error"]:
+            log.error("Error processing %s, %s" % (result["path"], result["error"]))
+        if signature and not result["error"]:
+            cache[relative] = {"signature": signature, "hash": result["hash"]}
+        else:
+            cache.pop(relative, None)
+    cache = {k: v for k, v in cache.items() if os.path.exists(os.path.join(root, k))}
+    Settings.writeAtomic(json.dumps(cache, indent=4).encode('utf-8'), cachePath)
+
+    processed = [x for x in results if not x["error"]]
+    total = sum(x["total"] for x in processed)
+    populated = sum(x["populated"] for x in processed)
+    log.info("Batch complete, %d processed, %d changed, %d skipped, %d failed" % (len(processed), len([x for x in processed if x["changed"]]), skipped, len(results) - len(processed)))
+    log.info("%d total entries, %d populated, %d empty (%.0f%%)" % (total, populated, total - populated, (populated / total) * 100 if total else 0))
 
 
 def dumpMarkers(media: ComplexMedia, settings: Settings, useGuid: bool = False) -> dict:
@@ -95,8 +195,9 @@ def dumpMarkers(media: ComplexMedia, settings: Settings, useGuid: bool = False)
     else:
         content.append(media)
     data = dict(Settings.CUSTOM_DEFAULTS)
+    showGuids = {}
     for c in content:
-        key = CustomEntries.keyToGuid(c) if useGuid else c.ratingKey
+        key = CustomEntries.keyToGuid(c, showGuids=showGuids) if useGuid else c.ratingKey
         data['markers'][key] = []
         if hasattr(c, 'markers'):
             for m in c.markers:
@@ -140,6 +241,19 @@ if __name__ == '__main__':
             settings = Settings(loadCustom=False, logger=log)
         server, _ = getPlexServer(settings, log)
 
+        section = args['export_guids'] or args['export_ratingkeys']
+        if section:
+            if os.path.isdir(path):
+                log.error("Export requires a file path ending in .json or .jsonl, %s is a directory" % (path))
+                sys.exit(1)
+            useGuid = args['export_guids'] is not None
+            index = None
+            if useGuid and settings.guidindex:
+                index = GuidIndex(server, settings.configDir, logger=log)
+                index.refresh()
+            MarkerExporter(server, settings.tags, index, useGuid, logger=log).export(path, section)
+            sys.exit(0)
+
         identifier = args['dump_guids'] or args['dump_ratingkeys']
         if identifier:
             useGuid = args['dump_guids'] is not None
@@ -160,12 +274,22 @@ if __name__ == '__main__':
                     processData(output, server, ratingKeyLookup, guidLookup)
             sys.exit(0)
 
-        if args['write_guids']:
+        if (args['write_guids'] or args['write_ratingkeys']) and settings.guidindex:
+            # Shared with the main script, only library changes since the last run are pulled
+            index = GuidIndex(server, settings.configDir, logger=log)
+            index.refresh()
+            ratingKeyLookup = guidLookup = index
+        elif args['write_guids']:
             ratingKeyLookup = CustomEntries.loadRatingKeys(server, log)
         elif args['write_ratingkeys']:
             guidLookup = CustomEntries.loadGuids(server, log)
 
-    if os.path.isdir(path):
+    if args['batch'] and os.path.isdir(path) and (isinstance(guidLookup, GuidIndex) or not (ratingKeyLookup or guidLookup)):
+        # Workers open their own connection to the refreshed GUID index, in memory lookups can't be shared cheaply
+        processBatch(path, guidLookup.path if isinstance(guidLookup, GuidIndex) else None)
+    elif os.path.isdir(path):
+        if args['batch']:
+            log.warning("Batch mode GUID/ratingKey conversion requires [Performance] guid-index, processing files sequentially")
         for root, _, files in os.walk(path):
             for filename in files:
                 fullpath = os.path.join(root, filename)
@@ -1,16 +1,20 @@
 import sys
 import os
+import signal
 from argparse import ArgumentParser
 from resources.log import getLogger
 from resources.settings import Settings
 from resources.skipper import Skipper
+from resources.asyncSkipper import AsyncSkipper
 from resources.server import getPlexServer
+from resources.statusServer import StatusServer
 
 if __name__ == '__main__':
     log = getLogger(__name__)
 
     parser = ArgumentParser(description="Plex Autoskip")
     parser.add_argument('-c', '--config', help='Specify an alternate configuration file location')
+    parser.add_argument('-e', '--engine', choices=Settings.ENGINES, help='Runtime engine, overrides the config.ini setting')
     args = vars(parser.parse_args())
 
     if args['config'] and os.path.exists(args['config']):
@@ -22,8 +26,18 @@ if __name__ == '__main__':
 
     plex, sslopt = getPlexServer(settings, log)
 
+    engine = args['engine'] or settings.engine
+    if engine == "asyncio" and not AsyncSkipper.available():
+        log.error("The asyncio engine requires the aiohttp python package, falling back to the threaded engine")
+        engine = "threaded"
+
     if plex:
-        skipper = Skipper(plex, settings, log)
+        skipper = AsyncSkipper(plex, settings, log) if engine == "asyncio" else Skipper(plex, settings, log)
+        if hasattr(signal, "SIGUSR1"):
+            # kill -USR1 <pid> logs the latency report
+            signal.signal(signal.SIGUSR1, lambda *_: skipper.metrics.report())
+        if settings.status:
+            StatusServer(skipper, settings.statusaddress, settings.statusport, logger=log).start()
         skipper.start(sslopt=sslopt)
     else:
         log.error("Unable to establish Plex Server object via PlexAPI")
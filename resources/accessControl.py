@@ -0,0 +1,122 @@
+import logging
+from threading import Lock
+from typing import Dict, FrozenSet, List, NamedTuple, Tuple
+from resources.customEntries import CustomEntries
+from resources.settings import Settings
+from resources.log import getLogger
+
+
+ALLOWING = "Allowing"
+BLOCKING = "Blocking"
+
+
+class Decision(NamedTuple):
+    blocked: bool
+    reasons: Tuple[Tuple[str, str], ...]
+
+
+class Rules(NamedTuple):
+    allowedUsers: FrozenSet[str]
+    blockedUsers: FrozenSet[str]
+    allowedClients: FrozenSet[str]
+    blockedClients: FrozenSet[str]
+    allowedKeys: FrozenSet[str]
+    blockedKeys: FrozenSet[str]
+
+
+class AccessControl():
+    # Allowed/blocked lists from the custom entries compiled to sets, decisions are memoized until the entries change
+    CAP = 5000
+
+    @staticmethod
+    def normalize(key) -> str:
+        return str(key).strip()
+
+    def __init__(self, settings: Settings, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.settings: Settings = settings
+        self._source: Tuple[int, int] = None
+        self._rules: Rules = None
+        self._decisions: Dict[tuple, Decision] = {}
+        self._lock: Lock = Lock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def rules(self) -> Rules:
+        custom: CustomEntries = self.settings.customEntries
+        source = (id(custom), custom.version)
+        with self._lock:
+            if source != self._source:
+                self._rules = Rules(
+                    allowedUsers=frozenset(self.normalize(x) for x in custom.allowedUsers),
+                    blockedUsers=frozenset(self.normalize(x) for x in custom.blockedUsers),
+                    allowedClients=frozenset(self.normalize(x) for x in custom.allowedClients),
+                    blockedClients=frozenset(self.normalize(x) for x in custom.blockedClients),
+                    allowedKeys=frozenset(self.normalize(x) for x in custom.allowedKeys),
+                    blockedKeys=frozenset(self.normalize(x) for x in custom.blockedKeys)
+                )
+                self._decisions.clear()
+                self._source = source
+                self.log.debug("Compiled access rules for custom entries version %d" % (custom.version))
+            return self._rules
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._source = None
+            self._decisions.clear()
+
+    def _memo(self, key: tuple, compute) -> Decision:
+        rules = self.rules
+        decision = self._decisions.get(key)
+        if decision:
+            self.hits += 1
+            return decision
+        self.misses += 1
+        decision = compute(rules)
+        with self._lock:
+            if len(self._decisions) >= self.CAP:
+                self._decisions.clear()
+            self._decisions[key] = decision
+        return decision
+
+    def userClient(self, username: str, playerTitle: str, clientIdentifier: str) -> Decision:
+        return self._memo(("user", username, playerTitle, clientIdentifier), lambda rules: self._userClient(rules, username, playerTitle, clientIdentifier))
+
+    def _userClient(self, rules: Rules, username: str, playerTitle: str, clientIdentifier: str) -> Decision:
+        reasons = []
+        user = self.normalize(username)
+        if user in rules.blockedUsers:
+            return Decision(True, ((BLOCKING, " based on blocked user in %s" % (username)),))
+        if rules.allowedUsers and user not in rules.allowedUsers:
+            return Decision(True, ((BLOCKING, " based on no allowed user in %s" % (username)),))
+        elif rules.allowedUsers:
+            reasons.append((ALLOWING, " based on allowed user in %s" % (username)))
+
+        player = {self.normalize(playerTitle), self.normalize(clientIdentifier)}
+        if rules.allowedClients and not (player & rules.allowedClients):
+            return Decision(True, tuple(reasons) + ((BLOCKING, " based on no allowed player %s %s" % (playerTitle, clientIdentifier)),))
+        elif rules.allowedClients:
+            reasons.append((ALLOWING, " based on allowed player %s %s" % (playerTitle, clientIdentifier)))
+        if rules.blockedClients and (player & rules.blockedClients):
+            return Decision(True, tuple(reasons) + ((BLOCKING, " based on blocked player %s %s" % (playerTitle, clientIdentifier)),))
+        return Decision(False, tuple(reasons))
+
+    def keys(self, ratingKeys: List[Tuple[str, int]]) -> Decision:
+        # ratingKeys is (level, ratingKey) from most to least specific
+        ancestry = tuple((level, self.normalize(key)) for level, key in ratingKeys)
+        return self._memo(("keys",) + ancestry, lambda rules: self._keys(rules, ancestry))
+
+    def _keys(self, rules: Rules, ancestry: Tuple[Tuple[str, str], ...]) -> Decision:
+        reasons = []
+        allowed = False
+        for level, key in ancestry:
+            if key in rules.allowedKeys:
+                reasons.append((ALLOWING, " for %s %s" % (level, key)))
+                allowed = True
+            if key in rules.blockedKeys:
+                return Decision(True, tuple(reasons) + ((BLOCKING, " for %s %s" % (level, key)),))
+        if rules.allowedKeys and not allowed:
+            return Decision(True, tuple(reasons) + ((BLOCKING, ", not on allowed list"),))
+        return Decision(False, tuple(reasons))
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ssl import CERT_NONE
+from typing import Callable, Dict, Hashable
+from xml.etree import ElementTree
+from plexapi.client import PlexClient
+from plexapi.exceptions import BadRequest, NotFound
+from plexapi.server import PlexServer
+from resources.settings import Settings
+from resources.skipper import Skipper
+from resources.mediaWrapper import MediaWrapper
+from resources.playerDirectory import commandRequest
+from resources.dispatcher import CommandDispatcher, Command, SEEKCOMMAND, VOLUMECOMMAND, STEPCOMMAND
+from resources.sequencer import Sequence, Step
+from resources.metrics import Histogram, SKIP
+from resources.sslAlertListener import SSLAlertListener
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncScheduler():
+    # Same interface as Scheduler but backed by event loop timers, safe to call from executor threads
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable) -> None:
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.callback: Callable = callback
+        self._handles: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._thread: int = threading.get_ident()
+        self.lag: Histogram = Histogram()
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        if threading.get_ident() != self._thread:
+            self.loop.call_soon_threadsafe(self.schedule, key, delay)
+            return
+        handle = self._handles.pop(key, None)
+        if handle:
+            handle.cancel()
+        self._handles[key] = self.loop.call_later(max(delay, 0), self._fire, key, self.loop.time() + max(delay, 0))
+
+    def cancel(self, key: Hashable) -> None:
+        if threading.get_ident() != self._thread:
+            self.loop.call_soon_threadsafe(self.cancel, key)
+            return
+        handle = self._handles.pop(key, None)
+        if handle:
+            handle.cancel()
+
+    def deadline(self, key: Hashable) -> float:
+        handle = self._handles.get(key)
+        return handle.when() if handle else None
+
+    def _fire(self, key: Hashable, deadline: float) -> None:
+        self._handles.pop(key, None)
+        self.lag.observe((self.loop.time() - deadline) * 1000)
+        self.callback(key)
+
+
+class AsyncCommandDispatcher(CommandDispatcher):
+    # Per-player ordered queues drained by lightweight tasks instead of worker threads
+    CONCURRENCY = 32
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, concurrency: int = CONCURRENCY, logger: logging.Logger = None) -> None:
+        super(AsyncCommandDispatcher, self).__init__(concurrency, logger)
+        self.loop: asyncio.AbstractEventLoop = loop
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+        self._thread: int = threading.get_ident()
+
+    def submit(self, clientIdentifier: str, kind: str, key: str, function: Callable, *args) -> None:
+        if threading.get_ident() != self._thread:
+            self.loop.call_soon_threadsafe(self.submit, clientIdentifier, kind, key, function, *args)
+            return
+        if self._enqueue(clientIdentifier, Command(kind, key, function, args)):
+            self.loop.create_task(self._drain(clientIdentifier))
+
+    async def _drain(self, clientIdentifier: str) -> None:
+        while self._queues[clientIdentifier]:
+            command = self._dequeue(clientIdentifier)
+            async with self._semaphore:
+                try:
+                    await command.function(*command.args)
+                except:
+                    self.log.exception("Unhandled exception running %s for player %s" % (command, clientIdentifier))
+        del self._queues[clientIdentifier]
+
+
+class AsyncSkipper(Skipper):
+    # asyncio runtime, the websocket, timers and player commands run as coroutines on one event loop over a pooled
+    # aiohttp session. PlexAPI object construction is synchronous so it stays on the shared hydration pool/executor
+    EXECUTOR_WORKERS = 8
+    CONNECTIONS = 64
+    COMMAND_TIMEOUT = 30
+    RECONNECT_DELAY = 5
+    TIMELINE_KEY = "timeline/poll"
+
+    @staticmethod
+    def available() -> bool:
+        return aiohttp is not None
+
+    def __init__(self, server: PlexServer, settings: Settings, logger: logging.Logger = None) -> None:
+        super(AsyncSkipper, self).__init__(server, settings, logger)
+        self.loop: asyncio.AbstractEventLoop = None
+        self.http = None
+        self.executor: ThreadPoolExecutor = None
+
+    def start(self, sslopt: dict = None) -> None:
+        self.executor = ThreadPoolExecutor(self.EXECUTOR_WORKERS, thread_name_prefix="AsyncSkipper")
+        self.startWatcher()
+        try:
+            asyncio.run(self.run(sslopt))
+        except KeyboardInterrupt:
+            self.log.debug("Stopping listener")
+        finally:
+            self.executor.shutdown(wait=False)
+            self.latency.save(force=True)
+
+    async def run(self, sslopt: dict = None) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.scheduler = AsyncScheduler(self.loop, self.checkDue)
+        self.dispatcher = AsyncCommandDispatcher(self.loop, logger=self.log)
+
+        ssl = False if sslopt and sslopt.get("cert_reqs") == CERT_NONE else None
+        connector = aiohttp.TCPConnector(limit=self.CONNECTIONS, ssl=ssl)
+        async with aiohttp.ClientSession(connector=connector) as self.http:
+            self.loop.call_later(self.IDLE_WAIT, self.clean)
+            while True:
+                try:
+                    await self.listen()
+                except (aiohttp.ClientError, OSError) as e:
+                    self.error(e)
+                self.log.error("Connection lost, reconnecting in %d seconds" % (self.RECONNECT_DELAY))
+                self.metrics.increment("reconnects")
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def listen(self) -> None:
+        url = self.server.url(SSLAlertListener.key, includeToken=True).replace('http', 'ws')
+        self.log.debug("Starting listener")
+        async with self.http.ws_connect(url, heartbeat=30) as ws:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    try:
+                        data = json.loads(message.data)['NotificationContainer']
+                    except (ValueError, KeyError):
+                        self.log.debug("Unable to parse websocket message %s" % (message.data))
+                        continue
+                    self.processAlert(data)
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    self.error(ws.exception())
+                    break
+
+    def clean(self) -> None:
+        self.bingeSessions.clean()
+        self.loop.call_later(self.IDLE_WAIT, self.clean)
+
+    def seekTo(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
+        self.dispatcher.submit(mediaWrapper.clientIdentifier, SEEKCOMMAND, mediaWrapper.pasIdentifier, self.asyncSeekTo, mediaWrapper, targetOffset)
+
+    def setVolume(self, mediaWrapper: MediaWrapper, volume: int, lowering: bool) -> None:
+        self.dispatcher.submit(mediaWrapper.clientIdentifier, VOLUMECOMMAND, mediaWrapper.pasIdentifier, self.asyncSetVolume, mediaWrapper, volume, lowering)
+
+    def dispatchStep(self, sequence: Sequence, step: Step) -> None:
+        self.dispatcher.submit(sequence.clientIdentifier, STEPCOMMAND, sequence.key, self.asyncRunStep, sequence, step)
+
+    async def asyncRunStep(self, sequence: Sequence, step: Step) -> None:
+        # Steps are PlexAPI player calls, the delays between them are loop timers through AsyncScheduler
+        await self.loop.run_in_executor(self.executor, self.runStep, sequence, step)
+
+    async def asyncSeekTo(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
+        player = mediaWrapper.player
+        if not player:
+            return
+        if mediaWrapper.skipnext and targetOffset >= mediaWrapper.media.duration:
+            # Skip next builds PlayQueues through PlexAPI objects, keep it off the loop
+            await self.loop.run_in_executor(self.executor, self._seekTo, mediaWrapper, targetOffset)
+            return
+        try:
+            targetOffset = self.adjustSeekTarget(player, mediaWrapper, targetOffset)
+            if targetOffset is None:
+                return
+            self.log.info("Seeking %s player playing %s from %d to %d" % (player.product, mediaWrapper, mediaWrapper.viewOffset, targetOffset))
+            self.metrics.observe(SKIP, "alertToCommand", mediaWrapper.sinceLastAlert * 1000)
+            with mediaWrapper.seekCommand(targetOffset):
+                started = self.loop.time()
+                await self.sendCommand(player, "playback/seekTo", offset=targetOffset, type="video")
+                self.latency.command(player, (self.loop.time() - started) * 1000)
+            self.verifySeekLater(mediaWrapper, targetOffset)
+        except (BadRequest, NotFound) as e:
+            self.logErrorMessage(e, "%s exception seekPlayerTo" % (e.__class__.__name__))
+            self.players.invalidate(player.machineIdentifier)
+            mediaWrapper.badSeek()
+        except asyncio.TimeoutError:
+            self.log.debug("TimeoutError, removing from cache to prevent false triggers, will be restored with next sync")
+            self.removeSession(mediaWrapper)
+            self.players.invalidate(player.machineIdentifier)
+        except:
+            self.log.exception("Exception, removing from cache to prevent false triggers, will be restored with next sync")
+            self.removeSession(mediaWrapper)
+            self.players.invalidate(player.machineIdentifier)
+        self.scheduleCheck(mediaWrapper)
+
+    async def asyncSetVolume(self, mediaWrapper: MediaWrapper, volume: int, lowering: bool) -> None:
+        player = mediaWrapper.player
+        if not player:
+            return
+        try:
+            previousVolume = self.settings.volumehigh if lowering else self.settings.volumelow
+            timeline = await self.playerTimeline(player)
+            if timeline is not None and timeline.attrib.get("volume") is not None:
+                previousVolume = int(timeline.attrib["volume"])
+            else:
+                self.log.debug("Unable to access timeline data for player %s to cache previous volume value, will restore to %d" % (player.product, previousVolume))
+            self.log.info("Setting %s player volume playing %s from %d to %d" % (player.product, mediaWrapper, previousVolume, volume))
+            mediaWrapper.updateVolume(volume, previousVolume, lowering)
+            await self.sendCommand(player, "playback/setParameters", volume=volume, type="video")
+        except (BadRequest, NotFound) as e:
+            self.logErrorMessage(e, "%s exception setPlayerVolume" % (e.__class__.__name__))
+            self.players.invalidate(player.machineIdentifier)
+        except asyncio.TimeoutError:
+            self.log.debug("TimeoutError, removing from cache to prevent false triggers, will be restored with next sync")
+            self.removeSession(mediaWrapper)
+            self.players.invalidate(player.machineIdentifier)
+        except:
+            self.log.exception("Exception, removing from cache to prevent false triggers, will be restored with next sync")
+            self.removeSession(mediaWrapper)
+            self.players.invalidate(player.machineIdentifier)
+        self.scheduleCheck(mediaWrapper)
+
+    async def playerTimeline(self, player: PlexClient) -> ElementTree.Element:
+        text = await self.sendCommand(player, self.TIMELINE_KEY, wait=0)
+        try:
+            timelines = ElementTree.fromstring(text) if text else []
+        except ElementTree.ParseError:
+            return None
+        return next((t for t in timelines if t.attrib.get("state", "stopped") != "stopped"), None)
+
+    async def sendCommand(self, player: PlexClient, command: str, **params) -> str:
+        url, headers = commandRequest(player, command, **params)
+        with self.metrics.timed(command.split("/")[-1], player):
+            async with self.http.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=self.COMMAND_TIMEOUT)) as response:
+                text = await response.text()
+                if response.status == 404:
+                    raise NotFound("(%d) not_found; %s %s" % (response.status, url, text.replace('\n', ' ')))
+                elif response.status not in (200, 201, 204):
+                    raise BadRequest("(%d) %s; %s %s" % (response.status, response.reason, url, text.replace('\n', ' ')))
+                return text
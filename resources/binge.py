@@ -3,7 +3,9 @@ from datetime import datetime
 from resources.mediaWrapper import MediaWrapper, GRANDPARENTRATINGKEY
 from resources.log import getLogger
 from resources.settings import Settings
+from resources.sessionRegistry import ExpiringSet
 from plexapi.playqueue import PlayQueue
+from threading import Lock
 from typing import Dict, List
 
 
@@ -90,12 +92,15 @@ class BingeSession():
 class BingeSessions():
     TIMEOUT = 300
     IGNORED_CAP = 200
+    IGNORED_TTL = 43200
 
     def __init__(self, settings: Settings, logger: logging.Logger = None) -> None:
         self.log = logger or getLogger(__name__)
         self.settings: Settings = settings
         self.sessions: Dict[BingeSession] = {}
-        self.ignored: List[str] = []
+        self.ignored: ExpiringSet = ExpiringSet(self.IGNORED_CAP, self.IGNORED_TTL)
+        # Updated from hydration threads as sessions are added and cleaned from the main loop
+        self.lock: Lock = Lock()
 
     def update(self, mediaWrapper: MediaWrapper) -> None:
         if mediaWrapper.ended:
@@ -104,34 +109,46 @@ class BingeSessions():
         if mediaWrapper.playQueueID in self.ignored:
             return
 
-        if mediaWrapper.clientIdentifier in self.sessions:
-            oldCount = self.sessions[mediaWrapper.clientIdentifier].count
-            if self.sessions[mediaWrapper.clientIdentifier].update(mediaWrapper):
-                if oldCount != self.sessions[mediaWrapper.clientIdentifier].count:
-                    self.log.debug("Updating binge watcher (%s) with %s, remaining %d total %d" % ("active" if self.sessions[mediaWrapper.clientIdentifier].block else "inactive", mediaWrapper, self.sessions[mediaWrapper.clientIdentifier].remaining, self.sessions[mediaWrapper.clientIdentifier].count))
-                return
-            else:
-                self.log.debug("Binge watcher %s is no longer relavant, player is playing alternative content, deleting" % (self.sessions[mediaWrapper.clientIdentifier]))
-                del self.sessions[mediaWrapper.clientIdentifier]
-
+        with self.lock:
+            if mediaWrapper.clientIdentifier in self.sessions:
+                oldCount = self.sessions[mediaWrapper.clientIdentifier].count
+                if self.sessions[mediaWrapper.clientIdentifier].update(mediaWrapper):
+                    if oldCount != self.sessions[mediaWrapper.clientIdentifier].count:
+                        self.log.debug("Updating binge watcher (%s) with %s, remaining %d total %d" % ("active" if self.sessions[mediaWrapper.clientIdentifier].block else "inactive", mediaWrapper, self.sessions[mediaWrapper.clientIdentifier].remaining, self.sessions[mediaWrapper.clientIdentifier].count))
+                    return
+                else:
+                    self.log.debug("Binge watcher %s is no longer relavant, player is playing alternative content, deleting" % (self.sessions[mediaWrapper.clientIdentifier]))
+                    del self.sessions[mediaWrapper.clientIdentifier]
+
+        # Built outside the lock, it fetches the PlayQueue
         try:
-            self.sessions[mediaWrapper.clientIdentifier] = BingeSession(mediaWrapper, self.settings.binge, self.settings.skipnextmax, self.settings.bingesafetags, self.settings.bingesameshowonly)
-            self.log.debug("Creating binge watcher (%s) for %s, remaining %d total %d" % ("active" if self.sessions[mediaWrapper.clientIdentifier].block else "inactive", mediaWrapper, self.sessions[mediaWrapper.clientIdentifier].remaining, self.sessions[mediaWrapper.clientIdentifier].count))
+            session = BingeSession(mediaWrapper, self.settings.binge, self.settings.skipnextmax, self.settings.bingesafetags, self.settings.bingesameshowonly)
         except BingeSession.BingeSessionException:
-            self.ignored.append(mediaWrapper.playQueueID)
-            self.ignored = self.ignored[-self.IGNORED_CAP:]
+            self.ignored.add(mediaWrapper.playQueueID)
+            return
+        with self.lock:
+            self.sessions[mediaWrapper.clientIdentifier] = session
+        self.log.debug("Creating binge watcher (%s) for %s, remaining %d total %d" % ("active" if session.block else "inactive", mediaWrapper, session.remaining, session.count))
+
+    def reapply(self, mediaWrapper: MediaWrapper) -> None:
+        with self.lock:
+            session: BingeSession = self.sessions.get(mediaWrapper.clientIdentifier)
+            if session and session.current is mediaWrapper:
+                session.__updateMediaWrapper__()
 
     def blockSkipNext(self, mediaWrapper: MediaWrapper) -> bool:
         if not self.settings.skipnextmax:
             return False
 
-        session: BingeSession = self.sessions.get(mediaWrapper.clientIdentifier)
+        with self.lock:
+            session: BingeSession = self.sessions.get(mediaWrapper.clientIdentifier)
         if session:
             return session.blockSkipNext
         return False
 
     def clean(self) -> None:
-        for session in list(self.sessions.values()):
-            if session.sinceLastUpdate > self.TIMEOUT:
-                self.log.debug("Binge watcher %s hasn't been updated in %d seconds, removing" % (session, self.TIMEOUT))
-                del self.sessions[session.clientIdentifier]
+        with self.lock:
+            for session in list(self.sessions.values()):
+                if session.sinceLastUpdate > self.TIMEOUT:
+                    self.log.debug("Binge watcher %s hasn't been updated in %d seconds, removing" % (session, self.TIMEOUT))
+                    del self.sessions[session.clientIdentifier]
@@ -0,0 +1,77 @@
+import logging
+import os
+import time
+from threading import Event, Thread
+from typing import Callable
+from resources.settings import Settings
+from resources.log import getLogger
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class ConfigWatcher(Thread):
+    # Watches config.ini and the custom JSON files, inotify when available with mtime polling as the fallback
+    POLL_INTERVAL = 5
+    DEBOUNCE = 0.5
+
+    def __init__(self, settings: Settings, callback: Callable, interval: float = POLL_INTERVAL, logger: logging.Logger = None) -> None:
+        super(ConfigWatcher, self).__init__(name="ConfigWatcher", daemon=True)
+        self.log = logger or getLogger(__name__)
+        self.settings: Settings = settings
+        self.callback: Callable = callback
+        self.interval: float = interval
+        self._stopped: Event = Event()
+        self._inotify = None
+
+        if INotify:
+            try:
+                self._inotify = INotify()
+            except OSError:
+                self.log.debug("Unable to initialize inotify, falling back to polling")
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def watchDirectories(self) -> None:
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        for root, _, _ in os.walk(self.settings.configDir):
+            try:
+                self._inotify.add_watch(root, mask)
+            except OSError:
+                self.log.debug("Unable to watch directory %s" % (root))
+
+    def relevant(self, event) -> bool:
+        # Subdirectories coming and going can add or remove custom files, anything else only counts for config.ini and custom files
+        if event.mask & flags.ISDIR:
+            return True
+        return event.name == os.path.basename(self.settings.configFile) or self.settings.isCustomFile(event.name)
+
+    def wait(self) -> bool:
+        if not self._inotify:
+            self._stopped.wait(self.interval)
+            return True
+        events = self._inotify.read(timeout=int(self.interval * 1000))
+        if not events:
+            return False
+        # Editors and copies produce bursts of events, let them settle before reparsing
+        time.sleep(self.DEBOUNCE)
+        events.extend(self._inotify.read(timeout=0))
+        if any(e.mask & flags.ISDIR and e.mask & (flags.CREATE | flags.MOVED_TO) for e in events):
+            self.watchDirectories()
+        return any(self.relevant(e) for e in events)
+
+    def run(self) -> None:
+        self.log.debug("Watching %s for configuration changes (%s)" % (self.settings.configDir, "inotify" if self._inotify else "polling every %ds" % (self.interval)))
+        if self._inotify:
+            self.watchDirectories()
+        while not self._stopped.is_set():
+            if not self.wait():
+                continue
+            try:
+                if any(self.settings.changed()):
+                    self.callback()
+            except:
+                self.log.exception("Unable to reload configuration")
@@ -1,17 +1,51 @@
 import logging
-from typing import Dict, List, TypeVar
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple, TypeVar
 from plexapi.server import PlexServer
 from plexapi.video import Show, Season, Episode, Movie
 from plexapi.exceptions import NotFound
 from resources.log import getLogger
+from resources.guidIndex import GuidIndex
+from resources.libraryCrawler import LibraryCrawler
 
 
 GuidMedia = TypeVar("GuidMedia", Show, Season, Episode, Movie)
 RATINGKEY = "ratingKey"
+STARTKEY = "start"
+ENDKEY = "end"
+TAGKEY = "tags"
+COMMANDKEY = "command"
+
+
+class MarkerGroup(NamedTuple):
+    level: str
+    ratingKey: int
+    markers: Tuple[dict, ...]
+
+
+class ShowTable(NamedTuple):
+    seasons: Dict[int, int]
+    episodes: Dict[Tuple[int, int], int]
+
+
+class Policy(NamedTuple):
+    # Effective custom settings for one (ratingKey hierarchy, player) pair, None means no override of the config value
+    markerGroups: Tuple[MarkerGroup, ...]
+    leftOffset: Optional[int]
+    rightOffset: Optional[int]
+    offsetTags: Optional[Tuple[str, ...]]
+    tags: Optional[Tuple[str, ...]]
+    modes: Tuple[str, ...]
+    commandDelay: int
+    allowSkipNext: bool
+    blockSkipNext: bool
+    playerTags: Tuple[str, ...]
 
 
 class CustomEntries():
     PREFIXES = ["imdb://", "tmdb://", "tvdb://"]
+    POLICY_CAP = 1000
 
     @property
     def markers(self) -> Dict[str, list]:
@@ -73,6 +107,13 @@ class CustomEntries():
     def mode(self) -> Dict[str, str]:
         return self.data.get("mode", {})
 
+    @property
+    def guidKeys(self) -> set:
+        with self._guidLock:
+            if self._guidKeys is None:
+                self._guidKeys = set(str(key) for key in (list(self.markers.keys()) + list(self.offsets.keys()) + list(self.tags.keys()) + list(self.mode.keys()) + self.allowedKeys + self.blockedKeys) if CustomEntries.keyIsGuid(key))
+            return self._guidKeys
+
     @property
     def needsGuidResolution(self) -> bool:
         return any(str(key).startswith(p) for key in (list(self.markers.keys()) + list(self.offsets.keys()) + list(self.tags.keys()) + list(self.mode.keys()) + self.allowedKeys + self.blockedKeys) for p in self.PREFIXES)
@@ -85,31 +126,100 @@ class CustomEntries():
         log.debug("Finished generated match table with %d entries" % (len(guidLookup)))
         return guidLookup
 
-    def convertToRatingKeys(self, server: PlexServer, guidLookup: dict = None) -> None:
-        guidLookup = guidLookup or CustomEntries.loadGuids(server, self.log)
+    def matchGuids(self, media: GuidMedia) -> bool:
+        # Session time alternative to convertToRatingKeys, binds GUID keyed entries to the ratingKeys of the playing item
+        if not self.guidKeys or media.ratingKey in self._matched:
+            return False
+
+        candidates = [(media.ratingKey, [g.id for g in getattr(media, "guids", [])])]
+        if media.type == "episode":
+            for guid in self.showGuids(media):
+                candidates.append((media.grandparentRatingKey, [guid]))
+                # Unmatched items and specials can be missing season/episode numbers
+                if media.seasonNumber is not None:
+                    candidates.append((media.parentRatingKey, ["%s.%d" % (guid, media.seasonNumber)]))
+                    if media.episodeNumber is not None:
+                        candidates.append((media.ratingKey, ["%s.%d.%d" % (guid, media.seasonNumber, media.episodeNumber)]))
+
+        bound = set()
+        access = False
+        with self._guidLock:
+            for ratingKey, guids in candidates:
+                for guid in guids:
+                    if guid in self._guidKeys:
+                        self.log.debug("Matched custom entry GUID %s to ratingKey %s" % (guid, ratingKey))
+                        access = self.bindGuid(guid, ratingKey) or access
+                        bound.add(str(ratingKey))
+            self._matched.add(media.ratingKey)
+        if access:
+            # Allowed/blocked keys changed, access rules are rebuilt from a new version
+            self.invalidate()
+        elif bound:
+            self.invalidate(bound)
+        return bool(bound)
+
+    def showGuids(self, media: Episode) -> List[str]:
+        guids = self._showGuids.get(media.grandparentRatingKey)
+        if guids is None:
+            try:
+                guids = [g.id for g in media.show().guids]
+            except NotFound:
+                guids = []
+            self._showGuids[media.grandparentRatingKey] = guids
+        return guids
+
+    def bindGuid(self, guid: str, ratingKey: int) -> bool:
+        # Called holding _guidLock, returns True when allowed/blocked keys changed
+        for entries in [self.markers, self.offsets, self.tags, self.mode]:
+            if guid in entries:
+                entries[str(ratingKey)] = entries[guid]
+        access = False
+        for keys in [self.allowedKeys, self.blockedKeys]:
+            if guid in keys and int(ratingKey) not in keys:
+                keys.append(int(ratingKey))
+                access = True
+        return access
+
+    def convertToRatingKeys(self, server: PlexServer, guidLookup: dict = None, resolved: Dict[str, str] = None) -> None:
+        # resolved is the GUID to ratingKey mapping of an earlier conversion, the library is only loaded for GUIDs it doesn't cover
+        resolved = resolved or {}
+        showTables: Dict[int, ShowTable] = {}
+
+        def resolve(key: str) -> str:
+            nonlocal guidLookup
+            if key in resolved:
+                ratingKey = resolved[key]
+            else:
+                if guidLookup is None:
+                    guidLookup = CustomEntries.loadGuids(server, self.log)
+                ratingKey = CustomEntries.resolveGuidToKey(key, guidLookup, showTables)
+            if str(ratingKey) != str(key):
+                self.resolved[key] = str(ratingKey)
+            return ratingKey
+
         for k in [x for x in list(self.markers.keys()) if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom markers GUID %s to ratingKey %s" % (k, ratingKey))
                 self.markers[str(ratingKey)] = self.markers.pop(k)
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in custom markers" % (k))
         for k in [x for x in list(self.offsets.keys()) if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom offsets GUID %s to ratingKey %s" % (k, ratingKey))
                 self.offsets[str(ratingKey)] = self.offsets.pop(k)
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in custom offsets" % (k))
         for k in [x for x in list(self.tags.keys()) if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom tags GUID %s to ratingKey %s" % (k, ratingKey))
                 self.tags[str(ratingKey)] = self.tags.pop(k)
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in tags offsets" % (k))
         for k in [x for x in self.allowedKeys if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom allowedKey GUID %s to ratingKey %s" % (k, ratingKey))
                 self.allowedKeys.append(int(ratingKey))
@@ -117,7 +227,7 @@ class CustomEntries():
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in custom allowedKeys" % (k))
         for k in [x for x in self.blockedKeys if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom blockedKeys GUID %s to ratingKey %s" % (k, ratingKey))
                 self.blockedKeys.append(int(ratingKey))
@@ -125,52 +235,49 @@ class CustomEntries():
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in custom blockedKeys" % (k))
         for k in [x for x in list(self.mode.keys()) if CustomEntries.keyIsGuid(x)]:
-            ratingKey = CustomEntries.resolveGuidToKey(k, guidLookup)
+            ratingKey = resolve(k)
             if str(ratingKey) != str(k):
                 self.log.debug("Resolving custom offsets GUID %s to ratingKey %s" % (k, ratingKey))
                 self.mode[str(ratingKey)] = self.mode.pop(k)
             else:
                 self.log.error("Unable to resolve GUID %s to ratingKey in custom mode" % (k))
+        self._guidKeys = None
+        self.invalidate()
 
     @staticmethod
     def loadRatingKeys(server: PlexServer, logger: logging.Logger = None) -> dict:
         log = logger or getLogger(__name__)
         log.debug("Generating ratingKey match table")
-        ratingKeyLookup = {item.ratingKey: item for item in server.library.all() if hasattr(item, RATINGKEY)}
-        for v in list(ratingKeyLookup.values()):
-            if v.type == "show":
-                for e in v.episodes():
-                    ratingKeyLookup[e.ratingKey] = e
-                for s in v.seasons():
-                    ratingKeyLookup[s.ratingKey] = s
+        ratingKeyLookup = LibraryCrawler(server, logger=log).ratingKeys()
         log.debug("Finished generated match table with %d entries" % (len(ratingKeyLookup)))
         return ratingKeyLookup
 
     def convertToGuids(self, server: PlexServer, ratingKeyLookup: dict = None) -> None:
-        ratingKeyLookup = ratingKeyLookup or CustomEntries.loadRatingKeys(server, self.log)
+        ratingKeyLookup = ratingKeyLookup if ratingKeyLookup is not None else CustomEntries.loadRatingKeys(server, self.log)
+        showGuids: Dict[int, List[str]] = {}
         for k in [x for x in list(self.markers.keys()) if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom marker ratingKey %s to GUID %s" % (k, guid))
                 self.markers[guid] = self.markers.pop(k)
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in custom markers" % (k))
         for k in [x for x in list(self.offsets.keys()) if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom offset ratingKey %s to GUID %s" % (k, guid))
                 self.offsets[guid] = self.offsets.pop(k)
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in custom offsets" % (k))
         for k in [x for x in list(self.tags.keys()) if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom tags ratingKey %s to GUID %s" % (k, guid))
                 self.tags[guid] = self.tags.pop(k)
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in tags offsets" % (k))
         for k in [x for x in self.allowedKeys if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(str(k), ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(str(k), ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom allowedKey ratingKey %s to GUID %s" % (k, guid))
                 self.allowedKeys.append(guid)
@@ -178,7 +285,7 @@ class CustomEntries():
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in custom allowedKeys" % (k))
         for k in [x for x in self.blockedKeys if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(str(k), ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(str(k), ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom blockedKey ratingKey %s to GUID %s" % (k, guid))
                 self.blockedKeys.append(guid)
@@ -186,27 +293,32 @@ class CustomEntries():
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in custom blockedKeys" % (k))
         for k in [x for x in list(self.mode.keys()) if not CustomEntries.keyIsGuid(x)]:
-            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup)
+            guid = CustomEntries.resolveKeyToGuid(k, ratingKeyLookup, showGuids=showGuids)
             if str(guid) != str(k):
                 self.log.debug("Resolving custom offset ratingKey %s to GUID %s" % (k, guid))
                 self.mode[guid] = self.mode.pop(k)
             else:
                 self.log.error("Unable to resolve ratingKey %s to GUID in custom mode" % (k))
+        self._guidKeys = None
+        self.invalidate()
 
     @staticmethod
     def keyIsGuid(key: str) -> bool:
         return any(str(key).startswith(p) for p in CustomEntries.PREFIXES)
 
     @staticmethod
-    def resolveGuidToKey(key: str, guidLookup: dict) -> str:
+    def resolveGuidToKey(key: str, guidLookup: dict, showTables: Dict[int, ShowTable] = None) -> str:
+        if isinstance(guidLookup, GuidIndex):
+            return guidLookup.resolve(key) or key
         k = key.split(".")
         base = guidLookup.get(k[0])
         if base:
             try:
-                if len(k) == 2 and base.type == "show":
-                    return base.season(season=int(k[1])).ratingKey
-                elif len(k) == 3 and base.type == "show":
-                    return base.episode(season=int(k[1]), episode=int(k[2])).ratingKey
+                if len(k) in [2, 3] and base.type == "show":
+                    # One pass over the show's seasons/leaves serves every key for that show
+                    table = CustomEntries.showTable(base, showTables if showTables is not None else {})
+                    ratingKey = table.seasons.get(int(k[1])) if len(k) == 2 else table.episodes.get((int(k[1]), int(k[2])))
+                    return ratingKey if ratingKey is not None else key
                 else:
                     return base.ratingKey
             except NotFound:
@@ -214,27 +326,139 @@ class CustomEntries():
         return key
 
     @staticmethod
-    def resolveKeyToGuid(key: str, ratingKeyLookup: dict, prefix: str = "tmdb://") -> str:
+    def showTable(show: Show, showTables: Dict[int, ShowTable]) -> ShowTable:
+        table = showTables.get(show.ratingKey)
+        if table is None:
+            table = ShowTable(
+                seasons={s.seasonNumber: s.ratingKey for s in show.seasons()},
+                episodes={(e.seasonNumber, e.episodeNumber): e.ratingKey for e in show.episodes()}
+            )
+            showTables[show.ratingKey] = table
+        return table
+
+    @staticmethod
+    def resolveKeyToGuid(key: str, ratingKeyLookup: dict, prefix: str = "tmdb://", showGuids: Dict[int, List[str]] = None) -> str:
+        if isinstance(ratingKeyLookup, GuidIndex):
+            return ratingKeyLookup.guidFor(int(key), prefix) or key
         base = ratingKeyLookup.get(int(key))
-        return CustomEntries.keyToGuid(base, prefix)
+        return CustomEntries.keyToGuid(base, prefix, showGuids, ratingKeyLookup)
 
     @staticmethod
-    def keyToGuid(base: GuidMedia, prefix: str = "tmdb://") -> str:
+    def keyToGuid(base: GuidMedia, prefix: str = "tmdb://", showGuids: Dict[int, List[str]] = None, ratingKeyLookup: dict = None) -> str:
         if base and hasattr(base, "guids"):
             if base.type == "episode":
-                tmdb = next(g for g in base.show().guids if g.id.startswith(prefix))
-                return "%s.%d.%d" % (tmdb.id, base.seasonNumber, base.episodeNumber)
+                tmdb = next(g for g in CustomEntries.cachedShowGuids(base, base.grandparentRatingKey, showGuids, ratingKeyLookup) if g.startswith(prefix))
+                return "%s.%d.%d" % (tmdb, base.seasonNumber, base.episodeNumber)
             elif base.type == "season":
-                tmdb = next(g for g in base.show().guids if g.id.startswith(prefix))
-                return "%s.%d" % (tmdb.id, base.seasonNumber)
+                tmdb = next(g for g in CustomEntries.cachedShowGuids(base, base.parentRatingKey, showGuids, ratingKeyLookup) if g.startswith(prefix))
+                return "%s.%d" % (tmdb, base.seasonNumber)
             else:
                 tmdb = next(g for g in base.guids if g.id.startswith(prefix))
                 return tmdb.id
         return base.ratingKey
 
+    @staticmethod
+    def cachedShowGuids(base: GuidMedia, showRatingKey: int, showGuids: Dict[int, List[str]] = None, ratingKeyLookup: dict = None) -> List[str]:
+        # Shows already in the lookup table carry their guids, otherwise fetch each show once
+        guids = showGuids.get(showRatingKey) if showGuids is not None else None
+        if guids is None:
+            show = ratingKeyLookup.get(showRatingKey) if ratingKeyLookup else None
+            guids = [g.id for g in (show if show is not None else base.show()).guids]
+            if showGuids is not None:
+                showGuids[showRatingKey] = guids
+        return guids
+
     def __init__(self, data: dict, logger: logging.Logger = None) -> None:
         self.data = data
         for m in self.markers:
             if isinstance(self.markers[m], dict):
                 self.markers[m] = [self.markers[m]]
         self.log = logger or logging.getLogger(__name__)
+        self.version: int = 0
+        self._bindings: int = 0
+        self._policies: OrderedDict = OrderedDict()
+        self._policyLock: Lock = Lock()
+        self._guidKeys: set = None
+        self._guidLock: Lock = Lock()
+        self._matched: set = set()
+        self._showGuids: Dict[int, List[str]] = {}
+        self.resolved: Dict[str, str] = {}
+
+    def invalidate(self, ratingKeys: set = None) -> None:
+        # Everything compiled from the entries is dropped, or only the policies that include one of ratingKeys
+        with self._policyLock:
+            if ratingKeys is None:
+                self.version += 1
+                self._policies.clear()
+                return
+            self._bindings += 1
+            for key in [k for k in self._policies if any(str(r) in ratingKeys for _, r in k[0])]:
+                del self._policies[key]
+
+    def policy(self, ratingKeys: List[Tuple[str, int]], playerTitle: str, clientIdentifier: str, machineIdentifier: str, product: str) -> Policy:
+        # ratingKeys is (level, ratingKey) from least to most specific, grandparent > parent > item
+        key = (tuple(ratingKeys), playerTitle, clientIdentifier, machineIdentifier, product)
+        with self._policyLock:
+            policy = self._policies.get(key)
+            if policy:
+                self._policies.move_to_end(key)
+                return policy
+            version = (self.version, self._bindings)
+
+        policy = self.compilePolicy(ratingKeys, playerTitle, clientIdentifier, machineIdentifier, product)
+        with self._policyLock:
+            if version == (self.version, self._bindings):
+                self._policies[key] = policy
+                while len(self._policies) > self.POLICY_CAP:
+                    self._policies.popitem(last=False)
+        return policy
+
+    def compilePolicy(self, ratingKeys: List[Tuple[str, int]], playerTitle: str, clientIdentifier: str, machineIdentifier: str, product: str) -> Policy:
+        markerGroups = []
+        leftOffset = rightOffset = offsetTags = tags = None
+        modes = []
+        # Same lock as bindGuid, GUID entries are bound from hydration threads
+        with self._guidLock:
+            for level, ratingKey in ratingKeys:
+                k = str(ratingKey)
+                if k in self.markers:
+                    markerGroups.append(MarkerGroup(level, ratingKey, tuple(self.markers[k])))
+                if k in self.offsets:
+                    leftOffset = self.offsets[k].get(STARTKEY, leftOffset)
+                    rightOffset = self.offsets[k].get(ENDKEY, rightOffset)
+                    offsetTags = self.offsets[k].get(TAGKEY, offsetTags)
+                if k in self.tags:
+                    tags = self.tags[k]
+                if k in self.mode:
+                    modes.append(self.mode[k])
+
+        if playerTitle in self.mode:
+            modes.append(self.mode[playerTitle])
+        elif clientIdentifier in self.mode:
+            modes.append(self.mode[clientIdentifier])
+
+        commandDelay = 0
+        if playerTitle in self.offsets:
+            commandDelay = self.offsets[playerTitle].get(COMMANDKEY, commandDelay)
+        elif clientIdentifier in self.offsets:
+            commandDelay = self.offsets[clientIdentifier].get(COMMANDKEY, commandDelay)
+
+        inAllowed = playerTitle in self.allowedSkipNext or clientIdentifier in self.allowedSkipNext
+        inBlocked = playerTitle in self.blockedSkipNext or clientIdentifier in self.blockedSkipNext
+        allowSkipNext = bool(self.allowedSkipNext) and inAllowed
+        blockSkipNext = (bool(self.allowedSkipNext) and not inAllowed) or (bool(self.blockedSkipNext) and inBlocked)
+
+        playerTags = self.tags.get(machineIdentifier, self.tags.get(product, []))
+
+        return Policy(
+            markerGroups=tuple(markerGroups),
+            leftOffset=leftOffset,
+            rightOffset=rightOffset,
+            offsetTags=tuple(offsetTags) if offsetTags is not None else None,
+            tags=tuple(x.lower() for x in tags) if tags is not None else None,
+            modes=tuple(modes),
+            commandDelay=commandDelay,
+            allowSkipNext=allowSkipNext,
+            blockSkipNext=blockSkipNext,
+            playerTags=tuple(x.lower() for x in playerTags or [])
+        )
@@ -0,0 +1,120 @@
+import logging
+import time
+from collections import deque
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable, Deque, Dict, List
+from resources.log import getLogger
+
+
+SEEKCOMMAND = "seek"
+VOLUMECOMMAND = "volume"
+STEPCOMMAND = "step"
+
+
+class Command():
+    __slots__ = ("kind", "key", "function", "args", "queued")
+
+    def __init__(self, kind: str, key: str, function: Callable, args: tuple) -> None:
+        self.kind: str = kind
+        self.key: str = key
+        self.function: Callable = function
+        self.args: tuple = args
+        self.queued: float = time.monotonic()
+
+    def __repr__(self) -> str:
+        return "<Command:%s:%s>" % (self.kind, self.key)
+
+
+class CommandDispatcher():
+    # Commands for the same player run in order one at a time, different players run in parallel on a fixed pool
+    WORKERS = 4
+
+    def __init__(self, workers: int = WORKERS, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self._queues: Dict[str, Deque[Command]] = {}
+        self._ready: Queue = Queue()
+        self._lock: Lock = Lock()
+
+        self.dispatched: int = 0
+        self.coalesced: int = 0
+        self.waitTotal: float = 0.0
+        self.waitMax: float = 0.0
+        self.lastWait: float = 0.0
+
+        self.workers: int = max(workers, 1)
+        self._threads: List[Thread] = []
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in list(self._queues.values()))
+
+    @property
+    def waitAverage(self) -> float:
+        return self.waitTotal / self.dispatched if self.dispatched else 0.0
+
+    def depths(self) -> Dict[str, int]:
+        return {k: len(v) for k, v in list(self._queues.items())}
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "players": len(self._queues),
+            "depth": self.depth,
+            "dispatched": self.dispatched,
+            "coalesced": self.coalesced,
+            "waitAverage": self.waitAverage,
+            "waitMax": self.waitMax,
+            "lastWait": self.lastWait
+        }
+
+    def submit(self, clientIdentifier: str, kind: str, key: str, function: Callable, *args) -> None:
+        command = Command(kind, key, function, args)
+        with self._lock:
+            if not self._threads:
+                self._threads = [Thread(target=self._run, name="CommandDispatcher-%d" % (i), daemon=True) for i in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+            if self._enqueue(clientIdentifier, command):
+                self._ready.put(clientIdentifier)
+
+    def _enqueue(self, clientIdentifier: str, command: Command) -> bool:
+        # Returns True when the player had no pending or in-flight commands and needs to be scheduled
+        queue = self._queues.get(clientIdentifier)
+        if queue is None:
+            self._queues[clientIdentifier] = deque([command])
+            return True
+        # A queued command of the same kind for the same session is stale once a newer one arrives
+        stale = next((c for c in queue if c.kind == command.kind and c.key == command.key), None)
+        if stale:
+            queue.remove(stale)
+            self.coalesced += 1
+            self.log.debug("Dropping queued %s for player %s, superseded by a newer command" % (stale, clientIdentifier))
+        queue.append(command)
+        return False
+
+    def _dequeue(self, clientIdentifier: str) -> Command:
+        command = self._queues[clientIdentifier].popleft()
+        wait = time.monotonic() - command.queued
+        self.dispatched += 1
+        self.waitTotal += wait
+        self.waitMax = max(self.waitMax, wait)
+        self.lastWait = wait
+        return command
+
+    def _run(self) -> None:
+        while True:
+            clientIdentifier = self._ready.get()
+            with self._lock:
+                command = self._dequeue(clientIdentifier)
+
+            try:
+                command.function(*command.args)
+            except:
+                self.log.exception("Unhandled exception running %s for player %s" % (command, clientIdentifier))
+
+            with self._lock:
+                if self._queues[clientIdentifier]:
+                    self._ready.put(clientIdentifier)
+                else:
+                    del self._queues[clientIdentifier]
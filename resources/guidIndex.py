@@ -0,0 +1,223 @@
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import RLock
+from typing import Dict, Iterator, List, Tuple
+from xml.etree.ElementTree import Element
+from plexapi import utils
+from plexapi.server import PlexServer
+from resources.log import getLogger
+
+
+MOVIETYPE = 1
+SHOWTYPE = 2
+SEASONTYPE = 3
+EPISODETYPE = 4
+
+SECTIONTYPES = {
+    "movie": [MOVIETYPE],
+    "show": [SHOWTYPE, SEASONTYPE, EPISODETYPE]
+}
+
+
+class GuidIndex():
+    # SQLite copy of GUIDs, ratingKeys and season/episode numbers kept in the config directory, refreshed per library
+    # section with updatedAt so warm starts only pull what changed since the last run
+    FILENAME = "guids.db"
+    PAGE_SIZE = 1000
+    SCHEMA = 1
+    CLOCK_SKEW = 300
+
+    def __init__(self, server: PlexServer, path: str, readOnly: bool = False, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.path: str = os.path.join(path, self.FILENAME) if os.path.isdir(path) else path
+        self._lock: RLock = RLock()
+        if readOnly:
+            # Lookups only, batch workers share the file with the process that refreshed it and must never write to it
+            self._db: sqlite3.Connection = sqlite3.connect("%s?mode=ro" % (Path(os.path.abspath(self.path)).as_uri()), uri=True, check_same_thread=False)
+        else:
+            self._db: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._create()
+
+    def _create(self) -> None:
+        with self._lock, self._db:
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.SCHEMA:
+                self._db.executescript("""
+                    DROP TABLE IF EXISTS items;
+                    DROP TABLE IF EXISTS guids;
+                    DROP TABLE IF EXISTS sections;
+                """)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    ratingKey INTEGER PRIMARY KEY,
+                    section INTEGER NOT NULL,
+                    type INTEGER NOT NULL,
+                    parentRatingKey INTEGER,
+                    grandparentRatingKey INTEGER,
+                    parentIndex INTEGER,
+                    itemIndex INTEGER,
+                    updatedAt INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS items_parent ON items (parentRatingKey, itemIndex);
+                CREATE INDEX IF NOT EXISTS items_grandparent ON items (grandparentRatingKey, parentIndex, itemIndex);
+                CREATE INDEX IF NOT EXISTS items_section ON items (section, type);
+                CREATE TABLE IF NOT EXISTS guids (
+                    guid TEXT NOT NULL,
+                    ratingKey INTEGER NOT NULL,
+                    PRIMARY KEY (guid, ratingKey)
+                );
+                CREATE INDEX IF NOT EXISTS guids_ratingkey ON guids (ratingKey);
+                CREATE TABLE IF NOT EXISTS sections (
+                    section INTEGER PRIMARY KEY,
+                    uuid TEXT,
+                    refreshed INTEGER
+                );
+            """)
+            self._db.execute("PRAGMA user_version = %d" % (self.SCHEMA))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def refresh(self) -> None:
+        started = time.monotonic()
+        sections = [s for s in self.server.library.sections() if s.type in SECTIONTYPES]
+        for section in sections:
+            try:
+                self.refreshSection(int(section.key), section.uuid, SECTIONTYPES[section.type])
+            except:
+                self.log.exception("Unable to refresh GUID index for library section %s" % (section.title))
+        with self._lock, self._db:
+            known = [str(int(s.key)) for s in sections]
+            self._db.execute("DELETE FROM guids WHERE ratingKey IN (SELECT ratingKey FROM items WHERE section NOT IN (%s))" % (",".join(known) or "NULL"))
+            self._db.execute("DELETE FROM items WHERE section NOT IN (%s)" % (",".join(known) or "NULL"))
+            self._db.execute("DELETE FROM sections WHERE section NOT IN (%s)" % (",".join(known) or "NULL"))
+        self.log.debug("GUID index refreshed with %d items in %.2f seconds" % (len(self), time.monotonic() - started))
+
+    def refreshSection(self, section: int, uuid: str, types: List[int]) -> None:
+        with self._lock:
+            row = self._db.execute("SELECT uuid, refreshed FROM sections WHERE section = ?", (section,)).fetchone()
+        since = row[1] if row and row[0] == uuid else None
+        started = int(time.time())
+
+        updated = 0
+        if since is not None:
+            # Item count and newest updatedAt both match when nothing was added, edited or removed since the last refresh
+            states = {t: self.serverState(section, t) for t in types}
+            changed = [t for t in types if states[t] != self.localState(section, t)]
+            updated = sum(self.pull(section, t, since) for t in changed)
+            # updatedAt can't express deletions, a removed item is left over as an extra row once the changes are pulled
+            if any(states[t][0] != self.localState(section, t)[0] for t in changed):
+                self.log.debug("GUID index for library section %d is out of sync, rebuilding" % (section))
+                since = None
+
+        if since is None:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM guids WHERE ratingKey IN (SELECT ratingKey FROM items WHERE section = ?)", (section,))
+                self._db.execute("DELETE FROM items WHERE section = ?", (section,))
+            updated = sum(self.pull(section, t) for t in types)
+
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?, ?)", (section, uuid, started))
+        self.log.debug("GUID index %s library section %d, %d items updated" % ("refreshed" if since else "rebuilt", section, updated))
+
+    @staticmethod
+    def itemRow(section: int, itemType: int, element: Element) -> Tuple:
+        def integer(name: str) -> int:
+            value = element.attrib.get(name)
+            return int(value) if value not in (None, "") else None
+        return (integer("ratingKey"), section, itemType, integer("parentRatingKey"), integer("grandparentRatingKey"), integer("parentIndex"), integer("index"), integer("updatedAt"))
+
+    def pull(self, section: int, itemType: int, since: int = None) -> int:
+        updated = 0
+        for page in self.fetch(section, itemType, since):
+            with self._lock, self._db:
+                self._db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [self.itemRow(section, itemType, e) for e in page])
+                self._db.executemany("DELETE FROM guids WHERE ratingKey = ?", [(int(e.attrib["ratingKey"]),) for e in page])
+                self._db.executemany("INSERT OR IGNORE INTO guids VALUES (?, ?)", [(g.attrib["id"], int(e.attrib["ratingKey"])) for e in page for g in e.iter("Guid") if g.attrib.get("id")])
+            updated += len(page)
+        return updated
+
+    def serverState(self, section: int, itemType: int) -> Tuple[int, int]:
+        # (item count, newest updatedAt) from a single item request sorted by updatedAt
+        data = self.server.query("/library/sections/%d/all%s" % (section, utils.joinArgs({"type": itemType, "sort": "updatedAt:desc"})), params={"X-Plex-Container-Start": 0, "X-Plex-Container-Size": 1})
+        newest = next((e for e in data if e.attrib.get("ratingKey")), None)
+        updatedAt = newest.attrib.get("updatedAt") if newest is not None else None
+        return int(data.attrib.get("totalSize", data.attrib.get("size", 0))), int(updatedAt) if updatedAt else None
+
+    def localState(self, section: int, itemType: int) -> Tuple[int, int]:
+        with self._lock:
+            return tuple(self._db.execute("SELECT COUNT(*), MAX(updatedAt) FROM items WHERE section = ? AND type = ?", (section, itemType)).fetchone())
+
+    def fetch(self, section: int, itemType: int, since: int = None) -> Iterator[List[Element]]:
+        args = {"type": itemType, "includeGuids": 1}
+        key = "/library/sections/%d/all%s" % (section, utils.joinArgs(args))
+        if since:
+            key = "%s&updatedAt>>=%d" % (key, since - self.CLOCK_SKEW)
+        start = 0
+        while True:
+            data = self.server.query(key, params={"X-Plex-Container-Start": start, "X-Plex-Container-Size": self.PAGE_SIZE})
+            page = [e for e in data if e.attrib.get("ratingKey")] if data is not None else []
+            if page:
+                yield page
+            start += self.PAGE_SIZE
+            if len(page) < self.PAGE_SIZE or start >= int(data.attrib.get("totalSize", 0) or 0):
+                break
+
+    def lookup(self, guid: str) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT g.ratingKey FROM guids g JOIN items i ON i.ratingKey = g.ratingKey WHERE g.guid = ? AND i.type IN (?, ?) ORDER BY g.ratingKey", (guid, MOVIETYPE, SHOWTYPE))]
+
+    def resolve(self, key: str) -> int:
+        # Accepts guid, guid.season and guid.season.episode, matching CustomEntries.resolveGuidToKey
+        k = str(key).split(".")
+        with self._lock:
+            base = self._db.execute("SELECT i.ratingKey, i.type FROM guids g JOIN items i ON i.ratingKey = g.ratingKey WHERE g.guid = ? AND i.type IN (?, ?) ORDER BY i.ratingKey LIMIT 1", (k[0], MOVIETYPE, SHOWTYPE)).fetchone()
+            if not base:
+                return None
+            ratingKey, itemType = base
+            try:
+                if len(k) == 2 and itemType == SHOWTYPE:
+                    row = self._db.execute("SELECT ratingKey FROM items WHERE parentRatingKey = ? AND type = ? AND itemIndex = ?", (ratingKey, SEASONTYPE, int(k[1]))).fetchone()
+                    return row[0] if row else None
+                elif len(k) == 3 and itemType == SHOWTYPE:
+                    row = self._db.execute("SELECT ratingKey FROM items WHERE grandparentRatingKey = ? AND type = ? AND parentIndex = ? AND itemIndex = ?", (ratingKey, EPISODETYPE, int(k[1]), int(k[2]))).fetchone()
+                    return row[0] if row else None
+            except ValueError:
+                return None
+            return ratingKey
+
+    def guidFor(self, ratingKey: int, prefix: str = "tmdb://") -> str:
+        # Reverse of resolve, episodes and seasons are expressed through their show GUID like CustomEntries.keyToGuid
+        with self._lock:
+            item = self._db.execute("SELECT type, parentRatingKey, grandparentRatingKey, parentIndex, itemIndex FROM items WHERE ratingKey = ?", (int(ratingKey),)).fetchone()
+            if not item:
+                return None
+            itemType, parentRatingKey, grandparentRatingKey, parentIndex, itemIndex = item
+            base = grandparentRatingKey if itemType == EPISODETYPE else parentRatingKey if itemType == SEASONTYPE else int(ratingKey)
+            row = self._db.execute("SELECT guid FROM guids WHERE ratingKey = ? AND guid LIKE ? ORDER BY guid LIMIT 1", (base, prefix + "%")).fetchone()
+        if not row:
+            return None
+        # Unmatched items and specials can be missing season/episode numbers
+        if (itemType == EPISODETYPE and (parentIndex is None or itemIndex is None)) or (itemType == SEASONTYPE and itemIndex is None):
+            return None
+        if itemType == EPISODETYPE:
+            return "%s.%d.%d" % (row[0], parentIndex, itemIndex)
+        elif itemType == SEASONTYPE:
+            return "%s.%d" % (row[0], itemIndex)
+        return row[0]
+
+    def guids(self, ratingKeys: List[int]) -> Dict[int, List[str]]:
+        found: Dict[int, List[str]] = {}
+        with self._lock:
+            for ratingKey, guid in self._db.execute("SELECT ratingKey, guid FROM guids WHERE ratingKey IN (%s)" % (",".join(str(int(r)) for r in ratingKeys) or "NULL")):
+                found.setdefault(ratingKey, []).append(guid)
+        return found
@@ -0,0 +1,59 @@
+from bisect import bisect_right
+from heapq import heappop, heappush
+from typing import List
+
+
+class Interval():
+    __slots__ = ("start", "end", "target", "priority", "label", "kind")
+
+    def __init__(self, start: int, end: int, target: int, priority: int, label: str, kind: str = None) -> None:
+        self.start: int = start
+        self.end: int = end
+        self.target: int = target
+        self.priority: int = priority
+        self.label: str = label
+        # Marker type, chapter title or "custom" without per item detail, used to group stats
+        self.kind: str = kind or label
+
+    def __repr__(self) -> str:
+        return "%s with range %d-%d" % (self.label, self.start, self.end)
+
+
+class IntervalIndex():
+    # Flattens possibly overlapping intervals into sorted, non-overlapping segments that each resolve to the
+    # highest priority (lowest value) interval covering them so lookups are a single bisect
+    def __init__(self, intervals: List[Interval] = None) -> None:
+        intervals = [i for i in (intervals or []) if i.start < i.end]
+        self.intervals: List[Interval] = intervals
+        self.bounds: List[int] = []
+        self.winners: List[Interval] = []
+
+        # Sweep the boundaries once, intervals enter a heap ordered by (priority, position) as they start and
+        # leave lazily once the top has ended, so ties still go to the earlier interval
+        pending = sorted(range(len(intervals)), key=lambda n: intervals[n].start)
+        active = []
+        nextPending = 0
+        points = sorted(set(p for i in intervals for p in (i.start, i.end)))
+        for point in points:
+            while nextPending < len(pending) and intervals[pending[nextPending]].start <= point:
+                n = pending[nextPending]
+                heappush(active, (intervals[n].priority, n))
+                nextPending += 1
+            while active and intervals[active[0][1]].end <= point:
+                heappop(active)
+            winner = intervals[active[0][1]] if active else None
+            if self.winners and self.winners[-1] is winner:
+                continue
+            self.bounds.append(point)
+            self.winners.append(winner)
+
+    def __len__(self) -> int:
+        return len(self.intervals)
+
+    def find(self, offset: int) -> Interval:
+        index = bisect_right(self.bounds, offset) - 1
+        return self.winners[index] if index >= 0 else None
+
+    def next(self, offset: int) -> int:
+        index = bisect_right(self.bounds, offset)
+        return self.bounds[index] if index < len(self.bounds) else None
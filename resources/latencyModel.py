@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+from typing import Dict
+from plexapi.client import PlexClient
+from resources.settings import Settings
+from resources.log import getLogger
+
+
+PRODUCTS = "products"
+DEVICES = "devices"
+
+
+class Estimate():
+    __slots__ = ("lead", "rtt", "samples")
+
+    def __init__(self, lead: float = 0.0, rtt: float = 0.0, samples: int = 0) -> None:
+        self.lead: float = lead
+        self.rtt: float = rtt
+        self.samples: int = samples
+
+    def toJson(self) -> dict:
+        return {"lead": round(self.lead, 1), "rtt": round(self.rtt, 1), "samples": self.samples}
+
+
+class LatencyModel():
+    # Smoothed seek latency per device with the product as a fallback, learned from where seeks land in the alerts
+    # that follow them. Kept as JSON in the config directory, not .json so it isn't read as custom entries
+    FILENAME = "latency.cache"
+    ALPHA = 0.2
+    MIN_SAMPLES = 3
+    MAX_LEAD = 2000
+    SAVE_INTERVAL = 60
+
+    def __init__(self, path: str, alpha: float = ALPHA, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.path: str = os.path.join(path, self.FILENAME) if os.path.isdir(path) else path
+        self.alpha: float = alpha
+        self._estimates: Dict[str, Dict[str, Estimate]] = {PRODUCTS: {}, DEVICES: {}}
+        self._lock: Lock = Lock()
+        self._dirty: bool = False
+        self._saved: float = time.monotonic()
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            for group in self._estimates:
+                for key, value in data.get(group, {}).items():
+                    self._estimates[group][key] = Estimate(float(value.get("lead", 0)), float(value.get("rtt", 0)), int(value.get("samples", 0)))
+            self.log.debug("Loaded seek latency estimates for %d devices and %d products" % (len(self._estimates[DEVICES]), len(self._estimates[PRODUCTS])))
+        except:
+            self.log.exception("Unable to load seek latency estimates from %s, starting fresh" % (self.path))
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._saved < self.SAVE_INTERVAL):
+                return
+            data = {group: {k: v.toJson() for k, v in estimates.items()} for group, estimates in self._estimates.items()}
+            self._dirty = False
+            self._saved = time.monotonic()
+        try:
+            Settings.writeAtomic(json.dumps(data, indent=4).encode('utf-8'), self.path)
+        except (OSError, IOError):
+            self.log.exception("Unable to save seek latency estimates to %s" % (self.path))
+
+    def _update(self, player: PlexClient, field: str, value: float) -> None:
+        value = min(max(value, 0.0), self.MAX_LEAD)
+        with self._lock:
+            for group, key in [(DEVICES, player.machineIdentifier), (PRODUCTS, player.product)]:
+                if not key:
+                    continue
+                estimate = self._estimates[group].setdefault(key, Estimate())
+                if field == "lead":
+                    estimate.lead = value if not estimate.samples else estimate.lead + self.alpha * (value - estimate.lead)
+                    estimate.samples += 1
+                else:
+                    estimate.rtt = value if not estimate.rtt else estimate.rtt + self.alpha * (value - estimate.rtt)
+            self._dirty = True
+        self.save()
+
+    def command(self, player: PlexClient, elapsed: float) -> None:
+        # Round trip of the seek command itself in milliseconds
+        self._update(player, "rtt", elapsed)
+
+    def landed(self, player: PlexClient, latency: float) -> None:
+        # Time between issuing a seek and the player actually playing from the target, derived from the next alert
+        self._update(player, "lead", latency)
+        self.log.debug("Seek latency sample %dms for %s %s, lead now %dms" % (latency, player.product, player.machineIdentifier, self.lead(player)))
+
+    def estimate(self, player: PlexClient) -> Estimate:
+        device = self._estimates[DEVICES].get(player.machineIdentifier)
+        if device and device.samples >= self.MIN_SAMPLES:
+            return device
+        product = self._estimates[PRODUCTS].get(player.product)
+        if product and product.samples >= self.MIN_SAMPLES:
+            return product
+        return device or product
+
+    def lead(self, player: PlexClient) -> int:
+        # Milliseconds to fire a seek ahead of a boundary, falls back to half the command round trip until seeks are measured
+        estimate = self.estimate(player) if player else None
+        if not estimate:
+            return 0
+        if estimate.samples >= self.MIN_SAMPLES:
+            return int(estimate.lead)
+        return int(estimate.rtt / 2)
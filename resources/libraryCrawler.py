@@ -0,0 +1,67 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import Dict, List, Tuple
+from plexapi.library import LibrarySection
+from plexapi.server import PlexServer
+from resources.log import getLogger
+
+
+class LibraryCrawler():
+    # Pages through every library section in parallel, shows also pull their seasons and episodes as bulk section
+    # listings instead of one request per show
+    WORKERS = 8
+    PAGE_SIZE = 500
+    SECTIONTYPES = {
+        "show": ["show", "season", "episode"]
+    }
+
+    def __init__(self, server: PlexServer, workers: int = WORKERS, pageSize: int = PAGE_SIZE, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.workers: int = max(workers, 1)
+        self.pageSize: int = pageSize
+        self._lock: Lock = Lock()
+        self.crawled: int = 0
+        self.total: int = 0
+
+    def pages(self, sections: List[LibrarySection]) -> List[Tuple[LibrarySection, str, int]]:
+        pages = []
+        for section in sections:
+            for libtype in self.SECTIONTYPES.get(section.type, [None]):
+                size = section.totalViewSize(libtype=libtype, includeCollections=False) or 0
+                self.total += size
+                pages.extend((section, libtype, start) for start in range(0, size, self.pageSize))
+        return pages
+
+    def fetchPage(self, section: LibrarySection, libtype: str, start: int) -> list:
+        items = section.search(libtype=libtype, container_start=start, container_size=self.pageSize, maxresults=self.pageSize)
+        with self._lock:
+            self.crawled += len(items)
+        return items
+
+    def crawl(self) -> list:
+        started = time.monotonic()
+        sections = self.server.library.sections()
+        pages = self.pages(sections)
+        self.log.debug("Crawling %d items from %d library sections in %d pages with %d workers" % (self.total, len(sections), len(pages), self.workers))
+
+        items = []
+        lastReport = started
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="LibraryCrawler") as executor:
+            futures = {executor.submit(self.fetchPage, *page): page for page in pages}
+            for future in as_completed(futures):
+                section, libtype, start = futures[future]
+                try:
+                    items.extend(future.result())
+                except:
+                    self.log.exception("Unable to crawl %s items %d-%d from library section %s" % (libtype or "all", start, start + self.pageSize, section.title))
+                if time.monotonic() - lastReport > 5:
+                    lastReport = time.monotonic()
+                    self.log.info("Crawled %d/%d library items (%.0f%%)" % (self.crawled, self.total, (self.crawled / self.total) * 100 if self.total else 100))
+        self.log.debug("Finished crawling %d library items in %.2f seconds" % (len(items), time.monotonic() - started))
+        return items
+
+    def ratingKeys(self) -> Dict[int, object]:
+        return {item.ratingKey: item for item in self.crawl() if hasattr(item, "ratingKey")}
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Tuple
+from xml.etree.ElementTree import Element
+from plexapi import utils
+from plexapi.library import LibrarySection
+from plexapi.server import PlexServer
+from resources.guidIndex import GuidIndex, MOVIETYPE, EPISODETYPE
+from resources.mediaWrapper import STARTKEY, ENDKEY, TYPEKEY
+from resources.settings import Settings
+from resources.log import getLogger
+
+
+JSONL = ".jsonl"
+
+
+class MarkerExporter():
+    # Streams markers and chapters for whole library sections from paged listings instead of loading every item
+    PAGE_SIZE = 500
+    SECTIONTYPES = {
+        "movie": MOVIETYPE,
+        "show": EPISODETYPE
+    }
+
+    def __init__(self, server: PlexServer, tags: List[str], guidIndex: GuidIndex = None, useGuid: bool = False, pageSize: int = PAGE_SIZE, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.tags: List[str] = tags
+        self.guidIndex: GuidIndex = guidIndex
+        self.useGuid: bool = useGuid
+        self.pageSize: int = pageSize
+        self._showGuids: Dict[int, List[str]] = {}
+
+        self.exported: int = 0
+        self.populated: int = 0
+
+    def sections(self, identifier: str = None) -> List[LibrarySection]:
+        sections = [s for s in self.server.library.sections() if s.type in self.SECTIONTYPES]
+        if not identifier or identifier.lower() == "all":
+            return sections
+        return [s for s in sections if str(s.key) == str(identifier) or s.title.lower() == identifier.lower()]
+
+    def fetch(self, section: LibrarySection) -> Iterator[List[Element]]:
+        args = {"type": self.SECTIONTYPES[section.type], "includeMarkers": 1, "includeChapters": 1}
+        if self.useGuid and self.guidIndex is None:
+            args["includeGuids"] = 1
+        key = "/library/sections/%s/all%s" % (section.key, utils.joinArgs(args))
+        start = 0
+        while True:
+            data = self.server.query(key, params={"X-Plex-Container-Start": start, "X-Plex-Container-Size": self.pageSize})
+            page = [e for e in data if e.attrib.get("ratingKey")] if data is not None else []
+            if page:
+                yield page
+            start += self.pageSize
+            if len(page) < self.pageSize or start >= int(data.attrib.get("totalSize", 0) or 0):
+                break
+
+    def markers(self, element: Element) -> List[dict]:
+        markers = []
+        for m in element.iter("Marker"):
+            if m.attrib.get("type") and m.attrib["type"].lower() in self.tags:
+                markers.append({
+                    STARTKEY: utils.cast(int, m.attrib.get("startTimeOffset")),
+                    ENDKEY: utils.cast(int, m.attrib.get("endTimeOffset")),
+                    TYPEKEY: m.attrib["type"]
+                })
+        for c in element.iter("Chapter"):
+            if c.attrib.get("tag") and c.attrib["tag"].lower() in self.tags:
+                markers.append({
+                    STARTKEY: utils.cast(int, c.attrib.get("startTimeOffset")),
+                    ENDKEY: utils.cast(int, c.attrib.get("endTimeOffset")),
+                    TYPEKEY: c.attrib["tag"]
+                })
+        return markers
+
+    def showGuids(self, ratingKey: int) -> List[str]:
+        if ratingKey not in self._showGuids:
+            try:
+                self._showGuids[ratingKey] = [g.id for g in self.server.fetchItem(ratingKey).guids]
+            except:
+                self.log.exception("Unable to load GUIDs for show %d" % (ratingKey))
+                self._showGuids[ratingKey] = []
+        return self._showGuids[ratingKey]
+
+    def key(self, element: Element, prefix: str = "tmdb://") -> str:
+        ratingKey = int(element.attrib["ratingKey"])
+        if not self.useGuid:
+            return str(ratingKey)
+        if self.guidIndex is not None:
+            return self.guidIndex.guidFor(ratingKey, prefix) or str(ratingKey)
+        if element.attrib.get("type") == "episode":
+            guid = next((g for g in self.showGuids(int(element.attrib["grandparentRatingKey"])) if g.startswith(prefix)), None)
+            if guid and element.attrib.get("parentIndex") and element.attrib.get("index"):
+                return "%s.%s.%s" % (guid, element.attrib["parentIndex"], element.attrib["index"])
+        else:
+            guid = next((g.attrib["id"] for g in element.iter("Guid") if g.attrib.get("id", "").startswith(prefix)), None)
+            if guid:
+                return guid
+        self.log.debug("No %s GUID found for %d, using ratingKey" % (prefix, ratingKey))
+        return str(ratingKey)
+
+    def entries(self, identifier: str = None) -> Iterator[Tuple[str, List[dict]]]:
+        sections = self.sections(identifier)
+        if not sections:
+            self.log.error("No movie or show library sections found matching %s" % (identifier))
+        for section in sections:
+            started = time.monotonic()
+            count = 0
+            for page in self.fetch(section):
+                for element in page:
+                    markers = self.markers(element)
+                    self.exported += 1
+                    self.populated += 1 if markers else 0
+                    count += 1
+                    yield self.key(element), markers
+            self.log.info("Exported %d items from library section %s in %.2f seconds" % (count, section.title, time.monotonic() - started))
+
+    def export(self, path: str, identifier: str = None) -> None:
+        # Streamed to a temporary file and swapped in at the end, memory use stays flat regardless of library size
+        with Settings.openAtomic(path, 'w', encoding='utf-8') as f:
+            if os.path.splitext(path)[1] == JSONL:
+                self.writeJsonLines(f, identifier)
+            else:
+                self.writeCustom(f, identifier)
+        total = self.exported
+        self.log.info("%d total entries, %d populated, %d empty (%.0f%%) written to %s" % (total, self.populated, total - self.populated, (self.populated / total) * 100 if total else 0, path))
+
+    def writeJsonLines(self, f, identifier: str = None) -> None:
+        for key, markers in self.entries(identifier):
+            f.write(json.dumps({"key": key, "markers": markers}) + "\n")
+
+    def writeCustom(self, f, identifier: str = None) -> None:
+        f.write('{\n    "markers": {')
+        first = True
+        for key, markers in self.entries(identifier):
+            f.write("%s\n        %s: %s" % ("" if first else ",", json.dumps(key), json.dumps(markers)))
+            first = False
+        f.write("\n    }")
+        for k, v in Settings.CUSTOM_DEFAULTS.items():
+            if k != "markers":
+                f.write(",\n    %s: %s" % (json.dumps(k), json.dumps(v)))
+        f.write("\n}\n")
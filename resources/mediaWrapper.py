@@ -1,5 +1,6 @@
 import logging
-from datetime import datetime
+import time
+from contextlib import contextmanager
 from plexapi import media, utils
 from plexapi.video import Episode, Movie
 from plexapi.server import PlexServer
@@ -8,19 +9,18 @@ from plexapi.client import PlexClient
 from plexapi.base import PlexSession
 from plexapi.myplex import MyPlexAccount
 from plexapi.exceptions import NotFound
-from resources.customEntries import CustomEntries
+from resources.customEntries import CustomEntries, Policy, RATINGKEY, STARTKEY, ENDKEY, TAGKEY
 from resources.settings import Settings
 from resources.log import getLogger
-from typing import TypeVar, List
+from resources.playerDirectory import PlayerDirectory
+from resources.intervals import Interval, IntervalIndex
+from typing import Iterator, TypeVar, List, Tuple
 from math import floor
 
 
 Media = TypeVar("Media", Episode, Movie)
 
-STARTKEY = "start"
-ENDKEY = "end"
 TYPEKEY = "type"
-TAGKEY = "tags"
 
 CUSTOMTAG = "custom"
 
@@ -117,11 +117,11 @@ class MediaWrapper():
 
     DEFAULT_CLIENT_PORT = 32500
 
-    def __init__(self, session: PlexSession, clientIdentifier: str, state: str, playQueueID: int, server: PlexServer, settings: Settings, custom: CustomEntries = None, logger: logging.Logger = None) -> None:
+    def __init__(self, session: PlexSession, clientIdentifier: str, state: str, playQueueID: int, server: PlexServer, settings: Settings, custom: CustomEntries = None, logger: logging.Logger = None, players: PlayerDirectory = None, source: Media = None) -> None:
         self._viewOffset: int = session.viewOffset
         self.plexsession: PlexSession = session
         self.server: PlexServer = server
-        self.media: Media = session.source()
+        self.media: Media = source if source and source.ratingKey == session.ratingKey else session.source()
 
         self.clientIdentifier = clientIdentifier
         self.state: str = state
@@ -129,12 +129,16 @@ class MediaWrapper():
         self.playQueueID: int = playQueueID
         self.player: PlexClient = session.player
 
-        self.lastUpdate: datetime = datetime.now()
-        self.lastAlert: datetime = datetime.now()
-        self.lastSeek: datetime = datetime(1970, 1, 1)
+        # Monotonic so viewOffset extrapolation is immune to wall clock adjustments
+        self.lastUpdate: float = time.monotonic()
+        self.lastAlert: float = time.monotonic()
+        self.lastSeek: float = 0.0
 
         self.seekTarget: int = 0
         self.seekOrigin: int = 0
+        self.seekExact: int = 0
+        self.landed: float = None
+        self.rejected: Tuple[int, str, float] = None
 
         self.markers: List[Marker] = []
         self.chapters: List[Chapter] = []
@@ -149,9 +153,14 @@ class MediaWrapper():
         self.commandDelay: int = 0
 
         self.tags: List[str] = settings.tags
+        self.playerTags: List[str] = []
+        self.policy: Policy = None
 
         self.log = logger or getLogger(__name__)
-        self.customMarkers = []
+
+        self.settings: Settings = settings
+        self.skipIntervals: IntervalIndex = IntervalIndex()
+        self.volumeIntervals: IntervalIndex = IntervalIndex()
 
         self.mode: Settings.MODE_TYPES = settings.mode
 
@@ -165,7 +174,6 @@ class MediaWrapper():
         except NotFound:
             self.userToken: str = None
 
-        client = next((c for c in server.clients() if c.machineIdentifier == self.player.machineIdentifier), None)
         if custom and self.player.title in custom.clients:
             if custom.clients[self.player.title] == "proxy":
                 self.player.proxyThroughServer(True, server)
@@ -184,106 +192,82 @@ class MediaWrapper():
                 self.player._baseurl = self.player._baseurl if self.player._baseurl.startswith("http://") else "http://%s" % (self.player._baseurl)
                 self.player.proxyThroughServer(False)
                 self.log.debug("Overriding player %s with custom baseURL %s, will not proxy through server" % (self.clientIdentifier, self.player._baseurl))
-        elif not client or (client.address == self.player.address and "playback" in client.protocolCapabilities):
-            # If there is no client, direct connect. If there is a client but its IP address matches the device IP, still direct connect. In devices that are proxy dependent 127.0.0.1 will usually be reported
-            port = int(self.server._myPlexClientPorts().get(self.player.machineIdentifier, self.CLIENT_PORTS.get(self.player.product, self.DEFAULT_CLIENT_PORT)))
-            baseurl = "http://%s:%d" % (self.player.address, port)
-            self.player._baseurl = baseurl
-            self.player.proxyThroughServer(False)
         else:
-            self.player.proxyThroughServer(True, server)
+            baseurl = (players or PlayerDirectory(server, logger=self.log)).connection(self.player, self.CLIENT_PORTS.get(self.player.product, self.DEFAULT_CLIENT_PORT))
+            if baseurl:
+                self.player._baseurl = baseurl
+                self.player.proxyThroughServer(False)
+            else:
+                self.player.proxyThroughServer(True, server)
 
-        if custom:
-            if hasattr(self.media, GRANDPARENTRATINGKEY):
-                if str(self.media.grandparentRatingKey) in custom.markers:
-                    for markerdata in custom.markers[str(self.media.grandparentRatingKey)]:
-                        try:
-                            cm = CustomMarker(markerdata, self.media.grandparentRatingKey, self.media.duration, settings.mode)
-                            if cm not in self.customMarkers:
-                                self.customMarkers.append(cm)
-                        except CustomMarker.CustomMarkerException:
-                            self.log.error("Invalid CustomMarker data for grandparentRatingKey %s" % (self.media.grandparentRatingKey))
-                        except CustomMarker.CustomMarkerDurationException:
-                            self.log.error("Invalid CustomMarker data for grandparentRatingKey %s, negative value start/end but API not reporting duration" % (self.media.grandparentRatingKey))
-                if str(self.media.grandparentRatingKey) in custom.offsets:
-                    self.leftOffset = custom.offsets[str(self.media.grandparentRatingKey)].get(STARTKEY, self.leftOffset)
-                    self.rightOffset = custom.offsets[str(self.media.grandparentRatingKey)].get(ENDKEY, self.rightOffset)
-                    self.offsetTags = custom.offsets[str(self.media.grandparentRatingKey)].get(TAGKEY, self.offsetTags)
-                if str(self.media.grandparentRatingKey) in custom.tags:
-                    self.tags = custom.tags[str(self.media.grandparentRatingKey)]
-                if str(self.media.grandparentRatingKey) in custom.mode:
-                    self.mode = Settings.MODE_MATCHER.get(custom.mode[str(self.media.grandparentRatingKey)], self.mode)
+        if not hasattr(self.media, 'markers') and not self.customOnly:
+            # Allow markers to be loaded on non-standard media (currently only loaded for episodes)
+            try:
+                self.media.markers = self.media.findItems(self.media._data, media.Marker)
+            except:
+                self.log.debug("Exception trying to load markers on non-standard media")
+
+        if hasattr(self.media, 'chapters') and not self.customOnly and len(self.media.chapters) > 0:
+            self.lastchapter = self.media.chapters[-1]
 
+        self.applyCustom(custom)
+
+    def applyCustom(self, custom: CustomEntries = None) -> None:
+        # Resolve settings and custom entries onto the already loaded media, rerun on config reloads without refetching
+        settings = self.settings
+        self.customMarkers = []
+        self.leftOffset = 0
+        self.rightOffset = 0
+        self.offsetTags = settings.offsetTags
+        self.commandDelay = 0
+        self.tags = settings.tags
+        self.mode = settings.mode
+        self.skipnext = settings.skipnext
+
+        self.policy = None
+        self.playerTags = []
+        if custom:
+            if settings.guidmatching == "session":
+                custom.matchGuids(self.media)
+            ratingKeys = [(GRANDPARENTRATINGKEY, self.media.grandparentRatingKey)] if hasattr(self.media, GRANDPARENTRATINGKEY) else []
             if hasattr(self.media, PARENTRATINGKEY):
-                if str(self.media.parentRatingKey) in custom.markers:
+                ratingKeys.append((PARENTRATINGKEY, self.media.parentRatingKey))
+            ratingKeys.append((RATINGKEY, self.media.ratingKey))
+            self.policy = custom.policy(ratingKeys, self.player.title, self.clientIdentifier, self.player.machineIdentifier, self.player.product)
+
+            for group in self.policy.markerGroups:
+                if group.level != GRANDPARENTRATINGKEY:
                     filtered = [x for x in self.customMarkers if x.cascade]
                     if self.customMarkers != filtered:
-                        self.log.debug("Better parentRatingKey markers found, clearing %d previous marker(s)" % (len(self.customMarkers) - len(filtered)))
+                        self.log.debug("Better %s markers found, clearing %d previous marker(s)" % (group.level, len(self.customMarkers) - len(filtered)))
                         self.customMarkers = filtered
-                    for markerdata in custom.markers[str(self.media.parentRatingKey)]:
-                        try:
-                            cm = CustomMarker(markerdata, self.media.parentRatingKey, self.media.duration, settings.mode)
-                            if cm not in self.customMarkers:
-                                self.log.debug("Found custom marker range %s entry for %s (parentRatingKey match)" % (cm, self))
-                                self.customMarkers.append(cm)
-                        except CustomMarker.CustomMarkerException:
-                            self.log.error("Invalid CustomMarker data for parentRatingKey %s" % (self.media.parentRatingKey))
-                        except CustomMarker.CustomMarkerDurationException:
-                            self.log.error("Invalid CustomMarker data for parentRatingKey %s, negative value start/end but API not reporting duration" % (self.media.parentRatingKey))
-                if str(self.media.parentRatingKey) in custom.offsets:
-                    self.leftOffset = custom.offsets[str(self.media.parentRatingKey)].get(STARTKEY, self.leftOffset)
-                    self.rightOffset = custom.offsets[str(self.media.parentRatingKey)].get(ENDKEY, self.rightOffset)
-                    self.offsetTags = custom.offsets[str(self.media.parentRatingKey)].get(TAGKEY, self.offsetTags)
-                if str(self.media.parentRatingKey) in custom.tags:
-                    self.tags = custom.tags[str(self.media.parentRatingKey)]
-                if str(self.media.parentRatingKey) in custom.mode:
-                    self.mode = Settings.MODE_MATCHER.get(custom.mode[str(self.media.parentRatingKey)], self.mode)
-
-            if str(self.media.ratingKey) in custom.markers:
-                filtered = [x for x in self.customMarkers if x.cascade]
-                if self.customMarkers != filtered:
-                    self.log.debug("Better ratingKey markers found, clearing %d previous marker(s)" % (len(self.customMarkers) - len(filtered)))
-                    self.customMarkers = filtered
-                for markerdata in custom.markers[str(self.media.ratingKey)]:
+                for markerdata in group.markers:
                     try:
-                        cm = CustomMarker(markerdata, self.media.ratingKey, self.media.duration, settings.mode)
+                        cm = CustomMarker(markerdata, group.ratingKey, self.media.duration, settings.mode)
                         if cm not in self.customMarkers:
-                            self.log.debug("Found custom marker range %s entry for %s" % (cm, self))
+                            if group.level != GRANDPARENTRATINGKEY:
+                                self.log.debug("Found custom marker range %s entry for %s (%s match)" % (cm, self, group.level))
                             self.customMarkers.append(cm)
                     except CustomMarker.CustomMarkerException:
-                        self.log.error("Invalid CustomMarker data for ratingKey %s" % (self.media.ratingKey))
+                        self.log.error("Invalid CustomMarker data for %s %s" % (group.level, group.ratingKey))
                     except CustomMarker.CustomMarkerDurationException:
-                        self.log.error("Invalid CustomMarker data for ratingKey %s, negative value start/end but API not reporting duration" % (self.media.ratingKey))
-            if str(self.media.ratingKey) in custom.offsets:
-                self.leftOffset = custom.offsets[str(self.media.ratingKey)].get(STARTKEY, self.leftOffset)
-                self.rightOffset = custom.offsets[str(self.media.ratingKey)].get(ENDKEY, self.rightOffset)
-                self.offsetTags = custom.offsets[str(self.media.ratingKey)].get(TAGKEY, self.offsetTags)
-            if str(self.media.ratingKey) in custom.tags:
-                self.tags = custom.tags[str(self.media.ratingKey)]
-            if str(self.media.ratingKey) in custom.mode:
-                self.mode = Settings.MODE_MATCHER.get(custom.mode[str(self.media.ratingKey)], self.mode)
-
-            if self.player.title in custom.mode:
-                self.mode = Settings.MODE_MATCHER.get(custom.mode[self.player.title], self.mode)
-            elif self.clientIdentifier in custom.mode:
-                self.mode = Settings.MODE_MATCHER.get(custom.mode[self.clientIdentifier], self.mode)
-
-            if self.player.title in custom.offsets:
-                self.commandDelay = custom.offsets[self.player.title].get("command", self.commandDelay)
-            elif self.clientIdentifier in custom.offsets:
-                self.commandDelay = custom.offsets[self.clientIdentifier].get("command", self.commandDelay)
-
-            if not self.skipnext and custom.allowedSkipNext and (self.player.title in custom.allowedSkipNext or self.clientIdentifier in custom.allowedSkipNext):
-                self.skipnext = True
-            elif self.skipnext and custom.allowedSkipNext and (self.player.title not in custom.allowedSkipNext and self.clientIdentifier not in custom.allowedSkipNext):
-                self.skipnext = False
-            elif self.skipnext and custom.blockedSkipNext and (self.player.title in custom.blockedSkipNext or self.clientIdentifier in custom.blockedSkipNext):
-                self.skipnext = False
-
-            self.tags = [x.lower() for x in self.tags]
-            self.playerTags = custom.tags.get(self.player.machineIdentifier, custom.tags.get(self.player.product, []))
+                        self.log.error("Invalid CustomMarker data for %s %s, negative value start/end but API not reporting duration" % (group.level, group.ratingKey))
+
+            if self.policy.leftOffset is not None:
+                self.leftOffset = self.policy.leftOffset
+            if self.policy.rightOffset is not None:
+                self.rightOffset = self.policy.rightOffset
+            if self.policy.offsetTags is not None:
+                self.offsetTags = list(self.policy.offsetTags)
+            if self.policy.tags is not None:
+                self.tags = list(self.policy.tags)
+            for mode in self.policy.modes:
+                self.mode = Settings.MODE_MATCHER.get(mode, self.mode)
+            self.commandDelay = self.policy.commandDelay
+            self.skipnext = not self.policy.blockSkipNext if self.skipnext else self.policy.allowSkipNext
+
+            self.playerTags = list(self.policy.playerTags)
             if self.playerTags:
-                self.playerTags = [x.lower() for x in self.playerTags]
                 self.log.debug("Found a special set of tags %s for player %s %s, filtering tags" % (self.playerTags, self.player.product, self.player.machineIdentifier))
                 self.tags = [x for x in self.tags if x in self.playerTags]
 
@@ -302,22 +286,12 @@ class MediaWrapper():
             if self.skipnext != settings.skipnext:
                 self.log.debug("Custom skipNext value of %s found for %s" % (self.skipnext, self))
 
-        if not hasattr(self.media, 'markers') and not self.customOnly:
-            # Allow markers to be loaded on non-standard media (currently only loaded for episodes)
-            try:
-                self.media.markers = self.media.findItems(self.media._data, media.Marker)
-            except:
-                self.log.debug("Exception trying to load markers on non-standard media")
-
         if self.playerTags:
             self.log.debug("Filtering custom markers based on playerTags %s, add 'custom' or a specified 'type' to the definition to keep them" % (self.playerTags))
             self.customMarkers = [x for x in self.customMarkers if x.type.lower() in self.playerTags]
 
         self.updateMarkers()
 
-        if hasattr(self.media, 'chapters') and not self.customOnly and len(self.media.chapters) > 0:
-            self.lastchapter = self.media.chapters[-1]
-
     def updateMarkers(self) -> None:
         if hasattr(self.media, 'markers') and not self.customOnly:
             self.markers = [x for x in self.media.markers if x.type and (x.type.lower() in self.tags or "%s:%s" % (MARKERPREFIX, x.type.lower()) in self.tags)]
@@ -325,6 +299,47 @@ class MediaWrapper():
         if hasattr(self.media, 'chapters') and not self.customOnly:
             self.chapters = [x for x in self.media.chapters if x.title and (x.title.lower() in self.tags or "%s:%s" % (CHAPTERPREFIX, x.title.lower()) in self.tags)]
 
+        self.updateIntervals()
+
+    def updateIntervals(self) -> None:
+        # Resolve offsets, modes and targets once so the skip/volume checks are a bisect per tick
+        leftOffset = self.leftOffset or self.settings.leftOffset
+        rightOffset = self.rightOffset or self.settings.rightOffset
+        skipLastChapter = self.settings.skiplastchapter and self.lastchapter and self.media.duration and (self.lastchapter.start / self.media.duration) > self.settings.skiplastchapter
+
+        skip: List[Interval] = []
+        volume: List[Interval] = []
+
+        for marker in self.customMarkers:
+            label = "custom marker (%s)" % (marker.key)
+            if marker.mode == Settings.MODE_TYPES.SKIP:
+                skip.append(Interval(marker.start, rd(marker.end), marker.end, len(skip), label, marker.type.lower()))
+            elif marker.mode == Settings.MODE_TYPES.VOLUME:
+                volume.append(Interval(marker.start, marker.end, marker.end, len(volume), label, marker.type.lower()))
+
+        if self.mode == Settings.MODE_TYPES.SKIP:
+            if skipLastChapter:
+                skip.append(Interval(self.lastchapter.start, rd(self.lastchapter.end), self.media.duration, len(skip), "last chapter", "lastchapter"))
+            for chapter in self.chapters:
+                skip.append(Interval(chapter.start, rd(chapter.end), chapter.end, len(skip), "chapter %s" % (chapter.title), chapter.title.lower()))
+            for marker in self.markers:
+                lo = leftOffset if marker.type.lower() in self.offsetTags else 0
+                ro = rightOffset if marker.type.lower() in self.offsetTags else 0
+                start = marker.start if marker.start < lo else (marker.start + lo)
+                skip.append(Interval(start, rd(marker.end), marker.end + ro, len(skip), "marker %s" % (marker.type), marker.type.lower()))
+        elif self.mode == Settings.MODE_TYPES.VOLUME:
+            if skipLastChapter:
+                volume.append(Interval(self.lastchapter.start, self.lastchapter.end + 1, self.lastchapter.end, len(volume), "last chapter", "lastchapter"))
+            for chapter in self.chapters:
+                volume.append(Interval(chapter.start, chapter.end, chapter.end, len(volume), "chapter %s" % (chapter.title), chapter.title.lower()))
+            for marker in self.markers:
+                lo = leftOffset if marker.type.lower() in self.offsetTags else 0
+                ro = rightOffset if marker.type.lower() in self.offsetTags else 0
+                volume.append(Interval(marker.start + lo, marker.end + ro, marker.end + ro, len(volume), "marker %s" % (marker.type), marker.type.lower()))
+
+        self.skipIntervals = IntervalIndex(skip)
+        self.volumeIntervals = IntervalIndex(volume)
+
     def __repr__(self) -> str:
         base = "%d [%d]" % (self.plexsession.sessionKey, self.media.ratingKey)
         if hasattr(self.media, "title"):
@@ -351,55 +366,86 @@ class MediaWrapper():
 
     @property
     def sinceLastUpdate(self) -> float:
-        return (datetime.now() - self.lastUpdate).total_seconds()
+        return time.monotonic() - self.lastUpdate
 
     @property
     def sinceLastAlert(self) -> float:
-        return (datetime.now() - self.lastAlert).total_seconds()
+        return time.monotonic() - self.lastAlert
 
     @property
     def viewOffset(self) -> int:
         if self.state != PLAYINGKEY:
             return self._viewOffset
-        vo = self._viewOffset + round((datetime.now() - self.lastUpdate).total_seconds() * 1000)
+        vo = self._viewOffset + round((time.monotonic() - self.lastUpdate) * 1000)
         return vo if vo <= (self.media.duration or vo) else self.media.duration
 
     def seekTo(self, offset: int, player: PlexClient) -> None:
+        with self.seekCommand(offset):
+            player.seekTo(offset)
+
+    @contextmanager
+    def seekCommand(self, offset: int) -> Iterator[None]:
+        # Session bookkeeping around sending a seek command, shared by the threaded and asyncio engines
+        self.beginSeek(offset)
+        yield
+        self.plexsession.viewOffset = offset
+
+    def beginSeek(self, offset: int) -> None:
         self.plexsession.viewOffset = self.viewOffset
         self.seekOrigin = rd(self._viewOffset)
         self.seekTarget = rd(offset)
-        self.lastUpdate = datetime.now()
+        self.seekExact = offset
+        self.lastUpdate = time.monotonic()
+        self.lastSeek = self.lastUpdate
+        self.rejected = None
         self._viewOffset = offset
-        player.seekTo(offset)
-        self.plexsession.viewOffset = offset
 
     def badSeek(self) -> None:
         self.state = BUFFERINGKEY
         self._viewOffset = self.plexsession.viewOffset
         # self.seekOrigin = 0
         # self.seekTarget = 0
-        self.lastUpdate = datetime.now()
+        self.lastUpdate = time.monotonic()
+
+    def abandonSeek(self) -> bool:
+        # Falls back to the latest alert rejected while seeking, False when nothing has contradicted the seek
+        if not self.seeking or not self.rejected:
+            return False
+        offset, state, received = self.rejected
+        self.state = state
+        self.seekOrigin = 0
+        self.seekTarget = 0
+        self.rejected = None
+        self._viewOffset = offset
+        self.plexsession.viewOffset = offset
+        self.lastUpdate = received
+        return True
 
     def updateOffset(self, offset: int, state: str) -> None:
-        self.lastAlert = datetime.now()
+        self.lastAlert = time.monotonic()
 
         if self.seeking:
             if self.seekOrigin < offset < self.seekTarget or state in [PAUSEDKEY, STOPPEDKEY]:
                 self.log.debug("Rejecting %d [%s] update session %s, alert is out of date" % (offset, state, self))
+                self.rejected = (offset, state, self.lastAlert)
                 return
             elif offset < self.seekOrigin:
                 self.log.debug("Seeking but new offset is earlier than the old one for session %s [%s], updating data and assuming user manual seek" % (self, state))
             else:
                 self.log.debug("Recent seek successful, server offset update %d meets/exceeds target %d [%s]" % (offset, self.seekTarget, state))
+                if state == PLAYINGKEY and self.lastSeek:
+                    # Playing from seekExact since the player acted on the command, whatever is missing is latency
+                    self.landed = (self.lastAlert - self.lastSeek) * 1000 - (offset - self.seekExact)
 
-        self.log.debug("Updating session %s [%s] viewOffset %d, old %d, diff %dms (%ds since last update)" % (self, state, offset, self.viewOffset, (offset - self.viewOffset), (datetime.now() - self.lastUpdate).total_seconds()))
+        self.log.debug("Updating session %s [%s] viewOffset %d, old %d, diff %dms (%ds since last update)" % (self, state, offset, self.viewOffset, (offset - self.viewOffset), self.sinceLastUpdate))
 
         self.state = state
         self.seekOrigin = 0
         self.seekTarget = 0
+        self.rejected = None
         self._viewOffset = offset
         self.plexsession.viewOffset = offset
-        self.lastUpdate = datetime.now()
+        self.lastUpdate = time.monotonic()
         if not self.ended and state in [PAUSEDKEY, STOPPEDKEY] and offset >= rd(self.media.duration * DURATION_TOLERANCE):
             self.ended = True
 
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import re
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from socket import timeout
+from threading import Lock
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import urlsplit
+from requests import Response, Session
+from requests.exceptions import Timeout
+from urllib3.exceptions import ReadTimeoutError
+from plexapi.client import PlexClient
+from resources.log import getLogger
+
+
+ENDPOINT = "endpoint"
+PLAYER = "player"
+CALL = "call"
+SKIP = "skip"
+
+TIMEOUTS = (Timeout, ReadTimeoutError, timeout, asyncio.TimeoutError)
+TARGETHEADER = "X-Plex-Target-Client-Identifier"
+
+
+class Histogram():
+    # Fixed millisecond buckets, observe is a bisect and a few increments under the histogram's own lock since
+    # response hooks, player commands and the scheduler record from different threads
+    BOUNDS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    __slots__ = ("counts", "count", "total", "max", "errors", "timeouts", "lock")
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(self.BOUNDS) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.errors: int = 0
+        self.timeouts: int = 0
+        self.lock: Lock = Lock()
+
+    def observe(self, elapsed: float) -> None:
+        index = bisect_left(self.BOUNDS, elapsed)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+
+    def error(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+    def timeout(self) -> None:
+        with self.lock:
+            self.timeouts += 1
+
+    def copy(self) -> 'Histogram':
+        # Consistent point in time view for readers, buckets always add up to count
+        histogram = Histogram()
+        with self.lock:
+            histogram.counts = list(self.counts)
+            histogram.count = self.count
+            histogram.total = self.total
+            histogram.max = self.max
+            histogram.errors = self.errors
+            histogram.timeouts = self.timeouts
+        return histogram
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        # Upper bound of the bucket holding the pth observation, never more than the largest value seen
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(float(self.BOUNDS[index]), self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def toJson(self) -> dict:
+        histogram = self.copy()
+        return {
+            "count": histogram.count,
+            "errors": histogram.errors,
+            "timeouts": histogram.timeouts,
+            "average": round(histogram.average, 1),
+            "p50": histogram.percentile(0.5),
+            "p95": histogram.percentile(0.95),
+            "p99": histogram.percentile(0.99),
+            "max": round(histogram.max, 1),
+            "buckets": dict(zip([str(b) for b in histogram.BOUNDS] + ["+Inf"], histogram.counts))
+        }
+
+
+class Metrics():
+    # Latency histograms with error/timeout counts per server endpoint, per player and per call site. Fed by a
+    # requests response hook on the PlexAPI session plus timed() around the calls that matter
+    IDPATTERN = re.compile(r"/\d+(?=/|$)")
+
+    def __init__(self, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._lock: Lock = Lock()
+        self._counterLock: Lock = Lock()
+        self.started: float = time.monotonic()
+
+    def histogram(self, category: str, name: str) -> Histogram:
+        key = (category, name)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def histograms(self, category: str = None) -> Dict[Tuple[str, str], Histogram]:
+        return {k: v for k, v in list(self._histograms.items()) if category is None or k[0] == category}
+
+    def observe(self, category: str, name: str, elapsed: float) -> None:
+        self.histogram(category, name).observe(elapsed)
+
+    def increment(self, name: str, label: str = "", amount: int = 1) -> None:
+        key = (name, label)
+        with self._counterLock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counters(self, name: str) -> Dict[str, int]:
+        with self._counterLock:
+            return {k[1]: v for k, v in self._counters.items() if k[0] == name}
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        # Numeric path segments collapse so ratingKeys/playQueueIDs don't create a histogram each
+        return Metrics.IDPATTERN.sub("/{id}", urlsplit(url).path) or "/"
+
+    def instrument(self, session: Session) -> None:
+        if self.responseHook not in session.hooks.setdefault('response', []):
+            session.hooks['response'].append(self.responseHook)
+
+    def responseHook(self, response: Response, *args, **kwargs) -> Response:
+        elapsed = response.elapsed.total_seconds() * 1000
+        endpoint = self.endpoint(response.url)
+        histogram = self.histogram(ENDPOINT, endpoint)
+        histogram.observe(elapsed)
+        if response.status_code >= 400:
+            histogram.error()
+        player = response.request.headers.get(TARGETHEADER) if response.request is not None else None
+        if player:
+            histogram = self.histogram(PLAYER, player)
+            histogram.observe(elapsed)
+            if response.status_code >= 400:
+                histogram.error()
+        return response
+
+    @contextmanager
+    def timed(self, name: str, player: PlexClient = None) -> Iterator[None]:
+        histograms = [self.histogram(CALL, name)]
+        if player is not None:
+            histograms.append(self.histogram(CALL, "%s:%s" % (name, player.product)))
+        started = time.monotonic()
+        try:
+            yield
+        except TIMEOUTS:
+            for histogram in histograms:
+                histogram.timeout()
+            raise
+        except:
+            for histogram in histograms:
+                histogram.error()
+            raise
+        finally:
+            elapsed = (time.monotonic() - started) * 1000
+            for histogram in histograms:
+                histogram.observe(elapsed)
+
+    def snapshot(self) -> dict:
+        data = {"uptime": round(time.monotonic() - self.started, 1)}
+        for (category, name), histogram in sorted(self.histograms().items()):
+            data.setdefault(category, {})[name] = histogram.toJson()
+        return data
+
+    def report(self) -> None:
+        self.log.info("Latency report after %d seconds (milliseconds, p50/p95/p99/max)" % (time.monotonic() - self.started))
+        for (category, name), histogram in sorted(self.histograms().items()):
+            histogram = histogram.copy()
+            self.log.info("%s %s: %d calls, %d errors, %d timeouts, avg %.1f, %.0f/%.0f/%.0f/%.0f" % (category, name, histogram.count, histogram.errors, histogram.timeouts, histogram.average, histogram.percentile(0.5), histogram.percentile(0.95), histogram.percentile(0.99), histogram.max))
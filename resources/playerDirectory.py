@@ -0,0 +1,136 @@
+import logging
+import time
+from threading import Lock, Thread
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+from plexapi import utils
+from plexapi.server import PlexServer
+from plexapi.client import PlexClient
+from resources.metrics import TARGETHEADER
+from resources.log import getLogger
+
+
+def commandRequest(player: PlexClient, command: str, **params) -> Tuple[str, Dict[str, str]]:
+    # URL and headers PlexClient.sendCommand would request, direct to the player or proxied through the server. Keeps the
+    # private PlexAPI request helpers in one place for callers that send commands with their own HTTP client
+    params['commandID'] = player._nextCommandId()
+    key = "/player/%s%s" % (command.strip("/"), utils.joinArgs(params))
+    headers = {TARGETHEADER: player.machineIdentifier}
+    if player._proxyThroughServer:
+        return player._server.url(key), player._server._headers(**headers)
+    return player.url(key), dict(player._headers(), **headers)
+
+
+class PlayerEntry():
+    __slots__ = ("machineIdentifier", "address", "port", "protocolCapabilities")
+
+    def __init__(self, client: PlexClient) -> None:
+        self.machineIdentifier: str = client.machineIdentifier
+        self.address: str = client.address
+        # PlexClient doesn't keep the port attribute from /clients, it is only part of the baseurl built from it
+        self.port: str = str(urlsplit(client._baseurl).port or "") if client._baseurl else None
+        self.protocolCapabilities: List[str] = list(client.protocolCapabilities or [])
+
+    def __repr__(self) -> str:
+        return "<PlayerEntry:%s:%s:%s>" % (self.machineIdentifier, self.address, self.port)
+
+
+class PlayerDirectory():
+    # Caches server.clients() and plex.tv client ports, stale data is served while a background refresh runs
+    TTL = 300
+    MISS_REFRESH = 10
+    # After a failed fetch callers go without the data for a while instead of each retrying the request inline
+    FAILURE_BACKOFF = 30
+
+    def __init__(self, server: PlexServer, ttl: float = TTL, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.ttl: float = ttl
+
+        self._clients: Dict[str, PlayerEntry] = {}
+        self._ports: Dict[str, str] = {}
+        self._fetched: Dict[str, float] = {}
+        self._failed: Dict[str, float] = {}
+        self._refreshing: set = set()
+        self._decisions: Dict[str, Tuple[str, str, str]] = {}
+        self._lock: Lock = Lock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def _fetchClients(self) -> None:
+        self._clients = {c.machineIdentifier: PlayerEntry(c) for c in self.server.clients()}
+
+    def _fetchPorts(self) -> None:
+        self._ports = dict(self.server._myPlexClientPorts())
+
+    def _refresh(self, kind: str, fetch) -> None:
+        try:
+            fetch()
+            self._fetched[kind] = time.monotonic()
+            self._failed.pop(kind, None)
+            self.log.debug("Refreshed player directory %s" % (kind))
+        except:
+            self._failed[kind] = time.monotonic()
+            self.log.exception("Unable to refresh player directory %s, retrying in %d seconds" % (kind, self.FAILURE_BACKOFF))
+        finally:
+            with self._lock:
+                self._refreshing.discard(kind)
+
+    def _ensure(self, kind: str, fetch, force: bool = False) -> None:
+        now = time.monotonic()
+        if now - self._failed.get(kind, float("-inf")) < self.FAILURE_BACKOFF:
+            return
+        age = now - self._fetched.get(kind, float("-inf"))
+        if force or kind not in self._fetched:
+            with self._lock:
+                self._refreshing.add(kind)
+            self._refresh(kind, fetch)
+        elif age > self.ttl:
+            with self._lock:
+                if kind in self._refreshing:
+                    return
+                self._refreshing.add(kind)
+            Thread(target=self._refresh, args=(kind, fetch), name="PlayerDirectory-%s" % (kind), daemon=True).start()
+
+    def age(self, kind: str) -> float:
+        return time.monotonic() - self._fetched.get(kind, float("-inf"))
+
+    def client(self, machineIdentifier: str) -> PlayerEntry:
+        self._ensure("clients", self._fetchClients)
+        entry = self._clients.get(machineIdentifier)
+        if not entry and self.age("clients") > self.MISS_REFRESH:
+            self._ensure("clients", self._fetchClients, force=True)
+            entry = self._clients.get(machineIdentifier)
+        return entry
+
+    def port(self, machineIdentifier: str) -> str:
+        self._ensure("ports", self._fetchPorts)
+        return self._ports.get(machineIdentifier)
+
+    def connection(self, player: PlexClient, defaultPort: int) -> str:
+        # Returns the direct baseurl for a player or None when commands should be proxied through the server
+        with self._lock:
+            decision = self._decisions.get(player.machineIdentifier)
+        if decision and decision[0] == player.address and decision[1] == player.product and self.age("clients") <= self.ttl:
+            self.hits += 1
+            return decision[2]
+        self.misses += 1
+
+        client = self.client(player.machineIdentifier)
+        baseurl = None
+        if not client or (client.address == player.address and "playback" in client.protocolCapabilities):
+            # If there is no client, direct connect. If there is a client but its IP address matches the device IP, still direct connect. In devices that are proxy dependent 127.0.0.1 will usually be reported
+            # plex.tv knows the port of remote-capable players, /clients the one of local players, the default otherwise
+            port = int(self.port(player.machineIdentifier) or (client.port if client else None) or defaultPort)
+            baseurl = "http://%s:%d" % (player.address, port)
+        with self._lock:
+            self._decisions[player.machineIdentifier] = (player.address, player.product, baseurl)
+        return baseurl
+
+    def invalidate(self, machineIdentifier: str) -> None:
+        self.log.debug("Invalidating player directory entry for %s" % (machineIdentifier))
+        with self._lock:
+            self._decisions.pop(machineIdentifier, None)
+        self._clients.pop(machineIdentifier, None)
+        self._fetched.pop("clients", None)
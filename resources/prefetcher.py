@@ -0,0 +1,115 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import List, Set
+from plexapi.playqueue import PlayQueue
+from plexapi.server import PlexServer
+from resources.customEntries import CustomEntries
+from resources.mediaWrapper import Media, MediaWrapper
+from resources.settings import Settings
+from resources.showCache import ShowCache, LIBRARYIDENTIFIER
+from resources.log import getLogger
+
+
+class Prefetcher():
+    # Loads the next PlayQueue item (or next episode of the show) with its markers and chapters while the current one
+    # plays, MediaWrapper takes it from here instead of calling session.source() when that item starts
+    CAP = 50
+    WORKERS = 2
+
+    def __init__(self, server: PlexServer, settings: Settings, shows: ShowCache, cap: int = CAP, workers: int = WORKERS, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.settings: Settings = settings
+        self.shows: ShowCache = shows
+        self.cap: int = cap
+        self._items: OrderedDict = OrderedDict()
+        self._pending: Set[int] = set()
+        self._lock: Lock = Lock()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max(workers, 1), thread_name_prefix="Prefetcher")
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, ratingKey: int) -> Media:
+        with self._lock:
+            media = self._items.pop(int(ratingKey), None)
+        if media:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return media
+
+    def put(self, media: Media) -> None:
+        with self._lock:
+            self._items.pop(media.ratingKey, None)
+            self._items[media.ratingKey] = media
+            while len(self._items) > self.cap:
+                self._items.popitem(last=False)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._items.clear()
+
+    def invalidate(self, ratingKey: int) -> None:
+        with self._lock:
+            self._items.pop(int(ratingKey), None)
+
+    def processTimeline(self, entries: List[dict]) -> None:
+        # Library updates to a prefetched item (new markers from analysis etc) drop it so it is loaded fresh
+        for entry in entries:
+            if entry.get('identifier') == LIBRARYIDENTIFIER and 'itemID' in entry:
+                self.invalidate(entry['itemID'])
+
+    def prefetch(self, mediaWrapper: MediaWrapper, custom: CustomEntries = None) -> None:
+        ratingKey = mediaWrapper.media.ratingKey
+        with self._lock:
+            if ratingKey in self._pending:
+                return
+            self._pending.add(ratingKey)
+        try:
+            self._executor.submit(self._prefetch, mediaWrapper, custom)
+        except RuntimeError:
+            # Shut down by a config reload that turned prefetching off
+            with self._lock:
+                self._pending.discard(ratingKey)
+
+    def _prefetch(self, mediaWrapper: MediaWrapper, custom: CustomEntries = None) -> None:
+        try:
+            key = self.nextKey(mediaWrapper)
+            if key is None:
+                self.log.debug("No next item to prefetch for %s" % (mediaWrapper))
+                return
+            media = self.server.fetchItem(key)
+            if custom and self.settings.guidmatching == "session":
+                custom.matchGuids(media)
+            self.put(media)
+            self.log.debug("Prefetched next item %s for %s, cached: %d" % (media.ratingKey, mediaWrapper, len(self._items)))
+        except:
+            self.log.exception("Unable to prefetch next item for %s" % (mediaWrapper))
+        finally:
+            with self._lock:
+                self._pending.discard(mediaWrapper.media.ratingKey)
+
+    def nextKey(self, mediaWrapper: MediaWrapper) -> str:
+        # Details key of the item after the current one, includes markers and chapters like session.source()
+        media = mediaWrapper.media
+        if mediaWrapper.playQueueID:
+            try:
+                pq = PlayQueue.get(self.server, mediaWrapper.playQueueID)
+                keys = [x.ratingKey for x in pq.items]
+                if media.ratingKey in keys:
+                    index = keys.index(media.ratingKey)
+                    return pq.items[index + 1]._details_key if index + 1 < len(keys) else None
+            except:
+                self.log.debug("Unable to load PlayQueue %d for %s, falling back to show order" % (mediaWrapper.playQueueID, mediaWrapper))
+        if media.type == "episode":
+            ratingKey = self.shows.get(media.grandparentRatingKey).nextEpisode(media.ratingKey)
+            if ratingKey:
+                return media._buildDetailsKey().replace(media.key, "/library/metadata/%d" % (ratingKey), 1)
+        return None
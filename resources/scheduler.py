@@ -0,0 +1,57 @@
+import heapq
+import time
+from threading import Condition
+from typing import Dict, Hashable, List, Tuple
+from resources.metrics import Histogram
+
+
+class Scheduler():
+    COMPACT_RATIO = 4
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}
+        self._condition: Condition = Condition()
+        self._counter: int = 0
+        # How late due keys are handed out, in milliseconds
+        self.lag: Histogram = Histogram()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        deadline = time.monotonic() + max(delay, 0)
+        with self._condition:
+            self._deadlines[key] = deadline
+            self._counter += 1
+            heapq.heappush(self._heap, (deadline, self._counter, key))
+            # Superseded entries are dropped lazily when popped, compact if they start to pile up
+            if len(self._heap) > self.COMPACT_RATIO * max(len(self._deadlines), 1):
+                self._heap = [x for x in self._heap if self._deadlines.get(x[2]) == x[0]]
+                heapq.heapify(self._heap)
+            if self._heap[0][2] == key:
+                self._condition.notify_all()
+
+    def cancel(self, key: Hashable) -> None:
+        with self._condition:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key: Hashable) -> float:
+        return self._deadlines.get(key)
+
+    def wait(self, timeout: float) -> List[Hashable]:
+        end = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, _, key = heapq.heappop(self._heap)
+                    if self._deadlines.get(key) == deadline:
+                        del self._deadlines[key]
+                        due.append(key)
+                        self.lag.observe((now - deadline) * 1000)
+                if due or now >= end:
+                    return due
+                nextDeadline = self._heap[0][0] if self._heap else end
+                self._condition.wait(min(nextDeadline, end) - now)
@@ -0,0 +1,114 @@
+import logging
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Deque, Dict, List, NamedTuple, Tuple
+from resources.log import getLogger
+
+
+SEQUENCEKEY = "sequence"
+
+
+class Step(NamedTuple):
+    delay: float
+    label: str
+    function: Callable
+    args: tuple = ()
+
+
+class Sequence():
+    __slots__ = ("key", "origin", "steps", "cancelled", "running", "started")
+
+    def __init__(self, clientIdentifier: str, origin: str, steps: List[Step]) -> None:
+        self.key: Tuple[str, str] = (SEQUENCEKEY, clientIdentifier)
+        self.origin: str = origin
+        self.steps: Deque[Step] = deque(steps)
+        self.cancelled: bool = False
+        self.running: bool = False
+        self.started: float = time.monotonic()
+
+    @property
+    def clientIdentifier(self) -> str:
+        return self.key[1]
+
+    @property
+    def delay(self) -> float:
+        return self.steps[0].delay if self.steps else None
+
+    def __repr__(self) -> str:
+        return "<Sequence:%s:%s:%d steps>" % (self.clientIdentifier, self.origin, len(self.steps))
+
+
+class Sequencer():
+    # Player command sequences (stop -> wait -> play) as timed steps on the scheduler instead of sleeping workers,
+    # one sequence per player and a newer one or a cancel drops whatever steps are left
+    def __init__(self, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self._sequences: Dict[Tuple[str, str], Sequence] = {}
+        self._lock: Lock = Lock()
+
+        self.completed: int = 0
+        self.cancelled: int = 0
+
+    def __len__(self) -> int:
+        return len(self._sequences)
+
+    @staticmethod
+    def owns(key) -> bool:
+        return isinstance(key, tuple) and len(key) == 2 and key[0] == SEQUENCEKEY
+
+    def start(self, clientIdentifier: str, origin: str, steps: List[Step]) -> Sequence:
+        sequence = Sequence(clientIdentifier, origin, steps)
+        with self._lock:
+            previous = self._sequences.get(sequence.key)
+            if previous:
+                previous.cancelled = True
+                self.cancelled += 1
+                self.log.debug("Replacing pending %s with a newer sequence" % (previous))
+            self._sequences[sequence.key] = sequence
+        return sequence
+
+    def get(self, key: Tuple[str, str]) -> Sequence:
+        return self._sequences.get(key)
+
+    def pending(self, clientIdentifier: str) -> Sequence:
+        return self._sequences.get((SEQUENCEKEY, clientIdentifier))
+
+    def next(self, sequence: Sequence) -> Step:
+        with self._lock:
+            if sequence.cancelled or not sequence.steps:
+                return None
+            return sequence.steps.popleft()
+
+    def begin(self, sequence: Sequence) -> bool:
+        # A step only runs if the sequence wasn't cancelled before it started, checked under the same lock as cancel
+        with self._lock:
+            if sequence.cancelled:
+                return False
+            sequence.running = True
+            return True
+
+    def complete(self, sequence: Sequence, failed: bool = False) -> bool:
+        # Returns True when there are more steps to schedule, otherwise the sequence is done and dropped
+        with self._lock:
+            sequence.running = False
+            if failed:
+                sequence.cancelled = True
+            if not sequence.cancelled and sequence.steps:
+                return True
+            if self._sequences.get(sequence.key) is sequence:
+                del self._sequences[sequence.key]
+            if not sequence.cancelled:
+                self.completed += 1
+            return False
+
+    def cancel(self, clientIdentifier: str) -> Sequence:
+        with self._lock:
+            sequence = self._sequences.get((SEQUENCEKEY, clientIdentifier))
+            if not sequence or (sequence.running and not sequence.steps):
+                # Nothing to cancel when the last step is already being sent
+                return None
+            del self._sequences[sequence.key]
+            sequence.cancelled = True
+            self.cancelled += 1
+            return sequence
@@ -0,0 +1,70 @@
+import logging
+import time
+from threading import Condition
+from typing import Dict
+from plexapi.server import PlexServer
+from plexapi.base import PlexSession
+from resources.log import getLogger
+
+
+class SessionSnapshot():
+    # Shared /status/sessions view indexed by sessionKey, concurrent callers wait on a single in-flight request
+    TTL = 2.0
+
+    def __init__(self, server: PlexServer, ttl: float = TTL, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self.ttl: float = ttl
+
+        self._sessions: Dict[int, PlexSession] = {}
+        self._fetched: float = float("-inf")
+        self._inflight: bool = False
+        self._condition: Condition = Condition()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.fetches: int = 0
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._fetched
+
+    def get(self, sessionKey: int, since: float = None) -> PlexSession:
+        # since is a time.monotonic() value the snapshot must have been requested at or after, defaults to the TTL window.
+        # The snapshot returned is never older than since so a missing session is not in it and a refetch would not help
+        since = time.monotonic() - self.ttl if since is None else since
+        session = self.snapshot(since).get(sessionKey)
+        if session is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return session
+
+    def snapshot(self, since: float) -> Dict[int, PlexSession]:
+        # Sessions from a request made at or after since, waiting on or starting one as needed
+        with self._condition:
+            while self._fetched < since:
+                if not self._inflight:
+                    break
+                self._condition.wait()
+            else:
+                return self._sessions
+            self._inflight = True
+
+        started = time.monotonic()
+        sessions = None
+        try:
+            sessions = {s.sessionKey: s for s in self.server.sessions()}
+            self.fetches += 1
+            return sessions
+        finally:
+            with self._condition:
+                if sessions is not None and started > self._fetched:
+                    self._sessions = sessions
+                    self._fetched = started
+                self._inflight = False
+                self._condition.notify_all()
+
+    def invalidate(self) -> None:
+        with self._condition:
+            self._fetched = float("-inf")
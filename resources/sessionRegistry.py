@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+from threading import Lock, RLock
+from typing import Dict, Hashable, List, Set
+from resources.mediaWrapper import MediaWrapper
+
+
+class ExpiringSet():
+    # Bounded set where entries expire after ttl seconds, oldest entries are evicted first once cap is reached
+    def __init__(self, cap: int, ttl: float) -> None:
+        self.cap: int = cap
+        self.ttl: float = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            added = self._entries.get(key)
+            if added is None:
+                return False
+            if time.monotonic() - added > self.ttl:
+                del self._entries[key]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        # Includes expired entries not evicted yet, no lock so status reads never contend with add/contains
+        return len(self._entries)
+
+    def add(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.monotonic()
+            self._expire()
+            while len(self._entries) > self.cap:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        while self._entries:
+            key, added = next(iter(self._entries.items()))
+            if added > cutoff:
+                break
+            del self._entries[key]
+
+
+class SessionRegistry():
+    # Active MediaWrappers by pasIdentifier with secondary indexes by clientIdentifier and playQueueID
+    def __init__(self) -> None:
+        self._sessions: Dict[str, MediaWrapper] = {}
+        self._clients: Dict[str, Set[str]] = {}
+        self._playQueues: Dict[int, Set[str]] = {}
+        self._lock: RLock = RLock()
+
+    def __contains__(self, pasIdentifier: str) -> bool:
+        return pasIdentifier in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __getitem__(self, pasIdentifier: str) -> MediaWrapper:
+        return self._sessions[pasIdentifier]
+
+    def __setitem__(self, pasIdentifier: str, mediaWrapper: MediaWrapper) -> None:
+        with self._lock:
+            self.pop(pasIdentifier)
+            self._sessions[pasIdentifier] = mediaWrapper
+            self._clients.setdefault(mediaWrapper.clientIdentifier, set()).add(pasIdentifier)
+            self._playQueues.setdefault(mediaWrapper.playQueueID, set()).add(pasIdentifier)
+
+    def __delitem__(self, pasIdentifier: str) -> None:
+        if not self.pop(pasIdentifier):
+            raise KeyError(pasIdentifier)
+
+    def get(self, pasIdentifier: str) -> MediaWrapper:
+        return self._sessions.get(pasIdentifier)
+
+    def pop(self, pasIdentifier: str) -> MediaWrapper:
+        with self._lock:
+            mediaWrapper = self._sessions.pop(pasIdentifier, None)
+            if mediaWrapper:
+                self._unindex(self._clients, mediaWrapper.clientIdentifier, pasIdentifier)
+                self._unindex(self._playQueues, mediaWrapper.playQueueID, pasIdentifier)
+            return mediaWrapper
+
+    def _unindex(self, index: dict, key: Hashable, pasIdentifier: str) -> None:
+        members = index.get(key)
+        if members is not None:
+            members.discard(pasIdentifier)
+            if not members:
+                del index[key]
+
+    def values(self) -> List[MediaWrapper]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions.keys())
+
+    def byClient(self, clientIdentifier: str) -> List[MediaWrapper]:
+        with self._lock:
+            return [self._sessions[p] for p in self._clients.get(clientIdentifier, [])]
+
+    def byPlayQueue(self, playQueueID: int) -> List[MediaWrapper]:
+        with self._lock:
+            return [self._sessions[p] for p in self._playQueues.get(playQueueID, [])]
@@ -3,6 +3,11 @@ import os
 import logging
 import sys
 import json
+import stat
+import tempfile
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import IO, Dict, Iterator, Tuple
 from resources.customEntries import CustomEntries
 from resources.log import getLogger
 from enum import Enum
@@ -90,6 +95,21 @@ class Settings:
         "Volume": {
             "low": 0,
             "high": 100
+        },
+        "Performance": {
+            "engine": "threaded",
+            "session-cache": 2.0,
+            "player-cache": 300,
+            "watch-config": True,
+            "guid-index": True,
+            "guid-matching": "startup",
+            "prefetch": True,
+            "latency-compensation": True
+        },
+        "Status": {
+            "enabled": False,
+            "address": "127.0.0.1",
+            "port": 9180
         }
     }
 
@@ -123,6 +143,9 @@ class Settings:
         "mute": MODE_TYPES.VOLUME
     }
 
+    ENGINES = ["threaded", "asyncio"]
+    GUID_MATCHING = ["startup", "session"]
+
     class SKIP_TYPES(Enum):
         NEVER = 0
         WATCHED = 1
@@ -170,9 +193,22 @@ class Settings:
         self.rightOffset: int = 0
         self.offsetTags: list = []
         self.commandDelay: int = 0
+        self.engine: str = "threaded"
+        self.sessionttl: float = 2.0
+        self.playerttl: float = 300
+        self.watchconfig: bool = True
+        self.guidindex: bool = True
+        self.guidmatching: str = "startup"
+        self.prefetch: bool = True
+        self.latencycompensation: bool = True
+        self.status: bool = False
+        self.statusaddress: str = "127.0.0.1"
+        self.statusport: int = 9180
         self.customEntries: CustomEntries = None
 
         self._configFile: str = None
+        self._configStat: Tuple[float, int] = None
+        self._customFiles: Dict[str, Tuple[Tuple[float, int], dict]] = {}
 
         self.log.info(sys.executable)
         if sys.version_info.major == 2:
@@ -200,36 +236,103 @@ class Settings:
         if os.path.isfile(configFile):
             config.read(configFile)
 
-        write = False
-        # Make sure all sections and all keys for each section are present
+        if self.fillDefaults(config):
+            Settings.writeConfig(config, configFile, self.log)
+        self._configFile = configFile
+        self._configStat = Settings.fileStat(configFile)
+
+        self.readConfig(config)
+
+        if loadCustom:
+            self.customEntries = self.loadCustomEntries()
+
+    def fillDefaults(self, config: configparser.ConfigParser) -> bool:
+        # Make sure all sections and all keys for each section are present, returns whether anything was missing
+        missing = False
         for s in self.DEFAULTS:
             if not config.has_section(s):
                 config.add_section(s)
-                write = True
+                missing = True
             for k in self.DEFAULTS[s]:
                 if not config.has_option(s, k):
                     config.set(s, k, str(self.DEFAULTS[s][k]))
-                    write = True
-        if write:
-            Settings.writeConfig(config, configFile, self.log)
-        self._configFile = configFile
+                    missing = True
+        return missing
 
-        self.readConfig(config)
+    def isCustomFile(self, filename: str) -> bool:
+        return os.path.splitext(filename)[1] == os.path.splitext(self.CUSTOM_DEFAULT)[1]
 
-        if loadCustom:
-            data = {}
-            _, ext = os.path.splitext(self.CUSTOM_DEFAULT)
-            for root, _, files in os.walk(os.path.dirname(configFile)):
-                for filename in files:
-                    fullpath = os.path.join(root, filename)
-                    if os.path.isfile(fullpath) and os.path.splitext(filename)[1] == ext:
-                        Settings.merge(data, Settings.loadCustom(fullpath, self.log))
-                    else:
-                        continue
-            if not data:
-                Settings.merge(data, Settings.loadCustom(os.path.join(os.path.dirname(configFile), self.CUSTOM_DEFAULT), self.log))
-
-            self.customEntries = CustomEntries(data, self.log)
+    @property
+    def configFile(self) -> str:
+        return self._configFile
+
+    @property
+    def configDir(self) -> str:
+        return os.path.dirname(self._configFile)
+
+    @staticmethod
+    def fileStat(path: str) -> Tuple[float, int]:
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def customFiles(self) -> Dict[str, Tuple[float, int]]:
+        found = {}
+        for root, _, files in os.walk(self.configDir):
+            for filename in files:
+                fullpath = os.path.join(root, filename)
+                if self.isCustomFile(filename):
+                    stat = Settings.fileStat(fullpath)
+                    if stat:
+                        found[fullpath] = stat
+        return found
+
+    def loadCustomEntries(self) -> CustomEntries:
+        # Parsed files are cached by mtime/size so a reload only reparses what changed
+        files = self.customFiles()
+        cache = {}
+        for fullpath, stat in files.items():
+            cached = self._customFiles.get(fullpath)
+            if cached and cached[0] == stat:
+                cache[fullpath] = cached
+            else:
+                # loadCustom may write missing defaults back so stat afterwards
+                loaded = Settings.loadCustom(fullpath, self.log)
+                cache[fullpath] = (Settings.fileStat(fullpath), loaded)
+
+        data = {}
+        for fullpath in files:
+            Settings.merge(data, deepcopy(cache[fullpath][1]))
+        if not data:
+            fullpath = os.path.join(self.configDir, self.CUSTOM_DEFAULT)
+            loaded = Settings.loadCustom(fullpath, self.log)
+            cache[fullpath] = (Settings.fileStat(fullpath), loaded)
+            Settings.merge(data, deepcopy(loaded))
+        self._customFiles = cache
+        customEntries = CustomEntries(data, self.log)
+        if self.customEntries:
+            customEntries.version = self.customEntries.version + 1
+        return customEntries
+
+    def changed(self) -> Tuple[bool, bool]:
+        # (config.ini changed, custom JSON changed) since the last load
+        custom = {k: v[0] for k, v in self._customFiles.items()}
+        return Settings.fileStat(self._configFile) != self._configStat, self.customFiles() != custom
+
+    def reload(self) -> Tuple[bool, bool]:
+        configChanged, customChanged = self.changed()
+        if configChanged:
+            self.log.info("Reloading config file %s" % (self._configFile))
+            config: FancyConfigParser = FancyConfigParser()
+            config.read(self._configFile)
+            self.fillDefaults(config)
+            self._configStat = Settings.fileStat(self._configFile)
+            self.readConfig(config)
+        if customChanged and self.customEntries:
+            self.customEntries = self.loadCustomEntries()
+        return configChanged, customChanged
 
     @staticmethod
     def loadCustom(customFile: str, logger: logging.Logger = None) -> dict:
@@ -287,13 +390,40 @@ class Settings:
     def writeCustom(data: dict, cfgfile: str, logger: logging.Logger = None) -> None:
         log = logger or getLogger(__name__)
         try:
-            with open(cfgfile, 'w', encoding='utf-8') as cf:
-                json.dump(data, cf, indent=4)
+            Settings.writeAtomic(json.dumps(data, indent=4).encode('utf-8'), cfgfile)
         except PermissionError:
             log.exception("Error writing to %s due to permissions" % (cfgfile))
         except IOError:
             log.exception("Error writing to %s" % (cfgfile))
 
+    @staticmethod
+    def writeAtomic(content: bytes, path: str) -> None:
+        with Settings.openAtomic(path, 'wb') as f:
+            f.write(content)
+
+    @staticmethod
+    @contextmanager
+    def openAtomic(path: str, mode: str = 'wb', encoding: str = None) -> Iterator[IO]:
+        # Write to a temporary file next to the target and swap it in so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp = tempfile.mkstemp(prefix=".%s." % (os.path.basename(path)), suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, mode, encoding=encoding) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(temp, stat.S_IMODE(os.stat(path).st_mode))
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp, 0o666 & ~umask)
+            os.replace(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
     def readConfig(self, config: FancyConfigParser) -> None:
         self.username = config.get("Plex.tv", "username")
         self.password = config.get("Plex.tv", "password", raw=True)
@@ -350,6 +480,25 @@ class Settings:
             if v > 100:
                 v = 100
 
+        self.engine = config.get("Performance", "engine").lower().strip()
+        if self.engine not in self.ENGINES:
+            self.log.warning("Invalid engine %s, must be one of %s, using %s" % (self.engine, self.ENGINES, self.ENGINES[0]))
+            self.engine = self.ENGINES[0]
+        self.sessionttl = max(config.getfloat("Performance", "session-cache"), 0.0)
+        self.playerttl = max(config.getfloat("Performance", "player-cache"), 0.0)
+        self.watchconfig = config.getboolean("Performance", "watch-config")
+        self.guidindex = config.getboolean("Performance", "guid-index")
+        self.guidmatching = config.get("Performance", "guid-matching").lower().strip()
+        if self.guidmatching not in self.GUID_MATCHING:
+            self.log.warning("Invalid guid-matching %s, must be one of %s, using %s" % (self.guidmatching, self.GUID_MATCHING, self.GUID_MATCHING[0]))
+            self.guidmatching = self.GUID_MATCHING[0]
+        self.prefetch = config.getboolean("Performance", "prefetch")
+        self.latencycompensation = config.getboolean("Performance", "latency-compensation")
+
+        self.status = config.getboolean("Status", "enabled")
+        self.statusaddress = config.get("Status", "address").strip() or "127.0.0.1"
+        self.statusport = config.getint("Status", "port")
+
     @staticmethod
     def replaceWithGUIDs(data, server: PlexServer, ratingKeyLookup: dict, logger: logging.Logger = None) -> None:
         log = logger or getLogger(__name__)
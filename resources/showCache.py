@@ -0,0 +1,128 @@
+import logging
+from threading import RLock
+from typing import Dict, List, Tuple
+from plexapi.server import PlexServer
+from plexapi.video import Show
+from resources.log import getLogger
+
+
+LIBRARYIDENTIFIER = "com.plexapp.plugins.library"
+SHOWTYPE = 2
+SEASONTYPE = 3
+EPISODETYPE = 4
+DELETEDSTATE = 9
+
+
+class ShowStructure():
+    def __init__(self, show: Show) -> None:
+        self.ratingKey: int = show.ratingKey
+        self.updatedAt = show.updatedAt
+        self.leafCount: int = show.leafCount
+        self.dirty: bool = False
+
+        # Ordered (seasonNumber, episodeNumber, ratingKey) for every episode as the server sorts them
+        self.episodes: List[Tuple[int, int, int]] = []
+        self.seasons: List[int] = []
+        self.lastEpisodes: Dict[int, int] = {}
+        self.children: set = set()
+        self._positions: Dict[int, int] = {}
+
+        for episode in show.episodes():
+            self._positions[episode.ratingKey] = len(self.episodes)
+            self.episodes.append((episode.seasonNumber, episode.episodeNumber, episode.ratingKey))
+            if episode.seasonNumber not in self.lastEpisodes:
+                self.seasons.append(episode.seasonNumber)
+            self.lastEpisodes[episode.seasonNumber] = episode.episodeNumber
+            self.children.update([episode.ratingKey, episode.parentRatingKey])
+
+    @property
+    def lastSeason(self) -> int:
+        return self.seasons[-1] if self.seasons else None
+
+    def lastEpisode(self, seasonNumber: int) -> int:
+        return self.lastEpisodes.get(seasonNumber)
+
+    def nextEpisode(self, ratingKey: int) -> int:
+        position = self._positions.get(int(ratingKey))
+        if position is not None and position + 1 < len(self.episodes):
+            return self.episodes[position + 1][2]
+        return None
+
+    def stale(self, show: Show) -> bool:
+        return show.updatedAt != self.updatedAt or show.leafCount != self.leafCount
+
+    def __repr__(self) -> str:
+        return "<ShowStructure:%s:%d seasons:%d episodes>" % (self.ratingKey, len(self.seasons), len(self.episodes))
+
+
+class ShowCache():
+    # Lazily filled season/episode layout per show, invalidated by library timeline alerts
+    CAP = 500
+
+    def __init__(self, server: PlexServer, logger: logging.Logger = None) -> None:
+        self.log = logger or getLogger(__name__)
+        self.server: PlexServer = server
+        self._shows: Dict[int, ShowStructure] = {}
+        self._children: Dict[int, int] = {}
+        self._lock: RLock = RLock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._shows)
+
+    def get(self, ratingKey: int) -> ShowStructure:
+        ratingKey = int(ratingKey)
+        structure = self._shows.get(ratingKey)
+        if structure and structure.dirty:
+            show = self.server.fetchItem(ratingKey)
+            if structure.stale(show):
+                self.log.debug("Cached structure for show %s is out of date, reloading" % (ratingKey))
+                structure = self._load(show)
+            else:
+                structure.dirty = False
+        if structure:
+            self.hits += 1
+            return structure
+        self.misses += 1
+        return self._load(self.server.fetchItem(ratingKey))
+
+    def _load(self, show: Show) -> ShowStructure:
+        structure = ShowStructure(show)
+        with self._lock:
+            self.invalidate(show.ratingKey)
+            while len(self._shows) >= self.CAP:
+                self.invalidate(next(iter(self._shows)))
+            self._shows[structure.ratingKey] = structure
+            for child in structure.children:
+                self._children[child] = structure.ratingKey
+        self.log.debug("Cached show structure %s" % (structure))
+        return structure
+
+    def invalidate(self, ratingKey: int) -> None:
+        with self._lock:
+            structure = self._shows.pop(int(ratingKey), None)
+            if structure:
+                for child in structure.children:
+                    self._children.pop(child, None)
+
+    def processTimeline(self, entries: List[dict]) -> None:
+        for entry in entries:
+            if entry.get('identifier') != LIBRARYIDENTIFIER or 'itemID' not in entry:
+                continue
+            itemType = int(entry.get('type', 0))
+            itemID = int(entry['itemID'])
+            deleted = int(entry.get('state', 0)) == DELETEDSTATE
+            show = itemID if itemType == SHOWTYPE else self._children.get(itemID) if itemType in [SEASONTYPE, EPISODETYPE] else None
+            structure = self._shows.get(show)
+            if structure:
+                if deleted:
+                    self.log.debug("Timeline deletion of %s belonging to show %s, clearing cached structure" % (itemID, show))
+                    self.invalidate(show)
+                else:
+                    structure.dirty = True
+            elif itemType in [SEASONTYPE, EPISODETYPE]:
+                # Unknown season/episode, could be new content for any cached show so revalidate updatedAt/leafCount on next use
+                for structure in list(self._shows.values()):
+                    structure.dirty = True
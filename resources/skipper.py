@@ -4,11 +4,26 @@ import logging
 import time
 import os
 from resources.settings import Settings
-from resources.customEntries import CustomEntries
+from resources.customEntries import CustomEntries, RATINGKEY
 from resources.sslAlertListener import SSLAlertListener
 from resources.mediaWrapper import Media, MediaWrapper, PLAYINGKEY, STOPPEDKEY, PAUSEDKEY, BUFFERINGKEY, DURATION_TOLERANCE, GRANDPARENTRATINGKEY, PARENTRATINGKEY, rd
 from resources.binge import BingeSessions
+from resources.scheduler import Scheduler
+from resources.sessionCache import SessionSnapshot
+from resources.playerDirectory import PlayerDirectory
+from resources.showCache import ShowCache
+from resources.dispatcher import CommandDispatcher, SEEKCOMMAND, VOLUMECOMMAND, STEPCOMMAND
+from resources.sequencer import Sequencer, Sequence, Step
+from resources.sessionRegistry import SessionRegistry, ExpiringSet
+from resources.accessControl import AccessControl, Decision
+from resources.configWatcher import ConfigWatcher
+from resources.guidIndex import GuidIndex
+from resources.prefetcher import Prefetcher
+from resources.latencyModel import LatencyModel
+from resources.metrics import Metrics, SKIP
 from resources.log import getLogger
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
 from xml.etree.ElementTree import ParseError
 from urllib3.exceptions import ReadTimeoutError
 from requests.exceptions import ReadTimeout
@@ -18,11 +33,13 @@ from plexapi.client import PlexClient
 from plexapi.server import PlexServer
 from plexapi.playqueue import PlayQueue
 from plexapi.base import PlexSession
-from threading import Thread
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from packaging.version import Version
 
 
+VERIFYKEY = "verify"
+
+
 class Skipper():
     TROUBLESHOOT_URL = "https://github.com/mdhiggins/PlexAutoSkip/wiki/Troubleshooting"
     ERRORS = {
@@ -45,6 +62,16 @@ class Skipper():
 
     TIMEOUT = 30
     IGNORED_CAP = 200
+    IGNORED_TTL = 43200
+    IDLE_WAIT = 5
+    HYDRATION_WORKERS = 4
+    HYDRATION_BACKLOG = 256
+    NEXT_QUEUE_LEAD = 60000
+    NEXT_QUEUE_TTL = 600
+    NEXT_QUEUE_WORKERS = 2
+    SEEK_VERIFY = 5
+    # Settings only read at startup, changing them in a reload needs a restart
+    RESTART_SETTINGS = ["username", "password", "servername", "token", "address", "ssl", "port", "engine", "watchconfig", "status", "statusaddress", "statusport"]
 
     @property
     def customEntries(self) -> CustomEntries:
@@ -56,11 +83,40 @@ class Skipper():
         self.log = logger or getLogger(__name__)
         self.verbose = os.environ.get("PAS_VERBOSE", "").lower() == "true"
 
-        self.media_sessions: Dict[str, MediaWrapper] = {}
+        self.media_sessions: SessionRegistry = SessionRegistry()
         self.delete: List[str] = []
-        self.ignored: List[str] = []
+        self.ignored: ExpiringSet = ExpiringSet(self.IGNORED_CAP, self.IGNORED_TTL)
         self.reconnect: bool = False
+        self.scheduler: Scheduler = Scheduler()
+        self.sessions: SessionSnapshot = SessionSnapshot(self.server, self.settings.sessionttl, logger=self.log)
+        self.players: PlayerDirectory = PlayerDirectory(self.server, self.settings.playerttl, logger=self.log)
+        self.shows: ShowCache = ShowCache(self.server, logger=self.log)
+        self.dispatcher: CommandDispatcher = CommandDispatcher(logger=self.log)
+        self.sequencer: Sequencer = Sequencer(logger=self.log)
         self.bingeSessions = BingeSessions(self.settings, self.log)
+        self.access: AccessControl = AccessControl(self.settings, logger=self.log)
+        self.watcher: ConfigWatcher = ConfigWatcher(self.settings, self.reloadConfig, logger=self.log) if self.settings.watchconfig else None
+        self.guidIndex: GuidIndex = None
+        self.latency: LatencyModel = LatencyModel(self.settings.configDir, logger=self.log)
+        self.metrics: Metrics = Metrics(logger=self.log)
+        self.metrics.instrument(self.server._session)
+        self.prefetcher: Prefetcher = Prefetcher(self.server, self.settings, self.shows, logger=self.log) if self.settings.prefetch else None
+
+        # New sessions are built off the alert thread, latest pending alert per pasIdentifier is replayed once hydrated
+        self.hydrator: ThreadPoolExecutor = ThreadPoolExecutor(self.HYDRATION_WORKERS, thread_name_prefix="Hydrator")
+        self.hydrating: Dict[str, Tuple[int, str, int, float]] = {}
+        self.hydrationLock: Lock = Lock()
+        self.hydrationBacklog: BoundedSemaphore = BoundedSemaphore(self.HYDRATION_BACKLOG)
+        self.verifying: set = set()
+
+        # Skip-next PlayQueues built ahead of the credits by pasIdentifier, (created, future of (pq, server)). Own pool so
+        # preparing them never delays hydrating new sessions
+        self.preparer: ThreadPoolExecutor = ThreadPoolExecutor(self.NEXT_QUEUE_WORKERS, thread_name_prefix="NextQueue")
+        self.nextQueues: Dict[str, Tuple[float, Future]] = {}
+
+        # Seek target to confirm by pasIdentifier, checked on its own (VERIFYKEY, pasIdentifier) scheduler key so it never
+        # replaces or gets replaced by a skip-next sequence of the same player
+        self.seekTargets: Dict[str, int] = {}
 
         self.log.debug("%s init with leftOffset %d rightOffset %d" % (self.__class__.__name__, self.settings.leftOffset, self.settings.rightOffset))
         self.log.debug("Offset tags %s" % (self.settings.offsetTags))
@@ -73,42 +129,113 @@ class Skipper():
         self.log.debug("Skip last chapter %s" % (self.settings.skiplastchapter))
         self.log.debug("Binge ignore skip for length %s" % (self.settings.binge))
 
-        if settings.customEntries.needsGuidResolution:
+        if settings.customEntries.needsGuidResolution and self.settings.guidmatching == "session":
+            self.log.debug("Custom entries contain GUIDs, these will be matched as sessions start")
+        elif settings.customEntries.needsGuidResolution:
             self.log.debug("Custom entries contain GUIDs that need ratingKey resolution")
-            settings.customEntries.convertToRatingKeys(server)
+            settings.customEntries.convertToRatingKeys(server, self.guidLookup())
 
         self.log.info("Skipper initiated and ready")
 
-    def getMediaSession(self, sessionKey: str) -> PlexSession:
+    def guidLookup(self) -> GuidIndex:
+        # None falls back to CustomEntries building the in memory table
+        if not self.settings.guidindex:
+            return None
         try:
-            return next(iter([session for session in self.server.sessions() if session.sessionKey == sessionKey]), None)
+            if self.guidIndex is None:
+                self.guidIndex = GuidIndex(self.server, self.settings.configDir, logger=self.log)
+            self.guidIndex.refresh()
+        except:
+            self.log.exception("Unable to load GUID index, falling back to full library scan")
+            return None
+        return self.guidIndex
+
+    def getMediaSession(self, sessionKey: int, since: float = None) -> PlexSession:
+        try:
+            # Only real fetches reach the server, their latency is recorded by the response hook
+            return self.sessions.get(sessionKey, since)
         except KeyboardInterrupt:
             raise
         except:
             self.log.exception("getDataFromSessions Error")
         return None
 
+    def startWatcher(self) -> None:
+        if self.watcher and not self.watcher.is_alive():
+            self.watcher.start()
+
+    def reloadConfig(self) -> None:
+        previous = self.customEntries
+        startup = {k: getattr(self.settings, k) for k in self.RESTART_SETTINGS}
+        configChanged, customChanged = self.settings.reload()
+        if configChanged:
+            self.applySettings(startup)
+        if customChanged and self.customEntries.needsGuidResolution and self.settings.guidmatching != "session":
+            self.log.debug("Reloaded custom entries contain GUIDs that need ratingKey resolution")
+            guidLookup = self.guidLookup()
+            # Without the index GUIDs resolved by the previous entries are reused instead of loading the whole library again
+            self.customEntries.convertToRatingKeys(self.server, guidLookup, previous.resolved if guidLookup is None and previous else None)
+        sessions = self.media_sessions.values()
+        self.log.info("Configuration reloaded (config %s, custom entries %s), reapplying to %d session(s)" % (configChanged, customChanged, len(sessions)))
+        for mediaWrapper in sessions:
+            self.reapplySession(mediaWrapper)
+
+    def applySettings(self, startup: dict) -> None:
+        # Push reloaded values into the objects built from them in __init__
+        self.sessions.ttl = self.settings.sessionttl
+        self.players.ttl = self.settings.playerttl
+        if self.settings.prefetch and self.prefetcher is None:
+            self.prefetcher = Prefetcher(self.server, self.settings, self.shows, logger=self.log)
+        elif not self.settings.prefetch and self.prefetcher is not None:
+            self.prefetcher.shutdown()
+            self.prefetcher = None
+        changed = [k for k, v in startup.items() if getattr(self.settings, k) != v]
+        if changed:
+            self.log.warning("Changes to %s only take effect after a restart" % (", ".join(changed)))
+
+    def reapplySession(self, mediaWrapper: MediaWrapper) -> None:
+        # Rebuild markers from the already loaded media rather than fetching it again
+        mediaWrapper.applyCustom(self.customEntries)
+        self.firstAdjust(mediaWrapper)
+        self.lastAdjust(mediaWrapper)
+        self.bingeSessions.reapply(mediaWrapper)
+        self.scheduleCheck(mediaWrapper, 0)
+
     def start(self, sslopt: dict = None) -> None:
+        self.startWatcher()
         self.listener = SSLAlertListener(self.server, self.processAlert, self.error, sslopt=sslopt, logger=self.log)
         self.log.debug("Starting listener")
         self.listener.start()
         self.reconnect = self.listener.is_alive()
         while self.listener.is_alive():
             try:
-                for session in list(self.media_sessions.values()):
-                    self.checkMedia(session)
+                for pasIdentifier in self.scheduler.wait(self.IDLE_WAIT):
+                    self.checkDue(pasIdentifier)
                 self.bingeSessions.clean()
-                time.sleep(1)
             except KeyboardInterrupt:
                 self.log.debug("Stopping listener")
                 self.reconnect = False
                 self.listener.stop()
+                self.latency.save(force=True)
                 break
         else:
             self.log.error("Connection lost")
         if self.reconnect:
+            self.metrics.increment("reconnects")
             self.start(sslopt)
 
+    def checkDue(self, pasIdentifier: str) -> None:
+        if Sequencer.owns(pasIdentifier):
+            self.advanceSequence(pasIdentifier)
+            return
+        if isinstance(pasIdentifier, tuple) and pasIdentifier[0] == VERIFYKEY:
+            self.verifyDue(pasIdentifier[1])
+            return
+        session = self.media_sessions.get(pasIdentifier)
+        if session:
+            self.checkMedia(session)
+            self.scheduleCheck(session)
+
     def checkMedia(self, mediaWrapper: MediaWrapper) -> None:
         if mediaWrapper.sinceLastAlert > self.TIMEOUT:
             self.log.debug("Session %s hasn't been updated in %d seconds" % (mediaWrapper, self.TIMEOUT))
@@ -117,11 +244,9 @@ class Skipper():
         if mediaWrapper.state == BUFFERINGKEY:
             return
 
-        leftOffset = mediaWrapper.leftOffset or self.settings.leftOffset
-        rightOffset = mediaWrapper.rightOffset or self.settings.rightOffset
-
-        self.checkMediaSkip(mediaWrapper, leftOffset, rightOffset)
-        self.checkMediaVolume(mediaWrapper, leftOffset, rightOffset)
+        self.checkMediaSkip(mediaWrapper)
+        self.checkMediaVolume(mediaWrapper)
+        self.checkNextQueue(mediaWrapper)
 
         if mediaWrapper.skipnext and mediaWrapper.ended and (mediaWrapper.viewOffset >= rd(mediaWrapper.media.duration * DURATION_TOLERANCE)):
             self.log.info("Found ended session %s that has reached the end of its duration %d with viewOffset %d with skip-next enabled, will skip to next" % (mediaWrapper, mediaWrapper.media.duration, mediaWrapper.viewOffset))
@@ -130,97 +255,132 @@ class Skipper():
             self.log.debug("Session %s has been marked as ended with viewOffset %d and state %s, removing" % (mediaWrapper, mediaWrapper.viewOffset, mediaWrapper.state))
             self.removeSession(mediaWrapper)
 
-    def checkMediaSkip(self, mediaWrapper: MediaWrapper, leftOffset: int, rightOffset: int) -> None:
+    def scheduleCheck(self, mediaWrapper: MediaWrapper, delay: float = None) -> None:
+        if mediaWrapper.pasIdentifier not in self.media_sessions:
+            return
+        if delay is None:
+            delay = self.nextCheckDelay(mediaWrapper)
+        self.scheduler.schedule(mediaWrapper.pasIdentifier, delay)
+
+    def nextCheckDelay(self, mediaWrapper: MediaWrapper) -> float:
+        delay = self.TIMEOUT - mediaWrapper.sinceLastAlert
+        if mediaWrapper.state == PLAYINGKEY:
+            viewOffset = mediaWrapper.viewOffset
+            boundary = self.nextBoundary(mediaWrapper, viewOffset, self.seekLead(mediaWrapper))
+            if boundary is not None:
+                delay = min(delay, (boundary - viewOffset) / 1000)
+        return max(delay, 0)
+
+    def nextBoundary(self, mediaWrapper: MediaWrapper, viewOffset: int, lead: int = 0) -> int:
+        # Earliest offset after viewOffset where checkMediaSkip, shouldLowerMediaVolume or checkNextQueue could reach a different decision
+        skip = mediaWrapper.skipIntervals.next(viewOffset + lead)
+        skip = skip - lead if skip is not None else None
+        prepare = self.nextQueueOffset(mediaWrapper) if mediaWrapper.skipnext and mediaWrapper.pasIdentifier not in self.nextQueues else None
+        prepare = prepare if prepare is not None and prepare > viewOffset else None
+        return min((b for b in [skip, mediaWrapper.volumeIntervals.next(viewOffset), prepare] if b is not None), default=None)
+
+    def seekLead(self, mediaWrapper: MediaWrapper) -> int:
+        # Skips are checked this many milliseconds ahead so the seek lands at the boundary rather than after it
+        return self.latency.lead(mediaWrapper.player) if self.settings.latencycompensation else 0
+
+    def checkMediaSkip(self, mediaWrapper: MediaWrapper) -> None:
         if mediaWrapper.state != PLAYINGKEY:
             return
 
-        skipMarkers = [m for m in mediaWrapper.customMarkers if m.mode == Settings.MODE_TYPES.SKIP]
-        for marker in skipMarkers:
-            if marker.start <= mediaWrapper.viewOffset < rd(marker.end):
-                self.log.info("Found a custom marker for media %s with range %d-%d and viewOffset %d (%d)" % (mediaWrapper, marker.start, marker.end, mediaWrapper.viewOffset, marker.key))
-                self.seekTo(mediaWrapper, marker.end)
-                return
-
-        if mediaWrapper.mode != Settings.MODE_TYPES.SKIP:
+        viewOffset = mediaWrapper.viewOffset
+        lead = self.seekLead(mediaWrapper)
+        interval = mediaWrapper.skipIntervals.find(viewOffset + lead)
+        if interval:
+            self.log.info("Found skippable %s for media %s and viewOffset %d (%dms lead), target %d" % (interval, mediaWrapper, viewOffset, lead, interval.target))
+            self.metrics.increment("skips", interval.kind)
+            self.metrics.observe(SKIP, "boundaryLag", max(viewOffset + lead - interval.start, 0))
+            self.seekTo(mediaWrapper, interval.target)
+
+    def nextQueueOffset(self, mediaWrapper: MediaWrapper) -> int:
+        # Shortly before the first skip that runs to the end of the media (the final marker/chapter) or the end itself
+        duration = mediaWrapper.media.duration
+        if not duration:
+            return None
+        final = min((i.start for i in mediaWrapper.skipIntervals.intervals if i.target >= rd(duration * DURATION_TOLERANCE)), default=duration)
+        return max(final - self.NEXT_QUEUE_LEAD, 0)
+
+    def checkNextQueue(self, mediaWrapper: MediaWrapper) -> None:
+        if not mediaWrapper.skipnext or mediaWrapper.state != PLAYINGKEY or mediaWrapper.pasIdentifier in self.nextQueues:
             return
+        offset = self.nextQueueOffset(mediaWrapper)
+        if offset is not None and mediaWrapper.viewOffset >= offset:
+            self.log.debug("Session %s is approaching its final marker with skip-next enabled, preparing next PlayQueue" % (mediaWrapper))
+            self.nextQueues[mediaWrapper.pasIdentifier] = (time.monotonic(), self.preparer.submit(self.prepareNextPlayQueue, mediaWrapper))
+
+    def prepareNextPlayQueue(self, mediaWrapper: MediaWrapper) -> Tuple[PlayQueue, PlexServer]:
+        server = self.sessionServer(mediaWrapper)
+        with self.metrics.timed("buildNextPlayQueue"):
+            pq = self.buildNextPlayQueue(mediaWrapper, server)
+        if pq and pq.items and pq.items[-1] != mediaWrapper.media:
+            self.log.debug("Prepared PlayQueue %d with %d items for %s" % (pq.playQueueID, len(pq.items), mediaWrapper))
+        else:
+            self.log.debug("No next item available for %s, skip-next will seek to the end" % (mediaWrapper))
+        return pq, server
+
+    def preparedPlayQueue(self, mediaWrapper: MediaWrapper) -> Tuple[PlayQueue, PlexServer]:
+        created, future = self.nextQueues.pop(mediaWrapper.pasIdentifier, (None, None))
+        if not future:
+            return None
+        if time.monotonic() - created > self.NEXT_QUEUE_TTL:
+            future.cancel()
+            self.log.debug("Prepared PlayQueue for %s is older than %d seconds, rebuilding" % (mediaWrapper, self.NEXT_QUEUE_TTL))
+            return None
+        if not future.done():
+            # Not worth holding the skip for, building it inline is no slower than waiting
+            future.cancel()
+            self.log.debug("Prepared PlayQueue for %s isn't ready yet, building it now" % (mediaWrapper))
+            return None
+        try:
+            return future.result()
+        except:
+            self.log.exception("Unable to use prepared PlayQueue for %s, rebuilding" % (mediaWrapper))
+            return None
 
-        if self.settings.skiplastchapter and mediaWrapper.lastchapter and (mediaWrapper.lastchapter.start / mediaWrapper.media.duration) > self.settings.skiplastchapter:
-            if mediaWrapper.lastchapter and mediaWrapper.lastchapter.start <= mediaWrapper.viewOffset < rd(mediaWrapper.lastchapter.end):
-                self.log.info("Found a valid last chapter for media %s with range %d-%d and viewOffset %d with skip-last-chapter enabled" % (mediaWrapper, mediaWrapper.lastchapter.start, mediaWrapper.lastchapter.end, mediaWrapper.viewOffset))
-                self.seekTo(mediaWrapper, mediaWrapper.media.duration)
-                return
-
-        for chapter in mediaWrapper.chapters:
-            if chapter.start <= mediaWrapper.viewOffset < rd(chapter.end):
-                self.log.info("Found skippable chapter %s for media %s with range %d-%d and viewOffset %d" % (chapter.title, mediaWrapper, chapter.start, chapter.end, mediaWrapper.viewOffset))
-                self.seekTo(mediaWrapper, chapter.end)
-                return
-
-        for marker in mediaWrapper.markers:
-            lo = leftOffset if marker.type.lower() in mediaWrapper.offsetTags else 0
-            ro = rightOffset if marker.type.lower() in mediaWrapper.offsetTags else 0
-
-            start = marker.start if marker.start < lo else (marker.start + lo)
-            if (start) <= mediaWrapper.viewOffset < rd(marker.end):
-                self.log.info("Found skippable marker %s for media %s with range %d(+%d)-%d(+%d) and viewOffset %d" % (marker.type, mediaWrapper, marker.start, lo, marker.end, ro, mediaWrapper.viewOffset))
-                self.seekTo(mediaWrapper, marker.end + ro)
-                return
-
-    def checkMediaVolume(self, mediaWrapper: MediaWrapper, leftOffset: int, rightOffset: int) -> None:
+    def checkMediaVolume(self, mediaWrapper: MediaWrapper) -> None:
         if mediaWrapper.state != PLAYINGKEY:
             return
 
-        shouldLower = self.shouldLowerMediaVolume(mediaWrapper, leftOffset, rightOffset)
+        shouldLower = self.shouldLowerMediaVolume(mediaWrapper)
         if not mediaWrapper.loweringVolume and shouldLower:
+            interval = mediaWrapper.volumeIntervals.find(mediaWrapper.viewOffset)
+            self.metrics.increment("volume", interval.kind if interval else "lower")
             self.log.info("Moving from normal volume to low volume viewOffset %d which is a low volume area for media %s, lowering volume to %d" % (mediaWrapper.viewOffset, mediaWrapper, self.settings.volumelow))
             self.setVolume(mediaWrapper, self.settings.volumelow, shouldLower)
             return
         elif mediaWrapper.loweringVolume and not shouldLower:
             self.log.info("Moving from lower volume to normal volume viewOffset %d for media %s, raising volume to %d" % (mediaWrapper.viewOffset, mediaWrapper, mediaWrapper.cachedVolume))
+            self.metrics.increment("volume", "restore")
             self.setVolume(mediaWrapper, mediaWrapper.cachedVolume, shouldLower)
             return
 
-    def shouldLowerMediaVolume(self, mediaWrapper: MediaWrapper, leftOffset: int, rightOffset: int) -> bool:
-        customVolumeMarkers = [m for m in mediaWrapper.customMarkers if m.mode == Settings.MODE_TYPES.VOLUME]
-        for marker in customVolumeMarkers:
-            if marker.start <= mediaWrapper.viewOffset < marker.end:
-                self.log.debug("Inside a custom marker for media %s with range %d-%d and viewOffset %d (%d), volume should be low" % (mediaWrapper, marker.start, marker.end, mediaWrapper.viewOffset, marker.key))
-                return True
-
-        if mediaWrapper.mode != Settings.MODE_TYPES.VOLUME:
-            return False
-
-        if self.settings.skiplastchapter and mediaWrapper.lastchapter and (mediaWrapper.lastchapter.start / mediaWrapper.media.duration) > self.settings.skiplastchapter:
-            if mediaWrapper.lastchapter and mediaWrapper.lastchapter.start <= mediaWrapper.viewOffset <= mediaWrapper.lastchapter.end:
-                self.log.debug("Inside a valid last chapter for media %s with range %d-%d and viewOffset %d with skip-last-chapter enabled, volume should be low" % (mediaWrapper, mediaWrapper.lastchapter.start, mediaWrapper.lastchapter.end, mediaWrapper.viewOffset))
-                return True
-
-        for chapter in mediaWrapper.chapters:
-            if chapter.start <= mediaWrapper.viewOffset < chapter.end:
-                self.log.debug("Inside chapter %s for media %s with range %d-%d and viewOffset %d, volume should be low" % (chapter.title, mediaWrapper, chapter.start, chapter.end, mediaWrapper.viewOffset))
-                return True
-
-        for marker in mediaWrapper.markers:
-            lo = leftOffset if marker.type.lower() in mediaWrapper.offsetTags else 0
-            ro = rightOffset if marker.type.lower() in mediaWrapper.offsetTags else 0
-            if (marker.start + lo) <= mediaWrapper.viewOffset < (marker.end + ro):
-                self.log.debug("Inside marker %s for media %s with range %d(+%d)-%d(+%d) and viewOffset %d, volume should be low" % (marker.type, mediaWrapper, marker.start, lo, marker.end, ro, mediaWrapper.viewOffset))
-                return True
+    def shouldLowerMediaVolume(self, mediaWrapper: MediaWrapper) -> bool:
+        viewOffset = mediaWrapper.viewOffset
+        interval = mediaWrapper.volumeIntervals.find(viewOffset)
+        if interval:
+            self.log.debug("Inside %s for media %s and viewOffset %d, volume should be low" % (interval, mediaWrapper, viewOffset))
+            return True
         return False
 
     def seekTo(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
-        t = Thread(target=self._seekTo, args=(mediaWrapper, targetOffset,))
-        t.start()
+        self.dispatcher.submit(mediaWrapper.clientIdentifier, SEEKCOMMAND, mediaWrapper.pasIdentifier, self._seekTo, mediaWrapper, targetOffset)
 
     def _seekTo(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
         try:
             self.seekPlayerTo(mediaWrapper.player, mediaWrapper, targetOffset)
+            self.scheduleCheck(mediaWrapper)
         except (ReadTimeout, ReadTimeoutError, timeout):
             self.log.debug("TimeoutError, removing from cache to prevent false triggers, will be restored with next sync")
             self.removeSession(mediaWrapper)
+            self.players.invalidate(mediaWrapper.player.machineIdentifier)
         except:
             self.log.exception("Exception, removing from cache to prevent false triggers, will be restored with next sync")
             self.removeSession(mediaWrapper)
+            self.players.invalidate(mediaWrapper.player.machineIdentifier)
 
     def seekPlayerTo(self, player: PlexClient, mediaWrapper: MediaWrapper, targetOffset: int, pq: PlayQueue = None, server: PlexServer = None) -> bool:
         if not player:
@@ -231,34 +391,48 @@ class Skipper():
                 if mediaWrapper.skipnext and targetOffset >= mediaWrapper.media.duration:
                     return self.skipPlayerTo(player, mediaWrapper, pq, server)
                 else:
-                    if mediaWrapper.media.duration and targetOffset >= (mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0)):
-                        self.log.debug("TargetOffset %d is greater or equal to duration of media %d(-%d), adjusting to match" % (targetOffset, mediaWrapper.media.duration, self.CREDIT_SKIP_FIX.get(player.product, 0)))
-                        targetOffset = mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0)
-
-                    if targetOffset <= mediaWrapper.viewOffset:
-                        self.log.debug("TargetOffset %d is less than or equal to current viewOffset %d, ignoring" % (targetOffset, mediaWrapper.viewOffset))
+                    targetOffset = self.adjustSeekTarget(player, mediaWrapper, targetOffset)
+                    if targetOffset is None:
                         return False
 
                     self.log.info("Seeking %s player playing %s from %d to %d" % (player.product, mediaWrapper, mediaWrapper.viewOffset, targetOffset))
-                    mediaWrapper.seekTo(targetOffset, player)
+                    started = time.monotonic()
+                    self.metrics.observe(SKIP, "alertToCommand", mediaWrapper.sinceLastAlert * 1000)
+                    with self.metrics.timed("seekTo", player):
+                        mediaWrapper.seekTo(targetOffset, player)
+                    self.latency.command(player, (time.monotonic() - started) * 1000)
+                    self.verifySeekLater(mediaWrapper, targetOffset)
                 return True
             except ParseError:
                 self.log.debug("ParseError, seems to be certain players but still functional, continuing")
                 return True
             except BadRequest as br:
                 self.logErrorMessage(br, "BadRequest exception seekPlayerTo")
+                self.players.invalidate(player.machineIdentifier)
                 mediaWrapper.badSeek()
                 return False
                 # return self.seekPlayerTo(self.recoverPlayer(player), mediaWrapper, targetOffset, pq, server)
             except NotFound as nf:
                 self.logErrorMessage(nf, "NotFound exception seekPlayerTo")
+                self.players.invalidate(player.machineIdentifier)
                 mediaWrapper.badSeek()
                 return False
                 # return self.seekPlayerTo(self.recoverPlayer(player), mediaWrapper, targetOffset, pq, server)
         except:
             raise
 
+    def adjustSeekTarget(self, player: PlexClient, mediaWrapper: MediaWrapper, targetOffset: int) -> int:
+        if mediaWrapper.media.duration and targetOffset >= (mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0)):
+            self.log.debug("TargetOffset %d is greater or equal to duration of media %d(-%d), adjusting to match" % (targetOffset, mediaWrapper.media.duration, self.CREDIT_SKIP_FIX.get(player.product, 0)))
+            targetOffset = mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0)
+
+        if targetOffset <= mediaWrapper.viewOffset:
+            self.log.debug("TargetOffset %d is less than or equal to current viewOffset %d, ignoring" % (targetOffset, mediaWrapper.viewOffset))
+            return None
+        return targetOffset
+
     def skipPlayerTo(self, player: PlexClient, mediaWrapper: MediaWrapper, pq: PlayQueue, server: PlexServer) -> bool:
+        prepared = self.preparedPlayQueue(mediaWrapper) if not pq else None
         self.removeSession(mediaWrapper)
         self.ignoreSession(mediaWrapper)
 
@@ -267,6 +441,89 @@ class Skipper():
             player.stop()
             return True
 
+        if prepared:
+            pq, server = prepared
+            self.log.debug("Using prepared PlayQueue %s for %s" % (pq.playQueueID if pq else None, mediaWrapper))
+        else:
+            server = self.sessionServer(mediaWrapper, server)
+            with self.metrics.timed("buildNextPlayQueue"):
+                pq = pq or self.buildNextPlayQueue(mediaWrapper, server)
+
+        if not pq or not pq.items:
+            self.log.warning("No available PlayQueue data %d (%s), using seekTo to go to media end" % (mediaWrapper.playQueueID, mediaWrapper.media.playQueueItemID))
+            mediaWrapper.seekTo(mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0), player)
+            return True
+
+        if pq.items[-1] == mediaWrapper.media:
+            self.log.debug("Seek target is the end but no more items in the PlayQueue, using seekTo to prevent loop")
+            mediaWrapper.seekTo(mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0), player)
+        else:
+            commandDelay = (mediaWrapper.commandDelay or self.settings.commandDelay) / 1000
+            self.runSequence(mediaWrapper, [Step(commandDelay, "stop", player.stop), Step(commandDelay, "playMedia", player.playMedia, (pq,))])
+        return True
+
+    def runSequence(self, mediaWrapper: MediaWrapper, steps: List[Step]) -> None:
+        sequence = self.sequencer.start(mediaWrapper.clientIdentifier, mediaWrapper.pasIdentifier, steps)
+        self.log.debug("Starting %s for %s" % (sequence, mediaWrapper))
+        self.scheduler.schedule(sequence.key, sequence.delay)
+
+    def cancelSequence(self, clientIdentifier: str, reason: str) -> None:
+        sequence = self.sequencer.cancel(clientIdentifier)
+        if sequence:
+            self.scheduler.cancel(sequence.key)
+            self.log.info("Cancelling %s%s, %s" % (sequence, " after its running step" if sequence.running else "", reason))
+
+    def verifySeekLater(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
+        self.seekTargets[mediaWrapper.pasIdentifier] = targetOffset
+        self.scheduler.schedule((VERIFYKEY, mediaWrapper.pasIdentifier), self.SEEK_VERIFY)
+
+    def verifyDue(self, pasIdentifier: str) -> None:
+        targetOffset = self.seekTargets.pop(pasIdentifier, None)
+        mediaWrapper = self.media_sessions.get(pasIdentifier)
+        if targetOffset is not None and mediaWrapper:
+            self.verifySeek(mediaWrapper, targetOffset)
+
+    def verifySeek(self, mediaWrapper: MediaWrapper, targetOffset: int) -> None:
+        # Alerts between the origin and target are rejected while seeking, if only those arrived the player dropped the
+        # seek and the session would otherwise believe it is already past the range
+        if mediaWrapper.pasIdentifier not in self.media_sessions or mediaWrapper.seekTarget != rd(targetOffset):
+            return
+        if mediaWrapper.abandonSeek():
+            self.log.info("Seek to %d for %s was not confirmed within %d seconds, checking again from %d" % (targetOffset, mediaWrapper, self.SEEK_VERIFY, mediaWrapper.viewOffset))
+            self.scheduleCheck(mediaWrapper, 0)
+
+    def advanceSequence(self, key: tuple) -> None:
+        sequence = self.sequencer.get(key)
+        step = self.sequencer.next(sequence) if sequence else None
+        if step:
+            self.dispatchStep(sequence, step)
+
+    def dispatchStep(self, sequence: Sequence, step: Step) -> None:
+        self.dispatcher.submit(sequence.clientIdentifier, STEPCOMMAND, sequence.key, self.runStep, sequence, step)
+
+    def runStep(self, sequence: Sequence, step: Step) -> None:
+        if not self.sequencer.begin(sequence):
+            return
+        failed = False
+        try:
+            try:
+                self.log.debug("Running %s step of %s" % (step.label, sequence))
+                with self.metrics.timed(step.label):
+                    step.function(*step.args)
+            except ParseError:
+                self.log.debug("ParseError, seems to be certain players but still functional, continuing")
+        except (BadRequest, NotFound) as e:
+            self.logErrorMessage(e, "%s exception running %s step" % (e.__class__.__name__, step.label))
+            self.players.invalidate(sequence.clientIdentifier)
+            failed = True
+        except:
+            self.log.exception("Exception running %s step of %s, dropping remaining steps" % (step.label, sequence))
+            self.players.invalidate(sequence.clientIdentifier)
+            failed = True
+        if self.sequencer.complete(sequence, failed):
+            self.scheduler.schedule(sequence.key, sequence.delay)
+
+    def sessionServer(self, mediaWrapper: MediaWrapper, server: PlexServer = None) -> PlexServer:
         server = server or mediaWrapper.server
         if mediaWrapper.plexsession.user != server.myPlexAccount():
             try:
@@ -274,35 +531,37 @@ class Skipper():
                 server = server.switchUser(mediaWrapper.plexsession._username)
             except:
                 self.log.exception("Unable to create new server instance to maintain current user")
+        return server
 
-        if not pq:
-            try:
-                current = PlayQueue.get(self.server, mediaWrapper.playQueueID)
-                if current.items[-1] != mediaWrapper.media:
-                    nextItem: Media = current[current.items.index(mediaWrapper.media) + 1]
-                    pq = PlayQueue.create(server, list(current.items), nextItem)
-                    self.log.debug("Creating new PlayQueue %d with start item %s" % (pq.playQueueID, nextItem))
-                else:
-                    self.log.debug("No more items in PlayQueue %d, at the end" % (current.playQueueID))
-            except Exception as e:
-                self.log.exception("")
-                self.log.debug("Seek target is the end but unable to get existing PlayQueue %d (%s) data from server" % (mediaWrapper.playQueueID, mediaWrapper.media.playQueueItemID))
-                if self.verbose:
-                    self.log.debug(e)
-                if mediaWrapper.media.type == "episode":
-                    self.log.debug("Attempting to create a new PlayQueue using remaining episodes")
-                    try:
-                        episodes = mediaWrapper.media.show().episodes()
-                        if episodes and episodes[-1] != mediaWrapper.media:
-                            self.log.debug("Generating new PlayQueue using remaining episodes in series")
-                            startItemIndex = episodes.index(mediaWrapper.media) + 1
-                            startItem = episodes[startItemIndex]
-                            self.log.debug("New queue contains %d items, selecting %s with index %s" % (len(episodes), startItem, startItemIndex))
-                            pq = PlayQueue.create(server, episodes, startItem)
-                        else:
-                            self.log.debug("No remaining episodes in series to build a PlayQueue")
-                    except:
-                        self.log.exception("Unable to create new PlayQueue for %s" % (mediaWrapper))
+    def buildNextPlayQueue(self, mediaWrapper: MediaWrapper, server: PlexServer) -> PlayQueue:
+        pq = None
+        try:
+            current = PlayQueue.get(self.server, mediaWrapper.playQueueID)
+            if current.items[-1] != mediaWrapper.media:
+                nextItem: Media = current[current.items.index(mediaWrapper.media) + 1]
+                pq = PlayQueue.create(server, list(current.items), nextItem)
+                self.log.debug("Creating new PlayQueue %d with start item %s" % (pq.playQueueID, nextItem))
+            else:
+                self.log.debug("No more items in PlayQueue %d, at the end" % (current.playQueueID))
+        except Exception as e:
+            self.log.exception("")
+            self.log.debug("Seek target is the end but unable to get existing PlayQueue %d (%s) data from server" % (mediaWrapper.playQueueID, mediaWrapper.media.playQueueItemID))
+            if self.verbose:
+                self.log.debug(e)
+            if mediaWrapper.media.type == "episode":
+                self.log.debug("Attempting to create a new PlayQueue using remaining episodes")
+                try:
+                    episodes = mediaWrapper.media.show().episodes()
+                    if episodes and episodes[-1] != mediaWrapper.media:
+                        self.log.debug("Generating new PlayQueue using remaining episodes in series")
+                        startItemIndex = episodes.index(mediaWrapper.media) + 1
+                        startItem = episodes[startItemIndex]
+                        self.log.debug("New queue contains %d items, selecting %s with index %s" % (len(episodes), startItem, startItemIndex))
+                        pq = PlayQueue.create(server, episodes, startItem)
+                    else:
+                        self.log.debug("No remaining episodes in series to build a PlayQueue")
+                except:
+                    self.log.exception("Unable to create new PlayQueue for %s" % (mediaWrapper))
 
         if mediaWrapper.media.type == "episode" and (not pq or not pq.items):
             try:
@@ -316,36 +575,23 @@ class Skipper():
                     self.log.debug("No on deck episodes found to build a PlayQueue")
             except:
                 self.log.exception("Unable to create new on deck PlayQueue for %s" % (mediaWrapper))
-
-        if not pq or not pq.items:
-            self.log.warning("No available PlayQueue data %d (%s), using seekTo to go to media end" % (mediaWrapper.playQueueID, mediaWrapper.media.playQueueItemID))
-            mediaWrapper.seekTo(mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0), player)
-            return True
-
-        if pq.items[-1] == mediaWrapper.media:
-            self.log.debug("Seek target is the end but no more items in the PlayQueue, using seekTo to prevent loop")
-            mediaWrapper.seekTo(mediaWrapper.media.duration - self.CREDIT_SKIP_FIX.get(player.product, 0), player)
-        else:
-            commandDelay = mediaWrapper.commandDelay or self.settings.commandDelay
-            time.sleep(commandDelay / 1000)
-            player.stop()
-            time.sleep(commandDelay / 1000)
-            player.playMedia(pq)
-        return True
+        return pq
 
     def setVolume(self, mediaWrapper: MediaWrapper, volume: int, lowering: bool) -> None:
-        t = Thread(target=self._setVolume, args=(mediaWrapper, volume, lowering))
-        t.start()
+        self.dispatcher.submit(mediaWrapper.clientIdentifier, VOLUMECOMMAND, mediaWrapper.pasIdentifier, self._setVolume, mediaWrapper, volume, lowering)
 
     def _setVolume(self, mediaWrapper: MediaWrapper, volume: int, lowering: bool) -> None:
         try:
             self.setPlayerVolume(mediaWrapper.player, mediaWrapper, volume, lowering)
+            self.scheduleCheck(mediaWrapper)
         except (ReadTimeout, ReadTimeoutError, timeout):
             self.log.debug("TimeoutError, removing from cache to prevent false triggers, will be restored with next sync")
             self.removeSession(mediaWrapper)
+            self.players.invalidate(mediaWrapper.player.machineIdentifier)
         except:
             self.log.exception("Exception, removing from cache to prevent false triggers, will be restored with next sync")
             self.removeSession(mediaWrapper)
+            self.players.invalidate(mediaWrapper.player.machineIdentifier)
 
     def setPlayerVolume(self, player: PlexClient, mediaWrapper: MediaWrapper, volume: int, lowering: bool) -> bool:
         if not player:
@@ -359,16 +605,19 @@ class Skipper():
                     self.log.debug("Unable to access timeline data for player %s to cache previous volume value, will restore to %d" % (player.product, previousVolume))
                 self.log.info("Setting %s player volume playing %s from %d to %d" % (player.product, mediaWrapper, previousVolume, volume))
                 mediaWrapper.updateVolume(volume, previousVolume, lowering)
-                player.setVolume(volume)
+                with self.metrics.timed("setVolume", player):
+                    player.setVolume(volume)
                 return True
             except ParseError:
                 self.log.debug("ParseError, seems to be certain players but still functional, continuing")
                 return True
             except BadRequest as br:
                 self.logErrorMessage(br, "BadRequest exception setPlayerVolume")
+                self.players.invalidate(player.machineIdentifier)
                 return False
             except NotFound as nf:
                 self.logErrorMessage(nf, "NotFound exception setPlayerVolume")
+                self.players.invalidate(player.machineIdentifier)
                 return False
         except:
             raise
@@ -387,12 +636,18 @@ class Skipper():
         return False
 
     def processAlert(self, data: dict) -> None:
+        self.metrics.increment("alerts", data.get('type', ""))
         if data['type'] == 'playing':
+            received = time.monotonic()
             sessionKey = int(data['PlaySessionStateNotification'][0]['sessionKey'])
             clientIdentifier = data['PlaySessionStateNotification'][0]['clientIdentifier']
             pasIdentifier = MediaWrapper.getSessionClientIdentifier(sessionKey, clientIdentifier)
             playQueueID = int(data['PlaySessionStateNotification'][0].get('playQueueID', 0))
 
+            sequence = self.sequencer.pending(clientIdentifier)
+            if sequence and sequence.origin != pasIdentifier and data['PlaySessionStateNotification'][0].get('state') == PLAYINGKEY:
+                self.cancelSequence(clientIdentifier, "player moved on to session %s" % (pasIdentifier))
+
             if pasIdentifier in self.ignored:
                 if self.verbose:
                     self.log.debug("Ignoring session %s" % pasIdentifier)
@@ -402,62 +657,126 @@ class Skipper():
                 state = data['PlaySessionStateNotification'][0]['state']
                 viewOffset = int(data['PlaySessionStateNotification'][0]['viewOffset'])
 
-                if pasIdentifier not in self.media_sessions:
-                    mediaSession = self.getMediaSession(sessionKey)
-                    if self.verbose:
-                        if mediaSession and mediaSession.session and mediaSession.player:
-                            self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d location %s user %s player IP %s" % (pasIdentifier, state, viewOffset, playQueueID, mediaSession.session.location, mediaSession._username, mediaSession.player.address))
-                        elif mediaSession and mediaSession.session:
-                            self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d location %s user %s" % (pasIdentifier, state, viewOffset, playQueueID, mediaSession.session.location, mediaSession._username))
-                        else:
-                            self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d but no session data" % (pasIdentifier, state, viewOffset, playQueueID))
-                    if mediaSession and mediaSession.session and mediaSession.session.location == 'lan':
-                        wrapper = MediaWrapper(mediaSession, clientIdentifier, state, playQueueID, self.server, settings=self.settings, custom=self.customEntries, logger=self.log)
-                        if not self.blockedClientUser(wrapper):
-                            if self.shouldAdd(wrapper):
-                                self.addSession(wrapper)
-                            else:
-                                if len(wrapper.customMarkers) > 0:
-                                    wrapper.customOnly = True
-                                    self.addSession(wrapper)
-                                else:
-                                    self.ignoreSession(wrapper)
-                        else:
-                            self.ignoreSession(wrapper)
-                else:
-                    mediaSession = self.media_sessions[pasIdentifier]
-                    mediaSession.updateOffset(viewOffset, state=state)
-                    if not mediaSession.ended and state in [STOPPEDKEY, PAUSEDKEY] and not self.getMediaSession(sessionKey):
-                        self.media_sessions[pasIdentifier].ended = True
-                    self.bingeSessions.update(mediaSession)
+                with self.hydrationLock:
+                    if pasIdentifier in self.hydrating:
+                        self.hydrating[pasIdentifier] = (sessionKey, state, viewOffset, received)
+                        return
+                    mediaWrapper = self.media_sessions.get(pasIdentifier)
+                    if not mediaWrapper:
+                        if self.submitHydration(self.hydrate, sessionKey, clientIdentifier, pasIdentifier, playQueueID, state, viewOffset, received):
+                            self.hydrating[pasIdentifier] = None
+                        return
+                self.updateSession(mediaWrapper, sessionKey, state, viewOffset, received)
             except KeyboardInterrupt:
                 raise
             except:
                 self.log.exception("Unexpected error getting data from session alert")
+        elif data['type'] == 'timeline':
+            try:
+                self.shows.processTimeline(data.get('TimelineEntry', []))
+                if self.prefetcher is not None:
+                    self.prefetcher.processTimeline(data.get('TimelineEntry', []))
+            except:
+                self.log.exception("Unexpected error processing timeline alert")
+
+    def submitHydration(self, function, *args) -> Future:
+        # Work for the hydration pool is capped, over the cap it is dropped and the session's next alert tries again
+        if not self.hydrationBacklog.acquire(blocking=False):
+            self.log.debug("Hydration backlog of %d is full, dropping %s" % (self.HYDRATION_BACKLOG, function.__name__))
+            return None
+        future = self.hydrator.submit(function, *args)
+        future.add_done_callback(lambda _: self.hydrationBacklog.release())
+        return future
+
+    def hydrate(self, sessionKey: int, clientIdentifier: str, pasIdentifier: str, playQueueID: int, state: str, viewOffset: int, received: float) -> None:
+        try:
+            self.hydrateSession(sessionKey, clientIdentifier, pasIdentifier, playQueueID, state, viewOffset, received)
+        except:
+            self.log.exception("Unexpected error getting data from session alert")
+        while True:
+            with self.hydrationLock:
+                pending = self.hydrating[pasIdentifier]
+                mediaWrapper = self.media_sessions.get(pasIdentifier)
+                if not pending or not mediaWrapper:
+                    del self.hydrating[pasIdentifier]
+                    return
+                self.hydrating[pasIdentifier] = None
+            try:
+                self.updateSession(mediaWrapper, *pending)
+            except:
+                self.log.exception("Unexpected error replaying session alert for %s" % (pasIdentifier))
+
+    def hydrateSession(self, sessionKey: int, clientIdentifier: str, pasIdentifier: str, playQueueID: int, state: str, viewOffset: int, received: float) -> None:
+        # The snapshot has to be requested after the alert so a session that just started is listed
+        mediaSession = self.getMediaSession(sessionKey, since=received)
+        if self.verbose:
+            if mediaSession and mediaSession.session and mediaSession.player:
+                self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d location %s user %s player IP %s" % (pasIdentifier, state, viewOffset, playQueueID, mediaSession.session.location, mediaSession._username, mediaSession.player.address))
+            elif mediaSession and mediaSession.session:
+                self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d location %s user %s" % (pasIdentifier, state, viewOffset, playQueueID, mediaSession.session.location, mediaSession._username))
+            else:
+                self.log.debug("Alert for %s with state %s viewOffset %d playQueueID %d but no session data" % (pasIdentifier, state, viewOffset, playQueueID))
+        if mediaSession and mediaSession.session and mediaSession.session.location == 'lan':
+            source = self.prefetcher.get(mediaSession.ratingKey) if self.prefetcher is not None else None
+            with self.metrics.timed("hydrate" if source else "source"):
+                wrapper = MediaWrapper(mediaSession, clientIdentifier, state, playQueueID, self.server, settings=self.settings, custom=self.customEntries, logger=self.log, players=self.players, source=source)
+            if not self.blockedClientUser(wrapper):
+                if self.shouldAdd(wrapper):
+                    self.addSession(wrapper)
+                else:
+                    if len(wrapper.customMarkers) > 0:
+                        wrapper.customOnly = True
+                        self.addSession(wrapper)
+                    else:
+                        self.ignoreSession(wrapper)
+            else:
+                self.ignoreSession(wrapper)
+
+    def updateSession(self, mediaWrapper: MediaWrapper, sessionKey: int, state: str, viewOffset: int, received: float) -> None:
+        mediaWrapper.updateOffset(viewOffset, state=state)
+        if mediaWrapper.landed is not None:
+            self.latency.landed(mediaWrapper.player, mediaWrapper.landed)
+            mediaWrapper.landed = None
+        if not mediaWrapper.ended and state in [STOPPEDKEY, PAUSEDKEY]:
+            self.verifySession(mediaWrapper, sessionKey, received)
+        self.bingeSessions.update(mediaWrapper)
+        self.scheduleCheck(mediaWrapper, 0 if mediaWrapper.ended or self.actionable(mediaWrapper) else None)
+
+    def actionable(self, mediaWrapper: MediaWrapper) -> bool:
+        # Scheduled boundaries only cover playing into a range, an alert that is already inside one (a user seek into a marker) is checked straight away
+        if mediaWrapper.state != PLAYINGKEY:
+            return False
+        viewOffset = mediaWrapper.viewOffset
+        return mediaWrapper.skipIntervals.find(viewOffset + self.seekLead(mediaWrapper)) is not None or mediaWrapper.loweringVolume != (mediaWrapper.volumeIntervals.find(viewOffset) is not None)
 
-    def blockedClientUser(self, mediaWrapper: MediaWrapper) -> bool:
-        session = mediaWrapper.plexsession
+    def verifySession(self, mediaWrapper: MediaWrapper, sessionKey: int, received: float) -> None:
+        # Checked on the hydration pool so the sessions request doesn't hold up alerts for every other session
+        with self.hydrationLock:
+            if mediaWrapper.pasIdentifier in self.verifying:
+                return
+            self.verifying.add(mediaWrapper.pasIdentifier)
+        if not self.submitHydration(self.confirmSession, mediaWrapper, sessionKey, received):
+            with self.hydrationLock:
+                self.verifying.discard(mediaWrapper.pasIdentifier)
 
-        # Users
-        if session._username in self.customEntries.blockedUsers:
-            self.log.debug("Blocking %s based on blocked user in %s" % (mediaWrapper, session._username))
-            return True
-        if self.customEntries.allowedUsers and session._username not in self.customEntries.allowedUsers:
-            self.log.debug("Blocking %s based on no allowed user in %s" % (mediaWrapper, session._username))
-            return True
-        elif self.customEntries.allowedUsers:
-            self.log.debug("Allowing %s based on allowed user in %s" % (mediaWrapper, session._username))
+    def confirmSession(self, mediaWrapper: MediaWrapper, sessionKey: int, received: float) -> None:
+        # A paused/stopped alert for a session that is no longer listed by the server means playback ended
+        try:
+            if not self.getMediaSession(sessionKey, since=received):
+                mediaWrapper.ended = True
+                self.scheduleCheck(mediaWrapper, 0)
+        finally:
+            with self.hydrationLock:
+                self.verifying.discard(mediaWrapper.pasIdentifier)
 
-        # Clients/players
-        if self.customEntries.allowedClients and (mediaWrapper.player.title not in self.customEntries.allowedClients and mediaWrapper.clientIdentifier not in self.customEntries.allowedClients):
-            self.log.debug("Blocking %s based on no allowed player %s %s" % (mediaWrapper, mediaWrapper.player.title, mediaWrapper.clientIdentifier))
-            return True
-        elif self.customEntries.allowedClients:
-            self.log.debug("Allowing %s based on allowed player %s %s" % (mediaWrapper, mediaWrapper.player.title, mediaWrapper.clientIdentifier))
-        if self.customEntries.blockedClients and (mediaWrapper.player.title in self.customEntries.blockedClients or mediaWrapper.clientIdentifier in self.customEntries.blockedClients):
-            self.log.debug("Blocking %s based on blocked player %s %s" % (mediaWrapper, mediaWrapper.player.title, mediaWrapper.clientIdentifier))
-            return True
-        return False
+    def blockedClientUser(self, mediaWrapper: MediaWrapper) -> bool:
+        decision = self.access.userClient(mediaWrapper.plexsession._username, mediaWrapper.player.title, mediaWrapper.clientIdentifier)
+        self.logDecision(mediaWrapper, decision)
+        return decision.blocked
+
+    def logDecision(self, mediaWrapper: MediaWrapper, decision: Decision) -> None:
+        for verb, reason in decision.reasons:
+            self.log.debug("%s %s%s" % (verb, mediaWrapper, reason))
 
     def shouldAdd(self, mediaWrapper: MediaWrapper) -> bool:
         media = mediaWrapper.media
@@ -471,29 +790,14 @@ class Skipper():
             return False
 
         # Keys
-        allowed = False
-        if media.ratingKey in self.customEntries.allowedKeys:
-            self.log.debug("Allowing %s for ratingKey %s" % (mediaWrapper, media.ratingKey))
-            allowed = True
-        if media.ratingKey in self.customEntries.blockedKeys:
-            self.log.debug("Blocking %s for ratingKey %s" % (mediaWrapper, media.ratingKey))
-            return False
+        ratingKeys = [(RATINGKEY, media.ratingKey)]
         if hasattr(media, PARENTRATINGKEY):
-            if media.parentRatingKey in self.customEntries.allowedKeys:
-                self.log.debug("Allowing %s for parentRatingKey %s" % (mediaWrapper, media.parentRatingKey))
-                allowed = True
-            if media.parentRatingKey in self.customEntries.blockedKeys:
-                self.log.debug("Blocking %s for parentRatingKey %s" % (mediaWrapper, media.parentRatingKey))
-                return False
+            ratingKeys.append((PARENTRATINGKEY, media.parentRatingKey))
         if hasattr(media, GRANDPARENTRATINGKEY):
-            if media.grandparentRatingKey in self.customEntries.allowedKeys:
-                self.log.debug("Allowing %s for grandparentRatingKey %s" % (mediaWrapper, media.grandparentRatingKey))
-                allowed = True
-            if media.grandparentRatingKey in self.customEntries.blockedKeys:
-                self.log.debug("Blocking %s for grandparentRatingKey %s" % (mediaWrapper, media.grandparentRatingKey))
-                return False
-        if self.customEntries.allowedKeys and not allowed:
-            self.log.debug("Blocking %s, not on allowed list" % (mediaWrapper))
+            ratingKeys.append((GRANDPARENTRATINGKEY, media.grandparentRatingKey))
+        decision = self.access.keys(ratingKeys)
+        self.logDecision(mediaWrapper, decision)
+        if decision.blocked:
             return False
 
         # Watched
@@ -529,10 +833,8 @@ class Skipper():
         media = mediaWrapper.media
 
         if hasattr(media, "episodeNumber") and hasattr(media, "seasonNumber"):
-            series = self.server.fetchItem(media.grandparentRatingKey)
-            curr_season = series.season(season=media.seasonNumber)
-            last_season = series.seasons()[-1]
-            if media.episodeNumber == curr_season.episodes()[-1].episodeNumber:
+            series = self.shows.get(media.grandparentRatingKey)
+            if media.episodeNumber == series.lastEpisode(media.seasonNumber):
                 if self.settings.skiplastepisodeseason == Settings.SKIP_TYPES.NEVER:
                     self.log.debug("Erasing tags %s, last episode in season and skip-last-episode-season is %s" % (mediaWrapper, self.settings.skiplastepisodeseason))
                     mediaWrapper.tags = [t for t in mediaWrapper.tags if t in self.settings.lastsafetags]
@@ -541,7 +843,7 @@ class Skipper():
                     self.log.debug("Erasing tags %s, last episode in season and skip-last-episode-season is %s and isWatched %s" % (mediaWrapper, self.settings.skiplastepisodeseason, media.isWatched))
                     mediaWrapper.tags = [t for t in mediaWrapper.tags if t in self.settings.lastsafetags]
                     mediaWrapper.updateMarkers()
-            if media.seasonNumber == last_season.seasonNumber and media.episodeNumber == last_season.episodes()[-1].episodeNumber:
+            if media.seasonNumber == series.lastSeason and media.episodeNumber == series.lastEpisode(series.lastSeason):
                 if self.settings.skiplastepisodeseries == Settings.SKIP_TYPES.NEVER:
                     self.log.debug("Erasing tags %s, last episode in series and skip-last-episode-series is %s" % (mediaWrapper, self.settings.skiplastepisodeseries))
                     mediaWrapper.tags = [t for t in mediaWrapper.tags if t in self.settings.lastsafetags]
@@ -563,26 +865,31 @@ class Skipper():
             self.lastAdjust(mediaWrapper)
             self.checkMedia(mediaWrapper)
             self.media_sessions[mediaWrapper.pasIdentifier] = mediaWrapper
+            self.scheduleCheck(mediaWrapper)
+            if self.prefetcher is not None:
+                self.prefetcher.prefetch(mediaWrapper, self.customEntries)
         else:
             self.log.info("Session %s has no accessible player, it will be ignored" % (mediaWrapper))
             self.ignoreSession(mediaWrapper)
 
     def ignoreSession(self, mediaWrapper: MediaWrapper) -> None:
         self.purgeOldSessions(mediaWrapper)
-        self.ignored.append(mediaWrapper.pasIdentifier)
-        self.ignored = self.ignored[-self.IGNORED_CAP:]
+        self.ignored.add(mediaWrapper.pasIdentifier)
         self.log.debug("Ignoring session %s %s, ignored: %d" % (mediaWrapper, mediaWrapper.plexsession._username, len(self.ignored)))
 
     def purgeOldSessions(self, mediaWrapper: MediaWrapper) -> None:
-        for sessionMediaWrapper in list(self.media_sessions.values()):
-            if sessionMediaWrapper.clientIdentifier == mediaWrapper.player.machineIdentifier:
+        for sessionMediaWrapper in self.media_sessions.byClient(mediaWrapper.player.machineIdentifier):
+            if sessionMediaWrapper is not mediaWrapper:
                 self.log.info("Session %s shares player (%s) with new session %s, deleting old session %s" % (sessionMediaWrapper, mediaWrapper.player.machineIdentifier, mediaWrapper, sessionMediaWrapper.plexsession.sessionKey))
                 self.removeSession(sessionMediaWrapper)
                 break
 
     def removeSession(self, mediaWrapper: MediaWrapper):
-        if mediaWrapper.pasIdentifier in self.media_sessions:
-            del self.media_sessions[mediaWrapper.pasIdentifier]
+        if self.media_sessions.pop(mediaWrapper.pasIdentifier):
+            self.scheduler.cancel(mediaWrapper.pasIdentifier)
+            self.scheduler.cancel((VERIFYKEY, mediaWrapper.pasIdentifier))
+            self.seekTargets.pop(mediaWrapper.pasIdentifier, None)
+            self.nextQueues.pop(mediaWrapper.pasIdentifier, None)
             self.log.debug("Deleting session %s, sessions: %d" % (mediaWrapper, len(self.media_sessions)))
 
     def error(self, data: dict) -> None:
@@ -0,0 +1,168 @@
+import json
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Dict, List
+from resources.metrics import Histogram
+from resources.skipper import Skipper
+from resources.log import getLogger
+
+
+PREFIX = "plexautoskip"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**kwargs) -> str:
+    return "{%s}" % (",".join("%s=\"%s\"" % (k, escape(v)) for k, v in kwargs.items())) if kwargs else ""
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0].rstrip("/")
+        try:
+            if path == "/metrics":
+                self.respond(self.server.status.prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            elif path in ["", "/status"]:
+                self.respond(json.dumps(self.server.status.status(), indent=4), "application/json")
+            else:
+                self.send_error(404)
+        except:
+            self.server.status.log.exception("Error serving status request %s" % (self.path))
+            self.send_error(500)
+
+    def respond(self, body: str, contentType: str) -> None:
+        content = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        self.server.status.log.debug("Status request %s" % (format % args))
+
+
+class StatusServer(Thread):
+    # Optional HTTP endpoint with Prometheus /metrics and JSON /status. Histograms and counters are copied under their
+    # own locks, held only for the copy, so a scrape can briefly contend with an alert or scheduler update but never blocks
+    # on I/O. Everything else is read from plain counters and snapshots on the Skipper without locking
+    def __init__(self, skipper: Skipper, address: str, port: int, logger: logging.Logger = None) -> None:
+        super(StatusServer, self).__init__(name="StatusServer", daemon=True)
+        self.log = logger or getLogger(__name__)
+        self.skipper: Skipper = skipper
+        self.address: str = address
+        self.port: int = port
+        self.httpd: ThreadingHTTPServer = None
+
+    def run(self) -> None:
+        try:
+            self.httpd = ThreadingHTTPServer((self.address, self.port), StatusHandler)
+        except OSError:
+            self.log.exception("Unable to start status server on %s:%d" % (self.address, self.port))
+            return
+        self.httpd.daemon_threads = True
+        self.httpd.status = self
+        self.log.info("Status server listening on http://%s:%d (/metrics, /status)" % (self.address, self.port))
+        self.httpd.serve_forever()
+
+    def stop(self) -> None:
+        if self.httpd:
+            self.httpd.shutdown()
+
+    @property
+    def uptime(self) -> float:
+        return time.monotonic() - self.skipper.metrics.started
+
+    def sessions(self) -> Dict[str, int]:
+        skipper = self.skipper
+        return {
+            "active": len(skipper.media_sessions),
+            "ignored": skipper.ignored.size,
+            "binge": len(skipper.bingeSessions.sessions),
+            "hydrating": len(skipper.hydrating),
+            "sequences": len(skipper.sequencer),
+            "preparedQueues": len(skipper.nextQueues)
+        }
+
+    def caches(self) -> Dict[str, Dict[str, int]]:
+        skipper = self.skipper
+        caches = {
+            "sessions": skipper.sessions,
+            "players": skipper.players,
+            "shows": skipper.shows,
+            "access": skipper.access,
+            "prefetch": skipper.prefetcher
+        }
+        return {name: {"hits": cache.hits, "misses": cache.misses} for name, cache in caches.items() if cache is not None}
+
+    def latencies(self) -> Dict[str, Histogram]:
+        metrics = self.skipper.metrics
+        found = {"loopLag": self.skipper.scheduler.lag.copy()}
+        for (category, name), histogram in metrics.histograms().items():
+            found["%s:%s" % (category, name)] = histogram.copy()
+        return found
+
+    def status(self) -> dict:
+        uptime = self.uptime
+        metrics = self.skipper.metrics
+        alerts = metrics.counters("alerts")
+        caches = self.caches()
+        for cache in caches.values():
+            total = cache["hits"] + cache["misses"]
+            cache["hitRate"] = round(cache["hits"] / total, 3) if total else 0.0
+        return {
+            "engine": self.skipper.__class__.__name__,
+            "uptime": round(uptime, 1),
+            "sessions": self.sessions(),
+            "alerts": {k: {"count": v, "perSecond": round(v / uptime, 3) if uptime else 0.0} for k, v in alerts.items()},
+            "skips": metrics.counters("skips"),
+            "volume": metrics.counters("volume"),
+            "reconnects": sum(metrics.counters("reconnects").values()),
+            "dispatcher": self.skipper.dispatcher.stats(),
+            "caches": caches,
+            "latency": {k: v.toJson() for k, v in sorted(self.latencies().items())}
+        }
+
+    def prometheus(self) -> str:
+        metrics = self.skipper.metrics
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help: str, samples: list) -> None:
+            lines.append("# HELP %s_%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s_%s %s" % (PREFIX, name, kind))
+            for suffix, sampleLabels, value in samples:
+                lines.append("%s_%s%s%s %s" % (PREFIX, name, suffix, labels(**sampleLabels), value))
+
+        metric("uptime_seconds", "gauge", "Seconds since the skipper started", [("", {}, round(self.uptime, 1))])
+        metric("sessions", "gauge", "Tracked sessions by state", [("", {"state": k}, v) for k, v in self.sessions().items()])
+        metric("alerts_total", "counter", "Websocket alerts received by type", [("", {"type": k}, v) for k, v in metrics.counters("alerts").items()])
+        metric("skips_total", "counter", "Skips by marker type", [("", {"type": k}, v) for k, v in metrics.counters("skips").items()])
+        metric("volume_changes_total", "counter", "Volume changes by marker type", [("", {"type": k}, v) for k, v in metrics.counters("volume").items()])
+        metric("reconnects_total", "counter", "Websocket reconnects", [("", {}, sum(metrics.counters("reconnects").values()))])
+
+        caches = self.caches()
+        metric("cache_hits_total", "counter", "Cache hits", [("", {"cache": k}, v["hits"]) for k, v in caches.items()])
+        metric("cache_misses_total", "counter", "Cache misses", [("", {"cache": k}, v["misses"]) for k, v in caches.items()])
+
+        dispatcher = self.skipper.dispatcher.stats()
+        metric("dispatcher_depth", "gauge", "Player commands waiting to run", [("", {}, dispatcher["depth"])])
+        metric("dispatcher_dispatched_total", "counter", "Player commands run", [("", {}, dispatcher["dispatched"])])
+        metric("dispatcher_coalesced_total", "counter", "Player commands dropped for a newer one", [("", {}, dispatcher["coalesced"])])
+
+        histograms = sorted(self.latencies().items())
+        samples = []
+        for key, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip([str(b) for b in Histogram.BOUNDS] + ["+Inf"], histogram.counts):
+                cumulative += count
+                samples.append(("_bucket", {"name": key, "le": bound}, cumulative))
+            samples.append(("_sum", {"name": key}, round(histogram.total, 3)))
+            samples.append(("_count", {"name": key}, histogram.count))
+        metric("latency_milliseconds", "histogram", "Latency of server queries, player commands, skips and the scheduler loop", samples)
+        metric("errors_total", "counter", "Failed calls", [("", {"name": k}, v.errors) for k, v in histograms])
+        metric("timeouts_total", "counter", "Timed out calls", [("", {"name": k}, v.timeouts) for k, v in histograms])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+from resources.accessControl import AccessControl
+from resources.customEntries import CustomEntries, RATINGKEY
+
+
+GRANDPARENTRATINGKEY = "grandparentRatingKey"
+PARENTRATINGKEY = "parentRatingKey"
+
+
+def accessControl(allowed: dict = None, blocked: dict = None) -> AccessControl:
+    custom = CustomEntries({"allowed": allowed or {}, "blocked": blocked or {}})
+    return AccessControl(SimpleNamespace(customEntries=custom))
+
+
+def hierarchy(ratingKey=3, parentRatingKey=2, grandparentRatingKey=1):
+    # Most to least specific, as Skipper passes it
+    return [(RATINGKEY, ratingKey), (PARENTRATINGKEY, parentRatingKey), (GRANDPARENTRATINGKEY, grandparentRatingKey)]
+
+
+def test_no_rules_allows_everything():
+    access = accessControl()
+    assert not access.userClient("alice", "Living Room", "client-a").blocked
+    assert not access.keys(hierarchy()).blocked
+
+
+def test_blocked_user_wins_over_allowed_user():
+    access = accessControl(allowed={"users": ["alice"]}, blocked={"users": ["alice"]})
+    assert access.userClient("alice", "Living Room", "client-a").blocked
+
+
+def test_allowed_users_block_everyone_else():
+    access = accessControl(allowed={"users": ["alice"]})
+    assert not access.userClient("alice", "Living Room", "client-a").blocked
+    assert access.userClient("bob", "Living Room", "client-a").blocked
+
+
+def test_clients_match_title_or_identifier():
+    access = accessControl(allowed={"clients": ["client-a"]}, blocked={"clients": ["Bedroom"]})
+    assert not access.userClient("alice", "Living Room", "client-a").blocked
+    assert access.userClient("alice", "Living Room", "client-b").blocked
+    assert access.userClient("alice", "Bedroom", "client-a").blocked
+
+
+def test_blocked_key_at_any_level_wins_over_allowed_key():
+    access = accessControl(allowed={"keys": [1]}, blocked={"keys": [3]})
+    decision = access.keys(hierarchy())
+    assert decision.blocked
+    assert decision.reasons[-1][0] == "Blocking"
+
+    access = accessControl(allowed={"keys": [3]}, blocked={"keys": [1]})
+    assert access.keys(hierarchy()).blocked
+
+
+def test_allowed_show_allows_its_episodes_only():
+    access = accessControl(allowed={"keys": [1]})
+    assert not access.keys(hierarchy()).blocked
+    assert access.keys(hierarchy(30, 20, 10)).blocked
+
+
+def test_keys_are_normalized():
+    access = accessControl(allowed={"keys": [" 2 "]})
+    assert not access.keys(hierarchy()).blocked
+
+
+def test_decisions_are_memoized_and_rebuilt_on_new_version():
+    access = accessControl(blocked={"keys": [3]})
+    assert access.keys(hierarchy()).blocked
+    assert access.keys(hierarchy()).blocked
+    assert (access.hits, access.misses) == (1, 1)
+
+    custom = access.settings.customEntries
+    custom.blockedKeys.clear()
+    custom.invalidate()
+    assert not access.keys(hierarchy()).blocked
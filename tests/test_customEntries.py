@@ -0,0 +1,164 @@
+import random
+from types import SimpleNamespace
+from resources.customEntries import CustomEntries, RATINGKEY
+from resources.settings import Settings
+
+
+GRANDPARENTRATINGKEY = "grandparentRatingKey"
+PARENTRATINGKEY = "parentRatingKey"
+KEYS = ["1", "2", "3", "10", "11"]
+PLAYERS = ["Living Room", "client-a", "client-b"]
+MODES = ["skip", "volume", "mute", "unknown"]
+
+
+def legacy(custom, hierarchy, title, clientIdentifier, machineIdentifier, product, skipnext):
+    # Per-call resolution as MediaWrapper did it before policies were compiled
+    state = SimpleNamespace(markers=[], leftOffset=0, rightOffset=0, offsetTags=["intro"], tags=["Intro"], mode=Settings.MODE_TYPES.SKIP, commandDelay=0, skipnext=skipnext)
+    for level, ratingKey in hierarchy:
+        k = str(ratingKey)
+        if k in custom.markers:
+            state.markers.append((level, ratingKey, list(custom.markers[k])))
+        if k in custom.offsets:
+            state.leftOffset = custom.offsets[k].get("start", state.leftOffset)
+            state.rightOffset = custom.offsets[k].get("end", state.rightOffset)
+            state.offsetTags = custom.offsets[k].get("tags", state.offsetTags)
+        if k in custom.tags:
+            state.tags = custom.tags[k]
+        if k in custom.mode:
+            state.mode = Settings.MODE_MATCHER.get(custom.mode[k], state.mode)
+
+    if title in custom.mode:
+        state.mode = Settings.MODE_MATCHER.get(custom.mode[title], state.mode)
+    elif clientIdentifier in custom.mode:
+        state.mode = Settings.MODE_MATCHER.get(custom.mode[clientIdentifier], state.mode)
+
+    if title in custom.offsets:
+        state.commandDelay = custom.offsets[title].get("command", state.commandDelay)
+    elif clientIdentifier in custom.offsets:
+        state.commandDelay = custom.offsets[clientIdentifier].get("command", state.commandDelay)
+
+    if not state.skipnext and custom.allowedSkipNext and (title in custom.allowedSkipNext or clientIdentifier in custom.allowedSkipNext):
+        state.skipnext = True
+    elif state.skipnext and custom.allowedSkipNext and (title not in custom.allowedSkipNext and clientIdentifier not in custom.allowedSkipNext):
+        state.skipnext = False
+    elif state.skipnext and custom.blockedSkipNext and (title in custom.blockedSkipNext or clientIdentifier in custom.blockedSkipNext):
+        state.skipnext = False
+
+    state.tags = [x.lower() for x in state.tags]
+    state.playerTags = [x.lower() for x in custom.tags.get(machineIdentifier, custom.tags.get(product, []))]
+    return state
+
+
+def applied(custom, hierarchy, title, clientIdentifier, machineIdentifier, product, skipnext):
+    # Policy application as MediaWrapper does it now
+    policy = custom.policy(hierarchy, title, clientIdentifier, machineIdentifier, product)
+    state = SimpleNamespace(markers=[(g.level, g.ratingKey, list(g.markers)) for g in policy.markerGroups], leftOffset=0, rightOffset=0, offsetTags=["intro"], tags=["intro"], mode=Settings.MODE_TYPES.SKIP, skipnext=skipnext)
+    if policy.leftOffset is not None:
+        state.leftOffset = policy.leftOffset
+    if policy.rightOffset is not None:
+        state.rightOffset = policy.rightOffset
+    if policy.offsetTags is not None:
+        state.offsetTags = list(policy.offsetTags)
+    if policy.tags is not None:
+        state.tags = list(policy.tags)
+    for mode in policy.modes:
+        state.mode = Settings.MODE_MATCHER.get(mode, state.mode)
+    state.commandDelay = policy.commandDelay
+    state.skipnext = not policy.blockSkipNext if skipnext else policy.allowSkipNext
+    state.playerTags = list(policy.playerTags)
+    return state
+
+
+def randomEntries(rng: random.Random) -> dict:
+    def some(population):
+        return rng.sample(population, rng.randint(0, len(population)))
+
+    offsets = {}
+    for k in some(KEYS):
+        offsets[k] = {field: rng.randint(-5000, 5000) for field in some(["start", "end"])}
+        if rng.random() < 0.5:
+            offsets[k]["tags"] = some(["intro", "credits", "commercial"])
+    for player in some(PLAYERS):
+        offsets[player] = {"command": rng.randint(0, 1000)} if rng.random() < 0.8 else {}
+    tags = {k: some(["Intro", "CREDITS", "commercial"]) for k in some(KEYS + ["machine-1", "Plex Web"])}
+    return {
+        "markers": {k: [{"start": rng.randint(0, 1000), "end": rng.randint(1000, 2000)}] for k in some(KEYS)},
+        "offsets": offsets,
+        "tags": tags,
+        "mode": {k: rng.choice(MODES) for k in some(KEYS + PLAYERS)},
+        "allowed": {"users": [], "clients": [], "keys": [], "skip-next": some(PLAYERS)},
+        "blocked": {"users": [], "clients": [], "keys": [], "skip-next": some(PLAYERS)},
+        "clients": {}
+    }
+
+
+def test_policy_matches_legacy_resolution():
+    rng = random.Random(7)
+    for _ in range(500):
+        custom = CustomEntries(randomEntries(rng))
+        hierarchy = [(level, int(k)) for level, k in zip([GRANDPARENTRATINGKEY, PARENTRATINGKEY, RATINGKEY], rng.sample(KEYS, 3))]
+        hierarchy = hierarchy[rng.randint(0, 2):]
+        title, clientIdentifier = rng.sample(PLAYERS, 2)
+        machineIdentifier = rng.choice(["machine-1", "machine-2"])
+        product = rng.choice(["Plex Web", "Plex for Android"])
+        for skipnext in (False, True):
+            expected = legacy(custom, hierarchy, title, clientIdentifier, machineIdentifier, product, skipnext)
+            # Twice so the cached policy is checked as well
+            assert applied(custom, hierarchy, title, clientIdentifier, machineIdentifier, product, skipnext) == expected
+            assert applied(custom, hierarchy, title, clientIdentifier, machineIdentifier, product, skipnext) == expected
+
+
+def test_policy_is_cached_until_invalidated():
+    custom = CustomEntries({"offsets": {"1": {"start": 1000}}})
+    hierarchy = [(RATINGKEY, 1)]
+    policy = custom.policy(hierarchy, "Living Room", "client-a", "machine-1", "Plex Web")
+    assert custom.policy(hierarchy, "Living Room", "client-a", "machine-1", "Plex Web") is policy
+
+    custom.offsets["1"]["start"] = 2000
+    custom.invalidate()
+    assert custom.policy(hierarchy, "Living Room", "client-a", "machine-1", "Plex Web").leftOffset == 2000
+
+
+def test_targeted_invalidate_keeps_unrelated_policies():
+    custom = CustomEntries({"offsets": {"1": {"start": 1000}, "2": {"start": 2000}}})
+    first = custom.policy([(RATINGKEY, 1)], "Living Room", "client-a", "machine-1", "Plex Web")
+    second = custom.policy([(RATINGKEY, 2)], "Living Room", "client-a", "machine-1", "Plex Web")
+    custom.invalidate({"1"})
+    assert custom.policy([(RATINGKEY, 1)], "Living Room", "client-a", "machine-1", "Plex Web") is not first
+    assert custom.policy([(RATINGKEY, 2)], "Living Room", "client-a", "machine-1", "Plex Web") is second
+
+
+def test_policy_cache_is_bounded():
+    custom = CustomEntries({})
+    custom.POLICY_CAP = 10
+    for ratingKey in range(25):
+        custom.policy([(RATINGKEY, ratingKey)], "Living Room", "client-a", "machine-1", "Plex Web")
+    assert len(custom._policies) == 10
+
+
+def test_convert_reuses_resolved_guids(monkeypatch):
+    loads = []
+    monkeypatch.setattr(CustomEntries, "loadGuids", staticmethod(lambda server, logger=None: loads.append(server) or {}))
+    monkeypatch.setattr(CustomEntries, "resolveGuidToKey", staticmethod(lambda key, lookup, showTables: "100" if key == "tvdb://1" else key))
+    data = {"markers": {"tvdb://1": [{"start": 0, "end": 1000}]}, "allowed": {"keys": ["tvdb://1"]}}
+
+    first = CustomEntries({k: dict(v) for k, v in data.items()})
+    first.convertToRatingKeys(None)
+    assert list(first.markers) == ["100"] and len(loads) == 1
+
+    second = CustomEntries({"markers": dict(data["markers"]), "allowed": {"keys": ["tvdb://1"]}})
+    second.convertToRatingKeys(None, None, first.resolved)
+    assert list(second.markers) == ["100"]
+    assert 100 in second.allowedKeys
+    assert len(loads) == 1
+
+
+def test_match_guids_skips_missing_episode_numbers(monkeypatch):
+    custom = CustomEntries({"markers": {"tvdb://5.1": [{"start": 0, "end": 1000}]}})
+    monkeypatch.setattr(custom, "showGuids", lambda media: ["tvdb://5"])
+    special = SimpleNamespace(ratingKey=30, grandparentRatingKey=10, parentRatingKey=20, type="episode", guids=[], seasonNumber=None, episodeNumber=None)
+    assert not custom.matchGuids(special)
+
+    episode = SimpleNamespace(ratingKey=31, grandparentRatingKey=10, parentRatingKey=21, type="episode", guids=[], seasonNumber=1, episodeNumber=None)
+    assert custom.matchGuids(episode)
+    assert "21" in custom.markers
@@ -0,0 +1,68 @@
+import time
+from threading import Event, Lock
+from resources.dispatcher import CommandDispatcher, SEEKCOMMAND, VOLUMECOMMAND
+
+
+def waitFor(condition, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class Recorder():
+    def __init__(self) -> None:
+        self.calls = []
+        self.lock = Lock()
+        self.release = Event()
+
+    def block(self) -> None:
+        self.release.wait(5)
+
+    def record(self, *args) -> None:
+        with self.lock:
+            self.calls.append(args)
+
+
+def test_newer_command_of_same_kind_and_key_replaces_queued_one():
+    dispatcher = CommandDispatcher(workers=1)
+    recorder = Recorder()
+    dispatcher.submit("client-a", SEEKCOMMAND, "block", recorder.block)
+    assert waitFor(lambda: dispatcher.dispatched == 1)
+
+    dispatcher.submit("client-a", SEEKCOMMAND, "session-1", recorder.record, "seek", 1000)
+    dispatcher.submit("client-a", VOLUMECOMMAND, "session-1", recorder.record, "volume", 10)
+    dispatcher.submit("client-a", SEEKCOMMAND, "session-2", recorder.record, "seek", 2000)
+    dispatcher.submit("client-a", SEEKCOMMAND, "session-1", recorder.record, "seek", 3000)
+    assert dispatcher.coalesced == 1
+    assert dispatcher.depths() == {"client-a": 3}
+
+    recorder.release.set()
+    assert waitFor(lambda: len(recorder.calls) == 3)
+    # Same player runs in submission order, the superseded seek is gone
+    assert recorder.calls == [("volume", 10), ("seek", 2000), ("seek", 3000)]
+    assert waitFor(lambda: dispatcher.depth == 0 and not dispatcher.depths())
+
+
+def test_players_run_in_parallel():
+    dispatcher = CommandDispatcher(workers=2)
+    recorder = Recorder()
+    dispatcher.submit("client-a", SEEKCOMMAND, "session-1", recorder.block)
+    dispatcher.submit("client-b", SEEKCOMMAND, "session-2", recorder.record, "b")
+    assert waitFor(lambda: recorder.calls == [("b",)])
+    recorder.release.set()
+
+
+def test_failing_command_does_not_stop_the_player_queue():
+    dispatcher = CommandDispatcher(workers=1)
+    recorder = Recorder()
+
+    def fail():
+        raise RuntimeError("player unreachable")
+
+    dispatcher.submit("client-a", SEEKCOMMAND, "session-1", fail)
+    dispatcher.submit("client-a", VOLUMECOMMAND, "session-1", recorder.record, "volume")
+    assert waitFor(lambda: recorder.calls == [("volume",)])
+    assert dispatcher.stats()["dispatched"] == 2
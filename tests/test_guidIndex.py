@@ -0,0 +1,108 @@
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlsplit
+from xml.etree.ElementTree import Element, SubElement
+import pytest
+from resources.guidIndex import GuidIndex, SHOWTYPE, SEASONTYPE, EPISODETYPE
+
+
+SECTION = 1
+
+
+class FakeLibrary():
+    # Answers the section listings GuidIndex requests from a list of item attribute dicts
+    def __init__(self) -> None:
+        self.items = []
+        self.queries = []
+
+    def add(self, ratingKey: int, itemType: int, updatedAt: int, guid: str = None, **attrib) -> None:
+        self.items.append(dict(attrib, ratingKey=ratingKey, type=itemType, updatedAt=updatedAt, guid=guid))
+
+    def remove(self, ratingKey: int) -> None:
+        self.items = [i for i in self.items if i["ratingKey"] != ratingKey]
+
+    def query(self, key: str, params: dict = None) -> Element:
+        self.queries.append(key)
+        # updatedAt>>= isn't valid query string syntax, split it off by hand
+        path, _, since = key.partition("&updatedAt>>=")
+        args = parse_qs(urlsplit(path).query)
+        items = [i for i in self.items if i["type"] == int(args["type"][0]) and (not since or i["updatedAt"] >= int(since))]
+        if args.get("sort") == ["updatedAt:desc"]:
+            items.sort(key=lambda i: i["updatedAt"], reverse=True)
+        start, size = params["X-Plex-Container-Start"], params["X-Plex-Container-Size"]
+        container = Element("MediaContainer", totalSize=str(len(items)))
+        for item in items[start:start + size]:
+            element = SubElement(container, "Directory", {k: str(v) for k, v in item.items() if k not in ("guid", "type") and v is not None})
+            if item["guid"]:
+                SubElement(element, "Guid", id=item["guid"])
+        return container
+
+
+@pytest.fixture
+def library() -> FakeLibrary:
+    library = FakeLibrary()
+    library.add(10, SHOWTYPE, 100, "tvdb://5")
+    library.add(20, SEASONTYPE, 100, parentRatingKey=10, index=1)
+    library.add(30, EPISODETYPE, 100, parentRatingKey=20, grandparentRatingKey=10, parentIndex=1, index=2)
+    library.add(31, EPISODETYPE, 100, parentRatingKey=20, grandparentRatingKey=10, parentIndex=1)
+    return library
+
+
+def refresh(index: GuidIndex) -> None:
+    index.refreshSection(SECTION, "uuid", [SHOWTYPE, SEASONTYPE, EPISODETYPE])
+
+
+def test_resolve_and_reverse(tmp_path, library):
+    index = GuidIndex(library, str(tmp_path))
+    refresh(index)
+    assert index.resolve("tvdb://5") == 10
+    assert index.resolve("tvdb://5.1") == 20
+    assert index.resolve("tvdb://5.1.2") == 30
+    assert index.guidFor(30, "tvdb://") == "tvdb://5.1.2"
+    assert index.guidFor(20, "tvdb://") == "tvdb://5.1"
+
+
+def test_reverse_lookup_without_episode_number(tmp_path, library):
+    index = GuidIndex(library, str(tmp_path))
+    refresh(index)
+    assert index.guidFor(31, "tvdb://") is None
+
+
+def test_unchanged_section_is_not_pulled_again(tmp_path, library):
+    index = GuidIndex(library, str(tmp_path))
+    refresh(index)
+    library.queries.clear()
+    refresh(index)
+    # One state request per type and nothing else
+    assert len(library.queries) == 3
+
+
+def test_edit_is_pulled_incrementally(tmp_path, library):
+    index = GuidIndex(library, str(tmp_path))
+    refresh(index)
+    library.remove(10)
+    library.add(10, SHOWTYPE, int(time.time()) + 1000, "tvdb://6")
+    refresh(index)
+    assert index.resolve("tvdb://6") == 10
+    assert index.resolve("tvdb://5") is None
+
+
+def test_delete_plus_add_is_detected(tmp_path, library):
+    index = GuidIndex(library, str(tmp_path))
+    refresh(index)
+    library.remove(30)
+    library.add(32, EPISODETYPE, int(time.time()) + 1000, parentRatingKey=20, grandparentRatingKey=10, parentIndex=1, index=3)
+    refresh(index)
+    assert index.resolve("tvdb://5.1.3") == 32
+    assert index.resolve("tvdb://5.1.2") is None
+    assert len(index) == 4
+
+
+def test_read_only_index_never_writes(tmp_path, library):
+    writer = GuidIndex(library, str(tmp_path))
+    refresh(writer)
+    writer.close()
+    index = GuidIndex(None, str(tmp_path), readOnly=True)
+    assert index.resolve("tvdb://5.1.2") == 30
+    with pytest.raises(sqlite3.OperationalError):
+        index._db.execute("DELETE FROM items")
@@ -0,0 +1,85 @@
+import random
+from resources.intervals import Interval, IntervalIndex
+
+
+def interval(start, end, priority=0, label="intro") -> Interval:
+    return Interval(start, end, end, priority, label)
+
+
+def bruteForce(intervals, offset):
+    covering = [i for i in intervals if i.start <= offset < i.end]
+    return min(covering, key=lambda i: i.priority) if covering else None
+
+
+def test_empty_index():
+    index = IntervalIndex()
+    assert len(index) == 0
+    assert index.find(0) is None
+    assert index.next(0) is None
+
+
+def test_find_is_start_inclusive_end_exclusive():
+    intro = interval(1000, 2000)
+    index = IntervalIndex([intro])
+    assert index.find(999) is None
+    assert index.find(1000) is intro
+    assert index.find(1999) is intro
+    assert index.find(2000) is None
+
+
+def test_overlapping_intervals_resolve_to_highest_priority():
+    low = interval(0, 10000, priority=2, label="chapter")
+    high = interval(2000, 4000, priority=0, label="intro")
+    middle = interval(3000, 6000, priority=1, label="custom")
+    index = IntervalIndex([low, high, middle])
+    assert index.find(1000) is low
+    assert index.find(2500) is high
+    assert index.find(3500) is high
+    assert index.find(4500) is middle
+    assert index.find(6500) is low
+    assert index.find(10000) is None
+
+
+def test_ties_go_to_the_earlier_interval():
+    first = interval(0, 2000, label="first")
+    second = interval(1000, 3000, label="second")
+    index = IntervalIndex([first, second])
+    assert index.find(1500) is first
+    assert index.find(2500) is second
+
+
+def test_next_returns_the_following_boundary():
+    low = interval(0, 10000, priority=2)
+    high = interval(2000, 4000, priority=0)
+    index = IntervalIndex([low, high])
+    assert index.next(-1) == 0
+    assert index.next(0) == 2000
+    assert index.next(2500) == 4000
+    assert index.next(4000) == 10000
+    assert index.next(10000) is None
+
+
+def test_nested_same_winner_is_merged():
+    outer = interval(0, 5000, priority=0)
+    inner = interval(1000, 2000, priority=1)
+    index = IntervalIndex([outer, inner])
+    assert index.bounds == [0, 5000]
+    assert index.next(500) == 5000
+
+
+def test_empty_and_inverted_intervals_are_ignored():
+    index = IntervalIndex([interval(1000, 1000), interval(2000, 1000)])
+    assert len(index) == 0
+    assert index.find(1000) is None
+
+
+def test_matches_brute_force():
+    rng = random.Random(3)
+    for _ in range(500):
+        intervals = []
+        for _ in range(rng.randint(0, 12)):
+            start = rng.randint(0, 100)
+            intervals.append(interval(start, start + rng.randint(-5, 60), priority=rng.randint(0, 3)))
+        index = IntervalIndex(intervals)
+        for offset in range(-1, 170):
+            assert index.find(offset) is bruteForce(intervals, offset)
@@ -0,0 +1,61 @@
+import json
+import os
+from types import SimpleNamespace
+from resources.latencyModel import LatencyModel
+
+
+def player(machineIdentifier: str = "machine-1", product: str = "Plex Web"):
+    return SimpleNamespace(machineIdentifier=machineIdentifier, product=product)
+
+
+def test_unknown_player_has_no_lead(tmp_path):
+    model = LatencyModel(str(tmp_path))
+    assert model.lead(player()) == 0
+    assert model.lead(None) == 0
+
+
+def test_half_round_trip_until_enough_seeks_landed(tmp_path):
+    model = LatencyModel(str(tmp_path))
+    model.command(player(), 200)
+    assert model.lead(player()) == 100
+    model.landed(player(), 400)
+    assert model.lead(player()) == 100
+
+
+def test_lead_is_smoothed_after_min_samples(tmp_path):
+    model = LatencyModel(str(tmp_path), alpha=0.5)
+    for latency in (400, 400, 800):
+        model.landed(player(), latency)
+    assert model.lead(player()) == 600
+
+
+def test_samples_are_clamped(tmp_path):
+    model = LatencyModel(str(tmp_path))
+    for _ in range(LatencyModel.MIN_SAMPLES):
+        model.landed(player(), 60000)
+    assert model.lead(player()) == LatencyModel.MAX_LEAD
+
+
+def test_product_is_the_fallback_for_new_devices(tmp_path):
+    model = LatencyModel(str(tmp_path), alpha=1)
+    for _ in range(LatencyModel.MIN_SAMPLES):
+        model.landed(player("machine-1"), 300)
+    assert model.lead(player("machine-2")) == 300
+    assert model.lead(player("machine-3", "Plex for Android")) == 0
+
+
+def test_estimates_survive_a_restart(tmp_path):
+    model = LatencyModel(str(tmp_path), alpha=1)
+    for _ in range(LatencyModel.MIN_SAMPLES):
+        model.landed(player(), 250)
+    model.save(force=True)
+    path = os.path.join(str(tmp_path), LatencyModel.FILENAME)
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f)["devices"]["machine-1"]["samples"] == LatencyModel.MIN_SAMPLES
+    assert LatencyModel(str(tmp_path)).lead(player()) == 250
+
+
+def test_corrupt_cache_starts_fresh(tmp_path):
+    with open(os.path.join(str(tmp_path), LatencyModel.FILENAME), "w") as f:
+        f.write("{not json")
+    assert LatencyModel(str(tmp_path)).lead(player()) == 0
@@ -0,0 +1,82 @@
+from threading import Thread
+from types import SimpleNamespace
+import pytest
+from requests.exceptions import Timeout
+from resources.metrics import CALL, ENDPOINT, PLAYER, Histogram, Metrics
+
+
+def test_buckets_and_summary():
+    histogram = Histogram()
+    for elapsed in (1, 7, 7, 40, 20000, 45000):
+        histogram.observe(elapsed)
+    data = histogram.toJson()
+    assert data["count"] == 6
+    assert data["buckets"]["5"] == 1
+    assert data["buckets"]["10"] == 2
+    assert data["buckets"]["50"] == 1
+    assert data["buckets"]["30000"] == 1
+    assert data["buckets"]["+Inf"] == 1
+    assert data["max"] == 45000
+    assert histogram.average == pytest.approx(65055 / 6)
+
+
+def test_percentiles_are_bucket_bounds_capped_at_max():
+    histogram = Histogram()
+    assert histogram.percentile(0.5) == 0.0
+    for elapsed in range(1, 101):
+        histogram.observe(elapsed)
+    assert histogram.percentile(0.05) == 5
+    assert histogram.percentile(0.5) == 50
+    assert histogram.percentile(0.99) == 100
+
+
+def test_concurrent_observes_are_not_lost():
+    histogram = Histogram()
+    metrics = Metrics()
+
+    def record():
+        for n in range(5000):
+            histogram.observe(n % 100)
+            metrics.increment("alerts", "playing")
+
+    threads = [Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    copy = histogram.copy()
+    assert copy.count == 40000
+    assert sum(copy.counts) == 40000
+    assert metrics.counters("alerts") == {"playing": 40000}
+
+
+def test_endpoint_collapses_ids():
+    assert Metrics.endpoint("http://plex:32400/library/metadata/1234/children") == "/library/metadata/{id}/children"
+    assert Metrics.endpoint("http://plex:32400/playQueues/55") == "/playQueues/{id}"
+    assert Metrics.endpoint("http://plex:32400") == "/"
+
+
+def test_response_hook_records_endpoint_and_player():
+    metrics = Metrics()
+    request = SimpleNamespace(headers={"X-Plex-Target-Client-Identifier": "client-a"})
+    response = SimpleNamespace(elapsed=SimpleNamespace(total_seconds=lambda: 0.02), url="http://plex:32400/player/playback/seekTo", status_code=500, request=request)
+    metrics.responseHook(response)
+    endpoint = metrics.histograms(ENDPOINT)[(ENDPOINT, "/player/playback/seekTo")]
+    assert endpoint.count == 1 and endpoint.errors == 1
+    assert metrics.histograms(PLAYER)[(PLAYER, "client-a")].errors == 1
+
+
+def test_timed_counts_errors_and_timeouts():
+    metrics = Metrics()
+    player = SimpleNamespace(product="Plex Web")
+    with metrics.timed("seek", player):
+        pass
+    with pytest.raises(Timeout):
+        with metrics.timed("seek"):
+            raise Timeout()
+    with pytest.raises(ValueError):
+        with metrics.timed("seek"):
+            raise ValueError()
+    seek = metrics.histogram(CALL, "seek")
+    assert (seek.count, seek.errors, seek.timeouts) == (3, 1, 1)
+    assert metrics.histogram(CALL, "seek:Plex Web").count == 1
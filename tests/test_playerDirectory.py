@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+from resources.playerDirectory import PlayerDirectory, commandRequest
+
+
+class FakeServer():
+    def __init__(self, clients=(), ports=None) -> None:
+        self._clients = list(clients)
+        self.ports = ports or {}
+        self.calls = {"clients": 0, "ports": 0}
+        self.fail = False
+
+    def clients(self):
+        self.calls["clients"] += 1
+        if self.fail:
+            raise ConnectionError()
+        return self._clients
+
+    def _myPlexClientPorts(self):
+        self.calls["ports"] += 1
+        if self.fail:
+            raise ConnectionError()
+        return self.ports
+
+
+def client(machineIdentifier: str = "machine-1", address: str = "10.0.0.5", port: int = 32433):
+    return SimpleNamespace(machineIdentifier=machineIdentifier, address=address, _baseurl="http://%s:%d" % (address, port), protocolCapabilities=["playback"])
+
+
+def player(machineIdentifier: str = "machine-1", address: str = "10.0.0.5"):
+    return SimpleNamespace(machineIdentifier=machineIdentifier, address=address, product="Plex for Android")
+
+
+def test_plex_tv_port_wins():
+    directory = PlayerDirectory(FakeServer([client()], {"machine-1": "32600"}))
+    assert directory.connection(player(), 32500) == "http://10.0.0.5:32600"
+
+
+def test_clients_port_before_default():
+    directory = PlayerDirectory(FakeServer([client()]))
+    assert directory.connection(player(), 32500) == "http://10.0.0.5:32433"
+
+
+def test_default_port_for_unknown_players():
+    directory = PlayerDirectory(FakeServer())
+    assert directory.connection(player(), 32500) == "http://10.0.0.5:32500"
+
+
+def test_mismatched_address_is_proxied():
+    directory = PlayerDirectory(FakeServer([client(address="127.0.0.1")]))
+    assert directory.connection(player(), 32500) is None
+
+
+def test_decisions_are_cached_until_invalidated():
+    server = FakeServer([client()])
+    directory = PlayerDirectory(server)
+    directory.connection(player(), 32500)
+    directory.connection(player(), 32500)
+    assert (directory.hits, directory.misses) == (1, 1)
+    directory.invalidate("machine-1")
+    directory.connection(player(), 32500)
+    assert directory.misses == 2
+    assert server.calls["clients"] == 2
+
+
+def test_failed_fetch_is_not_retried_inline():
+    server = FakeServer([client()])
+    server.fail = True
+    directory = PlayerDirectory(server)
+    for n in range(5):
+        assert directory.connection(player("machine-%d" % (n)), 32500) == "http://10.0.0.5:32500"
+    assert server.calls == {"clients": 1, "ports": 1}
+
+    server.fail = False
+    directory._failed.clear()
+    assert directory.connection(player("machine-1"), 32500) == "http://10.0.0.5:32433"
+
+
+def commandPlayer(proxy: bool):
+    server = SimpleNamespace(url=lambda key: "http://server:32400%s" % (key), _headers=lambda **h: dict({"X-Plex-Token": "server"}, **h))
+    return SimpleNamespace(machineIdentifier="machine-1", _proxyThroughServer=proxy, _server=server, _nextCommandId=lambda: 7,
+                           url=lambda key: "http://10.0.0.5:32500%s" % (key), _headers=lambda: {"X-Plex-Token": "client"})
+
+
+def test_command_request_direct_and_proxied():
+    url, headers = commandRequest(commandPlayer(False), "playback/seekTo", offset=1000)
+    assert url == "http://10.0.0.5:32500/player/playback/seekTo?commandID=7&offset=1000"
+    assert headers == {"X-Plex-Token": "client", "X-Plex-Target-Client-Identifier": "machine-1"}
+
+    url, headers = commandRequest(commandPlayer(True), "playback/seekTo", offset=1000)
+    assert url.startswith("http://server:32400/player/playback/seekTo?")
+    assert headers == {"X-Plex-Token": "server", "X-Plex-Target-Client-Identifier": "machine-1"}
@@ -0,0 +1,54 @@
+import time
+from threading import Thread
+from resources.scheduler import Scheduler
+
+
+def test_due_keys_come_out_in_deadline_order():
+    scheduler = Scheduler()
+    scheduler.schedule("late", 0.05)
+    scheduler.schedule("now", 0)
+    assert scheduler.wait(1) == ["now"]
+    assert scheduler.wait(1) == ["late"]
+    assert len(scheduler) == 0
+    assert scheduler.lag.count == 2
+
+
+def test_rescheduling_replaces_the_previous_deadline():
+    scheduler = Scheduler()
+    scheduler.schedule("key", 0)
+    scheduler.schedule("key", 60)
+    assert scheduler.wait(0.05) == []
+    assert len(scheduler) == 1
+
+    scheduler.schedule("key", 0)
+    assert scheduler.wait(1) == ["key"]
+    assert scheduler.wait(0.05) == []
+
+
+def test_cancelled_keys_are_never_returned():
+    scheduler = Scheduler()
+    scheduler.schedule("key", 0)
+    scheduler.cancel("key")
+    assert scheduler.deadline("key") is None
+    assert scheduler.wait(0.05) == []
+
+
+def test_earlier_deadline_wakes_a_waiter():
+    scheduler = Scheduler()
+    scheduler.schedule("far", 60)
+    due = []
+    waiter = Thread(target=lambda: due.extend(scheduler.wait(5)))
+    waiter.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    scheduler.schedule("near", 0)
+    waiter.join(5)
+    assert due == ["near"]
+    assert time.monotonic() - started < 1
+
+
+def test_superseded_entries_are_compacted():
+    scheduler = Scheduler()
+    for _ in range(100):
+        scheduler.schedule("key", 60)
+    assert len(scheduler._heap) <= Scheduler.COMPACT_RATIO
@@ -0,0 +1,81 @@
+from resources.sequencer import Sequencer, Step
+
+
+def steps(count: int = 2):
+    return [Step(0, "step%d" % (n), lambda: None) for n in range(count)]
+
+
+def test_steps_run_in_order_and_complete():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps(2))
+    assert sequencer.pending("client-a") is sequence
+
+    step = sequencer.next(sequence)
+    assert step.label == "step0"
+    assert sequencer.begin(sequence)
+    assert sequencer.complete(sequence)
+
+    assert sequencer.next(sequence).label == "step1"
+    assert sequencer.begin(sequence)
+    assert not sequencer.complete(sequence)
+    assert sequencer.pending("client-a") is None
+    assert sequencer.completed == 1
+
+
+def test_newer_sequence_replaces_pending_one():
+    sequencer = Sequencer()
+    first = sequencer.start("client-a", "skipNext", steps())
+    second = sequencer.start("client-a", "seek", steps())
+    assert first.cancelled and not second.cancelled
+    assert sequencer.next(first) is None
+    assert sequencer.pending("client-a") is second
+    assert sequencer.cancelled == 1
+
+
+def test_cancel_before_begin_stops_the_step():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps())
+    sequencer.next(sequence)
+    assert sequencer.cancel("client-a") is sequence
+    assert not sequencer.begin(sequence)
+    assert sequencer.next(sequence) is None
+    assert len(sequencer) == 0
+
+
+def test_cancel_drops_remaining_steps_after_a_running_one():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps(2))
+    sequencer.next(sequence)
+    sequencer.begin(sequence)
+    assert sequencer.cancel("client-a") is sequence
+    assert not sequencer.complete(sequence)
+    assert sequencer.completed == 0
+
+
+def test_cancel_is_a_no_op_while_the_last_step_runs():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps(1))
+    sequencer.next(sequence)
+    sequencer.begin(sequence)
+    assert sequencer.cancel("client-a") is None
+    assert not sequence.cancelled
+    assert not sequencer.complete(sequence)
+    assert sequencer.completed == 1
+
+
+def test_failed_step_cancels_the_rest():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps(2))
+    sequencer.next(sequence)
+    sequencer.begin(sequence)
+    assert not sequencer.complete(sequence, failed=True)
+    assert sequence.cancelled
+    assert sequencer.pending("client-a") is None
+
+
+def test_owns():
+    sequencer = Sequencer()
+    sequence = sequencer.start("client-a", "skipNext", steps())
+    assert Sequencer.owns(sequence.key)
+    assert not Sequencer.owns("client-a")
+    assert not Sequencer.owns(("other", "client-a"))
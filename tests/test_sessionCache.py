@@ -0,0 +1,93 @@
+import time
+from threading import Event, Thread
+from types import SimpleNamespace
+from resources.sessionCache import SessionSnapshot
+
+
+class FakeServer():
+    def __init__(self, sessionKeys=(1,), delay: float = 0) -> None:
+        self.sessionKeys = list(sessionKeys)
+        self.delay = delay
+        self.calls = 0
+        self.entered = Event()
+
+    def sessions(self):
+        self.calls += 1
+        self.entered.set()
+        time.sleep(self.delay)
+        return [SimpleNamespace(sessionKey=k) for k in self.sessionKeys]
+
+
+def test_fresh_snapshot_is_reused():
+    server = FakeServer()
+    snapshot = SessionSnapshot(server, ttl=60)
+    assert snapshot.get(1).sessionKey == 1
+    assert snapshot.get(1).sessionKey == 1
+    assert server.calls == 1
+    assert (snapshot.hits, snapshot.misses) == (2, 0)
+
+
+def test_concurrent_callers_share_one_request():
+    server = FakeServer(delay=0.1)
+    snapshot = SessionSnapshot(server, ttl=60)
+    results = []
+    threads = [Thread(target=lambda: results.append(snapshot.get(1))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(results) == 8 and all(r.sessionKey == 1 for r in results)
+    assert server.calls == 1
+
+
+def test_since_newer_than_the_snapshot_fetches_exactly_once():
+    server = FakeServer(sessionKeys=[1])
+    snapshot = SessionSnapshot(server, ttl=60)
+    snapshot.get(1)
+    server.sessionKeys = [1, 2]
+    # Within the TTL, but requested before the alert so the snapshot can't contain the new session
+    assert snapshot.get(2, since=time.monotonic()).sessionKey == 2
+    assert server.calls == 2
+    # A session missing from a snapshot that is already new enough is a miss, not a second request
+    assert snapshot.get(3, since=time.monotonic()) is None
+    assert server.calls == 3
+    assert snapshot.misses == 1
+
+
+def test_missing_session_does_not_refetch_a_snapshot_newer_than_since():
+    server = FakeServer(sessionKeys=[1])
+    snapshot = SessionSnapshot(server, ttl=60)
+    since = time.monotonic()
+    assert snapshot.get(2, since=since) is None
+    assert server.calls == 1
+    assert snapshot.misses == 1
+
+
+def test_request_after_an_alert_waits_for_a_newer_snapshot():
+    server = FakeServer(delay=0.1)
+    snapshot = SessionSnapshot(server, ttl=60)
+    first = Thread(target=snapshot.get, args=(1,))
+    first.start()
+    server.entered.wait(5)
+    # Requested while the first fetch is in flight, that fetch started too early to count
+    received = time.monotonic()
+    snapshot.get(1, since=received)
+    first.join(5)
+    assert server.calls == 2
+
+
+def test_failed_fetch_releases_waiters():
+    class FailingServer(FakeServer):
+        def sessions(self):
+            self.calls += 1
+            raise ConnectionError()
+
+    server = FailingServer()
+    snapshot = SessionSnapshot(server, ttl=60)
+    for _ in range(2):
+        try:
+            snapshot.get(1)
+        except ConnectionError:
+            pass
+    assert server.calls == 2
+    assert not snapshot._inflight
@@ -0,0 +1,50 @@
+import time
+from resources.sessionRegistry import ExpiringSet
+
+
+def test_oldest_entries_are_evicted_at_cap():
+    entries = ExpiringSet(cap=3, ttl=60)
+    for key in range(5):
+        entries.add(key)
+    assert len(entries) == 3
+    assert 0 not in entries and 1 not in entries
+    assert all(key in entries for key in (2, 3, 4))
+
+
+def test_readding_refreshes_position():
+    entries = ExpiringSet(cap=2, ttl=60)
+    entries.add("a")
+    entries.add("b")
+    entries.add("a")
+    entries.add("c")
+    assert "a" in entries and "c" in entries
+    assert "b" not in entries
+
+
+def test_entries_expire_after_ttl():
+    entries = ExpiringSet(cap=10, ttl=0.05)
+    entries.add("a")
+    assert "a" in entries
+    time.sleep(0.1)
+    assert entries.size == 1
+    assert "a" not in entries
+    assert entries.size == 0
+
+
+def test_expired_entries_are_dropped_on_add_and_len():
+    entries = ExpiringSet(cap=10, ttl=0.05)
+    entries.add("a")
+    entries.add("b")
+    time.sleep(0.1)
+    entries.add("c")
+    assert entries.size == 1
+    time.sleep(0.1)
+    assert len(entries) == 0
+
+
+def test_discard():
+    entries = ExpiringSet(cap=10, ttl=60)
+    entries.add("a")
+    entries.discard("a")
+    entries.discard("missing")
+    assert "a" not in entries